@@ -1,4 +1,34 @@
 #!/bin/bash
 export PYTHONPATH=./vendor
-python3 manage.py migrate --noinput
-python3 -m gunicorn --workers 2 myapp.wsgi --bind 0.0.0.0:8000
\ No newline at end of file
+# FAST_START（既定）：マイグレーションが全部適用済みなら migrate を飛ばし、
+# gunicorn の master でアプリを温めてから fork する（gunicorn.conf.py）。段階ごとの秒数はログと /metrics に出る
+if [ "${FAST_START:-true}" = "true" ]; then
+  python3 manage.py migrate_if_needed
+  export STARTUP_WARMUP=true
+else
+  python3 manage.py migrate --noinput
+fi
+# Web とワーカーのどちらかが終わったらコンテナごと終了する（ワーカーだけ落ちてジョブが積まれたままにならないように。
+# 再起動はコンテナの restart policy に任せる）。SIGTERM/SIGINT は両方に渡す
+pids=()
+trap 'kill -TERM "${pids[@]}" 2>/dev/null' TERM INT
+
+# プラン生成ジョブ（Gemini 呼び出し）は gunicorn の外のワーカーで処理する
+# （ASGI で PLAN_JOBS_INLINE=true のときは Web 側で async に待つので不要）
+if [ "${PLAN_JOBS_INLINE:-false}" != "true" ]; then
+  python3 manage.py run_plan_worker --concurrency "${PLAN_WORKER_CONCURRENCY:-4}" &
+  pids+=($!)
+fi
+# SERVER_MODE=asgi で uvicorn ワーカー（async ビューは I/O 待ちの間も同じプロセスで他のリクエストを処理する）
+if [ "${SERVER_MODE:-wsgi}" = "asgi" ]; then
+  python3 -m gunicorn --workers "${WEB_WORKERS:-2}" -k uvicorn_worker.UvicornWorker myapp.asgi --bind 0.0.0.0:8000 &
+else
+  python3 -m gunicorn --workers "${WEB_WORKERS:-2}" myapp.wsgi --bind 0.0.0.0:8000 &
+fi
+pids+=($!)
+
+wait -n
+status=$?
+kill -TERM "${pids[@]}" 2>/dev/null
+wait
+exit "$status"
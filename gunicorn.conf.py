@@ -0,0 +1,16 @@
+"""
+gunicorn の設定（カレントディレクトリの gunicorn.conf.py は自動で読まれる）
+
+STARTUP_WARMUP=true（entrypoint.sh の FAST_START）のときは master でアプリを読み込んで温めてから fork する。
+ワーカーは import・URL・テンプレートが済んだ状態で始まり、Gemini のクライアントを作ってからリクエストを受ける。
+"""
+import os
+
+preload_app = (os.environ.get("STARTUP_WARMUP") or "false") == "true"
+
+
+def post_worker_init(worker):
+    if preload_app:
+        from taskplanner.startup import warm_worker
+
+        warm_worker()
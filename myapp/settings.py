@@ -21,6 +21,62 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
+# プラン生成：ローカル計画エンジンの結果を Gemini で仕上げるか（false ならAIを呼ばない）
+PLAN_AI_POLISH = (os.environ.get("PLAN_AI_POLISH") or "true") == "true"
+
+# Gemini 呼び出し：前のモデルが遅いとき次のモデルを並行で投げるまでの秒数（負の値なら順番に1つずつ）
+AI_HEDGE_DELAY_SECONDS = float(os.environ.get("AI_HEDGE_DELAY_SECONDS") or "2.0")
+# モデルごとのサーキットブレーカー：連続失敗で open、一定時間後に1件だけお試し
+AI_BREAKER_FAILURES = int(os.environ.get("AI_BREAKER_FAILURES") or "3")
+AI_BREAKER_RESET_SECONDS = float(os.environ.get("AI_BREAKER_RESET_SECONDS") or "60")
+# 1リクエストあたりのプロンプトの目安トークン数（超えるとメモを切り詰め、さらにタスクを分割する）
+AI_PROMPT_TOKEN_BUDGET = int(os.environ.get("AI_PROMPT_TOKEN_BUDGET") or "6000")
+# true なら Gemini の応答をストリーミングで受け取り、届いた件数をジョブの進捗として表示する
+AI_STREAMING = (os.environ.get("AI_STREAMING") or "false") == "true"
+# Gemini クライアントの差し替え（例: "taskplanner.ai_fake.FakeGeminiClient"）
+AI_CLIENT_FACTORY = os.environ.get("AI_CLIENT_FACTORY") or None
+
+# AIプラン結果のキャッシュ（BACKEND: memory / django / file / クラスのパス、空ならキャッシュしない）
+AI_PLAN_CACHE = {
+    "BACKEND": os.environ.get("AI_PLAN_CACHE_BACKEND", "django"),
+    "TTL": int(os.environ.get("AI_PLAN_CACHE_TTL") or "600"),
+    "MAX_ENTRIES": int(os.environ.get("AI_PLAN_CACHE_MAX_ENTRIES") or "256"),
+    "LOCATION": os.environ.get("AI_PLAN_CACHE_LOCATION") or None,
+}
+
+# プラン生成ジョブ：true ならリクエスト内で実行（run_plan_worker を起動しないローカル開発用）
+PLAN_JOBS_INLINE = (os.environ.get("PLAN_JOBS_INLINE") or "false") == "true"
+
+# セッションはキャッシュから読み、ログイン状態が変わらない書き込みは DB へ後回しにする（taskplanner.sessions）
+SESSION_ENGINE = "taskplanner.sessions"
+# セッションとログインユーザーをキャッシュに置く秒数。キャッシュがインスタンス間で共有されていないと、
+# ほかのインスタンスでのログアウトやユーザーの変更がこの秒数まで反映されない
+SESSION_CACHE_SECONDS = int(os.environ.get("SESSION_CACHE_SECONDS") or "60")
+# ログイン中のユーザーをキャッシュに置く秒数。ほかのインスタンスでパスワードを変えた/無効にしたユーザーの
+# 古いセッションが通ってしまうのは最長この秒数まで
+SESSION_USER_CACHE_SECONDS = int(os.environ.get("SESSION_USER_CACHE_SECONDS") or "10")
+# DB への前回の書き込みがこの秒数より新しければ、ログイン状態に関わらない変更はキャッシュにだけ書き、
+# あとで DB に書く（0 なら毎回 DB にも書く）。書く前にキャッシュから消えたり、ほかのインスタンスで読まれたりすると
+# その変更は失われるので、インスタンス間で共有するキャッシュ（CACHE_BACKEND）のときだけ SESSION_CACHE_SECONDS 未満で使う
+SESSION_WRITE_BEHIND_SECONDS = int(os.environ.get("SESSION_WRITE_BEHIND_SECONDS") or "0")
+
+# true ならアプリの読み込み時に URL・テンプレート・google.genai を温める（entrypoint.sh の FAST_START で gunicorn の master から）
+STARTUP_WARMUP = (os.environ.get("STARTUP_WARMUP") or "false") == "true"
+
+# リクエストごとの計測（クエリ数/DB時間/AI呼び出し時間 → Server-Timing ヘッダ・JSONログ・/metrics）
+METRICS = {
+    "ENABLED": (os.environ.get("METRICS_ENABLED") or "false") == "true",
+    # クエリ数などの詳細を取るリクエストの割合（件数と所要時間のヒストグラムは全リクエスト）
+    "SAMPLE_RATE": float(os.environ.get("METRICS_SAMPLE_RATE") or "1.0"),
+    # これより遅いリクエストはサンプル外でもログに出す（ミリ秒）
+    "SLOW_REQUEST_MS": int(os.environ.get("METRICS_SLOW_REQUEST_MS") or "1000"),
+    # true なら SLOW_QUERY_MS を超えたクエリの呼び出し元スタックをログに含める
+    "CAPTURE_STACKS": (os.environ.get("METRICS_CAPTURE_STACKS") or "false") == "true",
+    "SLOW_QUERY_MS": int(os.environ.get("METRICS_SLOW_QUERY_MS") or "100"),
+    # /metrics の Bearer トークン（空ならスタッフユーザーのログインが必要）
+    "TOKEN": os.environ.get("METRICS_TOKEN") or "",
+}
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
 
@@ -30,8 +86,9 @@ SECRET_KEY = "django-insecure-&645oimkv=jszi^z8437q(t0-w#u7)!lpflqyud_vg!az_ub*d
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
-ALLOWED_HOSTS = (os.environ.get("ALLOWED_HOSTS") or "").split(",")  # deploy for Railway
-CSRF_TRUSTED_ORIGINS = (os.environ.get("CSRF_TRUSTED_ORIGINS") or "").split(",")
+# 未設定のとき [""] にならないように空の要素は捨てる（CSRF_TRUSTED_ORIGINS の "" はシステムチェックで落ちる）
+ALLOWED_HOSTS = [h for h in (os.environ.get("ALLOWED_HOSTS") or "").split(",") if h]  # deploy for Railway
+CSRF_TRUSTED_ORIGINS = [o for o in (os.environ.get("CSRF_TRUSTED_ORIGINS") or "").split(",") if o]
 
 
 # Application definition
@@ -47,13 +104,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # METRICS["ENABLED"] が false なら読み込み時に外れる
+    "taskplanner.middleware.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.locale.LocaleMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
-    "django.contrib.auth.middleware.AuthenticationMiddleware",
+    # ログインユーザーをキャッシュから引く（taskplanner.sessions）
+    "taskplanner.middleware.CachedAuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -104,6 +164,15 @@ DATABASE_USER = os.environ.get("DB_USER")
 DATABASE_PASSWORD = os.environ.get("DB_PASSWORD")
 DATABASE_PORT = os.environ.get("DB_PORT") or "3306"
 
+# 接続の使い回し：毎リクエストのTLS接続を省く（秒数。0 ならリクエストごとに閉じる）
+DATABASE_CONN_MAX_AGE = int(os.environ.get("DB_CONN_MAX_AGE") or "60")
+# 使い回す接続をリクエストの最初に確認し、切れていれば繋ぎ直す
+DATABASE_CONN_HEALTH_CHECKS = (os.environ.get("DB_CONN_HEALTH_CHECKS") or "true") == "true"
+# コネクションプール（ASGI では接続がリクエストごとになり CONN_MAX_AGE が効かないので既定で有効）
+DATABASE_POOL = (
+    os.environ.get("DB_POOL") or ("true" if os.environ.get("SERVER_MODE") == "asgi" else "false")
+) == "true"
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.mysql",
@@ -112,9 +181,68 @@ DATABASES = {
         "PASSWORD": DATABASE_PASSWORD,
         "HOST": DATABASE_HOST,
         "PORT": DATABASE_PORT,
+        "CONN_MAX_AGE": DATABASE_CONN_MAX_AGE,
+        "CONN_HEALTH_CHECKS": DATABASE_CONN_HEALTH_CHECKS,
+    }
+}
+
+# ローカルのベンチマーク/開発用：DB_ENGINE=sqlite なら SQLite（DB_NAME があればそのファイル）
+if os.environ.get("DB_ENGINE") == "sqlite":
+    DATABASE_POOL = False
+    DATABASES["default"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": DATABASE_NAME or BASE_DIR / "db.sqlite3",
+        "CONN_MAX_AGE": DATABASE_CONN_MAX_AGE,
+        "CONN_HEALTH_CHECKS": DATABASE_CONN_HEALTH_CHECKS,
+    }
+
+if DATABASE_POOL:
+    # リクエストの終わりに毎回プールへ返す（生死の確認はプールが貸す前に行う）
+    DATABASES["default"].update({
+        "ENGINE": "taskplanner.dbpool",
+        "CONN_MAX_AGE": 0,
+        "OPTIONS": {
+            "pool": {
+                "size": int(os.environ.get("DB_POOL_SIZE") or "5"),
+                "max_overflow": int(os.environ.get("DB_POOL_MAX_OVERFLOW") or "10"),
+                "recycle": int(os.environ.get("DB_POOL_RECYCLE") or "1800"),
+                "timeout": float(os.environ.get("DB_POOL_TIMEOUT") or "10"),
+                "pre_ping": (os.environ.get("DB_POOL_PRE_PING") or "true") == "true",
+            },
+        },
+    })
+
+
+# Cache
+# gunicorn の各ワーカーと run_plan_worker で共有したいので、本番は FileBasedCache 等を環境変数で指定する
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get("CACHE_BACKEND") or "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": os.environ.get("CACHE_LOCATION") or "",
+        "OPTIONS": {"MAX_ENTRIES": int(os.environ.get("CACHE_MAX_ENTRIES") or "5000")},
     }
 }
 
+# カレンダー/プラン設計画面の断片キャッシュの保持秒数（キーに世代が入るので、長くても古い表示は出ない）
+PAGE_CACHE_SECONDS = int(os.environ.get("PAGE_CACHE_SECONDS") or "3600")
+
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {"class": "logging.StreamHandler"},
+    },
+    "loggers": {
+        # 計測ミドルウェアの1リクエスト1行のJSON
+        "taskplanner.metrics": {"handlers": ["console"], "level": "INFO", "propagate": False},
+        # 起動の段階ごとの秒数（startup.report）
+        "taskplanner.startup": {"handlers": ["console"], "level": "INFO", "propagate": False},
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -13,4 +13,7 @@ from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myapp.settings')
 
-application = get_wsgi_application()
+from taskplanner.startup import load_application  # noqa: E402
+
+# 読み込みの時間を測り、STARTUP_WARMUP なら温めてから返す
+application = load_application(get_wsgi_application)
@@ -0,0 +1,185 @@
+"""
+AIプラン結果のキャッシュ（内容アドレス方式）
+
+キーは「tasks / existing_events / availability / window / draft」を正規化したJSONの sha256 に、
+ユーザーのキャッシュ世代を混ぜたもの。入力が1文字でも変われば別キーになるので、
+世代（PlanTask/Schedule の保存・削除で進む）は古いエントリを早めに捨てるための補助。
+draft（ローカル計画）は not_before（今）以降の空きに詰めたものなので、時間が進んで
+最初の空きがずれれば別キーになり、過去の枠を指す答えをリプレイしない。
+
+settings.AI_PLAN_CACHE で設定する:
+    {"BACKEND": "memory" | "django" | "file" | "<dotted.path.Backend>",
+     "TTL": 600, "MAX_ENTRIES": 256, "LOCATION": "..."}
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from .caching import user_version
+
+CACHE_NAMESPACE = "ai_plan"
+DEFAULT_TTL = 600
+DEFAULT_MAX_ENTRIES = 256
+
+
+def plan_cache_key(
+    task_dicts, existing_events, availability, window_start, window_end, draft=None, user_id=None
+) -> str:
+    payload = {
+        "tasks": task_dicts,
+        "events": existing_events,
+        "availability": availability,
+        "window": [window_start, window_end],
+        "draft": draft,
+    }
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    digest = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+    if user_id is None:
+        return f"aiplan:{digest}"
+    return f"aiplan:{user_id}:{user_version(user_id, CACHE_NAMESPACE)}:{digest}"
+
+
+class MemoryBackend:
+    """プロセス内の LRU + TTL"""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, **kwargs):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return None
+            expires, value = hit
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DjangoCacheBackend:
+    """settings.CACHES のキャッシュを使う（LRU/上限はキャッシュ側の設定に従う）"""
+
+    def __init__(self, ttl=DEFAULT_TTL, location="default", **kwargs):
+        self.ttl = ttl
+        self.cache = caches[location or "default"]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.ttl)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class FileBackend:
+    """
+    1エントリ1ファイル（同じコンテナ内の複数プロセスで共有できる）
+    読んだファイルは mtime を更新し、上限を超えたら mtime の古い順に消す（LRU）。
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, location=None, **kwargs):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.directory = location or os.path.join(tempfile.gettempdir(), "myapp-ai-plan-cache")
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("expires", 0) < time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry.get("value")
+
+    def set(self, key, value):
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"expires": time.time() + self.ttl, "value": value}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        self._evict()
+
+    def _evict(self):
+        try:
+            entries = [e for e in os.scandir(self.directory) if e.name.endswith(".json")]
+        except OSError:
+            return
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for e in entries[: len(entries) - self.max_entries]:
+            try:
+                os.remove(e.path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for e in os.scandir(self.directory):
+            if e.name.endswith(".json"):
+                try:
+                    os.remove(e.path)
+                except OSError:
+                    pass
+
+
+BACKENDS = {
+    "memory": MemoryBackend,
+    "django": DjangoCacheBackend,
+    "file": FileBackend,
+}
+
+
+@lru_cache(maxsize=1)
+def get_backend():
+    conf = getattr(settings, "AI_PLAN_CACHE", None) or {}
+    name = conf.get("BACKEND", "memory")
+    if not name:
+        return None
+    cls = BACKENDS.get(name) or import_string(name)
+    return cls(
+        ttl=conf.get("TTL", DEFAULT_TTL),
+        max_entries=conf.get("MAX_ENTRIES", DEFAULT_MAX_ENTRIES),
+        location=conf.get("LOCATION"),
+    )
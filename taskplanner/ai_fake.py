@@ -0,0 +1,97 @@
+"""
+Gemini の代わりに使うローカルのフェイククライアント（テスト/ベンチマーク用）
+
+settings.AI_CLIENT_FACTORY = "taskplanner.ai_fake.FakeGeminiClient" で ai_service から使われる。
+ネットワークには一切出ず、プロンプト中の draft（ローカル計画 [id,s,e,est]）をそのまま返す。
+"""
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+
+class FakeGeminiClient:
+    def __init__(self, latency=0.0, fail_models=(), response=None):
+        """
+        latency: 応答までの秒数。{"モデル名": 秒} でモデルごとにも指定できる
+        fail_models: 503 を返すモデル名
+        response: 返すテキストを固定したいとき（None なら draft を返す）
+        """
+        self.latency = latency
+        self.fail_models = set(fail_models)
+        self.response = response
+        self.calls = []
+        self.models = _FakeModels(self)
+        self.aio = SimpleNamespace(models=_FakeAsyncModels(self))
+
+
+class _FakeModels:
+    def __init__(self, client: FakeGeminiClient):
+        self._client = client
+
+    def _latency(self, model):
+        latency = self._client.latency
+        if isinstance(latency, dict):
+            return latency.get(model, 0.0)
+        return latency or 0.0
+
+    def generate_content(self, *, model, contents, config=None):
+        self._client.calls.append(model)
+
+        wait = self._latency(model)
+        if wait:
+            time.sleep(wait)
+
+        if model in self._client.fail_models:
+            raise RuntimeError(f"503 UNAVAILABLE: {model} is under high demand (fake)")
+
+        text = self._client.response
+        if text is None:
+            text = json.dumps(extract_draft(contents), ensure_ascii=False)
+        return SimpleNamespace(text=text)
+
+    def generate_content_stream(self, *, model, contents, config=None, chunk_size=16):
+        """本物と同じく、テキストを少しずつ返す（latency は最初の1チャンクまでの時間）"""
+        text = self.generate_content(model=model, contents=contents, config=config).text
+        for i in range(0, len(text), chunk_size):
+            yield SimpleNamespace(text=text[i:i + chunk_size])
+
+
+class _FakeAsyncModels:
+    """client.aio.models の代わり（待ち時間は asyncio.sleep なのでイベントループを止めない）"""
+
+    def __init__(self, client: FakeGeminiClient):
+        self._client = client
+
+    _latency = _FakeModels._latency
+
+    async def generate_content(self, *, model, contents, config=None):
+        self._client.calls.append(model)
+
+        wait = self._latency(model)
+        if wait:
+            await asyncio.sleep(wait)
+
+        if model in self._client.fail_models:
+            raise RuntimeError(f"503 UNAVAILABLE: {model} is under high demand (fake)")
+
+        text = self._client.response
+        if text is None:
+            text = json.dumps(extract_draft(contents), ensure_ascii=False)
+        return SimpleNamespace(text=text)
+
+
+def extract_draft(prompt: str):
+    """プロンプトの最後にある「draft: [[id,s,e,est], ...]」を AI の出力形式にして返す"""
+    marker = "draft:"
+    idx = prompt.rfind(marker)
+    if idx < 0:
+        return []
+    try:
+        rows = json.loads(prompt[idx + len(marker):].strip())
+    except ValueError:
+        return []
+    return [
+        {"id": row[0], "order": n, "s": row[1], "e": row[2], "est": row[3]}
+        for n, row in enumerate(rows, start=1)
+    ]
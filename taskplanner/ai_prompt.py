@@ -0,0 +1,223 @@
+"""
+ai_plan_tasks 用のコンパクトなプロンプト生成
+
+- 日時は ISO 文字列ではなく「window_start からの分」で渡す（AIの出力も分で受け取る）
+- 既存予定はタイトルを捨てて、重なりを結合した busy 区間にしてから渡す
+- tasks は列名を1回だけ書いた配列（キーの繰り返しをなくす）
+- メモはトークン予算に収まるまで切り詰め、それでも入らなければタスクを複数リクエストに分割する
+"""
+from __future__ import annotations
+
+import json
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+DEFAULT_TOKEN_BUDGET = 6000
+MEMO_LIMITS = (120, 60, 20, 0)
+
+TASK_COLUMNS = ["id", "title", "memo", "p", "deadline", "desired", "est", "lock"]
+
+PROMPT_TEMPLATE = """あなたはタスク計画アシスタントです。
+目的: 既存予定(busy)を避けて、新規タスクをスケジューリングしてください。
+
+時刻の表し方: すべて window_start からの経過分（整数）。window は 0〜{horizon}。
+
+制約:
+- busy の区間には絶対に重ねない
+- 0〜{horizon} の範囲内、かつ作業可能時間(free)の中に入れる
+- deadline が近い/p(priority, 1が高) が高いタスクを優先
+- desired があるタスクは可能な限りその時刻に寄せる（無理なら最も近い空き枠）
+- est が null のタスクは title/memo から推定して埋める
+- 連続作業は最大90分、間に10分休憩。開始は{slot}分単位
+- lock の文字は固定値: P=p, D=desired, E=est。固定値は絶対に変更しない
+- draft はローカル計画エンジンが作った、上の制約をすべて満たす下書き [id,s,e,est]
+- draft より良くできる場合のみ変更し、それ以外は draft をそのまま返す
+- draft にあるタスク(id)は1つも落とさない
+
+出力: JSON配列のみ。余計な文章は禁止。
+各要素: {{"id":int,"order":int(1からの連番),"s":開始分,"e":終了分,"est":int,"p":int}}
+
+tasks({columns}):
+{tasks}
+free: {free}
+busy: {busy}
+draft: {draft}"""
+
+
+def estimate_tokens(text: str) -> int:
+    """ざっくり見積もり：ASCII は4文字で1トークン、日本語などは1文字1トークン"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+def _parse_dt(value) -> Optional[datetime]:
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def merge_busy(intervals):
+    out: List[List[int]] = []
+    for s, e in sorted(intervals):
+        if e <= s:
+            continue
+        if out and s <= out[-1][1]:
+            out[-1][1] = max(out[-1][1], e)
+        else:
+            out.append([s, e])
+    return out
+
+
+class PlanPrompt:
+    """
+    1回分の入力（tasks/busy/availability/window/draft）をコンパクトに符号化する。
+    render() でプロンプト文字列、decode() でAIの出力を PlanItem（ISO日時）に戻す。
+    """
+
+    def __init__(self, task_dicts, existing_events, availability, window_start, window_end, draft=None):
+        self.window_start = _parse_dt(window_start)
+        self.window_end = _parse_dt(window_end)
+        self.availability = availability or {}
+        self.tasks = list(task_dicts or [])
+        self.draft = list(draft or [])
+        self.horizon = self.offset(self.window_end)
+
+        busy = []
+        for ev in existing_events or []:
+            s = _parse_dt(ev.get("start"))
+            e = _parse_dt(ev.get("end"))
+            if s and e:
+                busy.append((max(0, self.offset(s)), min(self.horizon, self.offset(e))))
+        self.busy = merge_busy(busy)
+
+    # ---------- 変換 ----------
+    def offset(self, dt) -> Optional[int]:
+        dt = _parse_dt(dt)
+        if dt is None:
+            return None
+        return int((dt - self.window_start).total_seconds() // 60)
+
+    def to_iso(self, minutes: int) -> str:
+        return (self.window_start + timedelta(minutes=int(minutes))).isoformat()
+
+    def _task_row(self, t, memo_limit: int):
+        memo = (t.get("memo") or "").replace("\n", " ").strip()
+        if len(memo) > memo_limit:
+            memo = memo[:memo_limit] + "…" if memo_limit else ""
+        lock = ""
+        if t.get("priority_locked"):
+            lock += "P"
+        if t.get("desired_at_locked"):
+            lock += "D"
+        if t.get("estimated_minutes_locked"):
+            lock += "E"
+        return [
+            t.get("id"),
+            t.get("title") or "",
+            memo,
+            t.get("priority"),
+            self.offset(t.get("deadline")),
+            self.offset(t.get("desired_at")),
+            t.get("estimated_minutes"),
+            lock,
+        ]
+
+    def _free(self):
+        """作業可能時間は曜日ごとの時計表記のまま渡す（日数分展開しない）"""
+        av = self.availability
+        out = {}
+        for key in ("weekday", "weekend"):
+            if av.get(key):
+                out[key] = [f"{r.get('start')}-{r.get('end')}" for r in av[key]]
+        out["tz"] = av.get("timezone")
+        out["window_start"] = self.window_start.isoformat() if self.window_start else None
+        return out
+
+    def _draft_rows(self, task_ids):
+        rows = []
+        for d in self.draft:
+            if d.get("id") not in task_ids:
+                continue
+            s = self.offset(d.get("start_at"))
+            e = self.offset(d.get("end_at"))
+            if s is None or e is None:
+                continue
+            rows.append([d["id"], s, e, d.get("estimated_minutes")])
+        return rows
+
+    @staticmethod
+    def _dumps(value) -> str:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+    def render(self, tasks, memo_limit: int = MEMO_LIMITS[0], extra_busy=()) -> str:
+        task_ids = {t.get("id") for t in tasks}
+        busy = merge_busy([tuple(b) for b in self.busy] + list(extra_busy))
+        return PROMPT_TEMPLATE.format(
+            horizon=self.horizon,
+            slot=self.availability.get("slot_minutes") or 15,
+            columns=",".join(TASK_COLUMNS),
+            tasks="\n".join(self._dumps(self._task_row(t, memo_limit)) for t in tasks),
+            free=self._dumps(self._free()),
+            busy=self._dumps(busy),
+            draft=self._dumps(self._draft_rows(task_ids)),
+        )
+
+    # ---------- 予算と分割 ----------
+    def batches(self, budget: int = DEFAULT_TOKEN_BUDGET):
+        """
+        (tasks, memo_limit) の配列を返す。
+        まずメモを段階的に切り詰め、それでも予算を超えるならタスクを分割する。
+        """
+        for memo_limit in MEMO_LIMITS:
+            if estimate_tokens(self.render(self.tasks, memo_limit)) <= budget:
+                return [(self.tasks, memo_limit)]
+
+        memo_limit = MEMO_LIMITS[-2]
+        overhead = estimate_tokens(self.render([], memo_limit))
+        batches = []
+        current, used = [], overhead
+        for t in self.tasks:
+            cost = estimate_tokens(self._dumps(self._task_row(t, memo_limit))) + 12  # draft 行のぶん
+            if current and used + cost > budget:
+                batches.append((current, memo_limit))
+                current, used = [], overhead
+            current.append(t)
+            used += cost
+        if current:
+            batches.append((current, memo_limit))
+        return batches
+
+    # ---------- 出力の復元 ----------
+    def decode(self, items) -> list:
+        out = []
+        for r in items:
+            if not isinstance(r, dict):
+                continue
+            item = dict(r)
+            if "s" in item and "e" in item:
+                try:
+                    item["start_at"] = self.to_iso(item.pop("s"))
+                    item["end_at"] = self.to_iso(item.pop("e"))
+                except (TypeError, ValueError):
+                    continue
+            if "est" in item:
+                item["estimated_minutes"] = item.pop("est")
+            if "p" in item:
+                item["priority"] = item.pop("p")
+            out.append(item)
+        return out
+
+    def spans(self, items):
+        """decode 済みの結果を分オフセットの区間にする（後続バッチの busy に足す用）"""
+        out = []
+        for r in items:
+            s = self.offset(r.get("start_at"))
+            e = self.offset(r.get("end_at"))
+            if s is not None and e is not None and e > s:
+                out.append((s, e))
+        return out
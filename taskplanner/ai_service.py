@@ -1,19 +1,38 @@
 from __future__ import annotations
 
+import asyncio
+import contextvars
 import os
 import json
 import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from functools import lru_cache
-from typing import List
+from typing import Dict, Iterator, List
 import typing
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
 from google import genai
 from google.genai import types
 
+from .ai_cache import get_backend, plan_cache_key
+from .ai_prompt import DEFAULT_TOKEN_BUDGET, PlanPrompt
+from .ai_stream import JsonArrayParser
+from .metrics import record_ai_attempt
+
 
 @lru_cache(maxsize=1)
 def _get_client() -> genai.Client:
+    # AI_CLIENT_FACTORY に "taskplanner.ai_fake.FakeGeminiClient" などを置くと差し替えられる（テスト/ベンチ用）
+    factory = getattr(settings, "AI_CLIENT_FACTORY", None)
+    if factory:
+        return import_string(factory)()
+
     # settings.py に GEMINI_API_KEY = "..." を置く想定
     api_key = getattr(settings, "GEMINI_API_KEY", None) or os.getenv("GEMINI_API_KEY")
     if not api_key:
@@ -29,6 +48,77 @@ MODEL_CANDIDATES = [
 ]
 
 
+class CircuitBreaker:
+    """
+    モデルごとのサーキットブレーカー
+    - closed: 通常どおり呼ぶ。連続 failure_threshold 回失敗したら open
+    - open: reset_timeout 秒間は呼ばずに即スキップ
+    - half_open: 時間が経ったら1件だけお試しで通し、成功で closed / 失敗で open に戻す
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_abandoned(self) -> None:
+        """結果を待たずに打ち切った呼び出し（async のヘッジで負けた側）。成功/失敗には数えない"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(model: str) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(model)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                failure_threshold=getattr(settings, "AI_BREAKER_FAILURES", 3),
+                reset_timeout=getattr(settings, "AI_BREAKER_RESET_SECONDS", 60.0),
+            )
+            _breakers[model] = breaker
+        return breaker
+
+
 class PlanItem(typing.TypedDict, total=False):
     id: int
     order: int
@@ -38,82 +128,387 @@ class PlanItem(typing.TypedDict, total=False):
     priority: int
 
 
+def _starts_in_past(result) -> bool:
+    """どれかの start_at がもう過ぎている（リプレイしても accepts() で捨てられる）"""
+    now = timezone.now()
+    for item in result:
+        start = parse_datetime(str(item.get("start_at") or ""))
+        if start is None:
+            continue
+        if timezone.is_naive(start):
+            start = timezone.make_aware(start)
+        if start < now:
+            return True
+    return False
+
+
+def _cached_plan(task_dicts, existing_events, availability, window_start, window_end, draft, cache_user_id):
+    """
+    (backend, key, キャッシュ済みの結果 or None)。キャッシュが無効なら backend/key も None
+    下書き（not_before 以降の空きに詰めたローカル計画）もキーに含めるので、時間が進めば別キーになる。
+    同じキーでも開始がもう過ぎた結果は返さない
+    """
+    backend = get_backend()
+    if backend is None:
+        return None, None, None
+    cache_key = plan_cache_key(
+        task_dicts, existing_events, availability, window_start, window_end, draft=draft, user_id=cache_user_id
+    )
+    cached = backend.get(cache_key)
+    if cached is not None and _starts_in_past(cached):
+        cached = None
+    return backend, cache_key, cached
+
+
 def ai_plan_tasks(
     task_dicts,
     existing_events,
     availability,
     window_start: str,
     window_end: str,
+    draft=None,
+    cache_user_id=None,
 ) -> List[PlanItem]:
+    # 同じ入力なら API を呼ばずにキャッシュから返す（キーは入力内容のハッシュ + ユーザーの世代）
+    backend, cache_key, cached = _cached_plan(
+        task_dicts, existing_events, availability, window_start, window_end, draft, cache_user_id
+    )
+    if cached is not None:
+        return cached
+
     client = _get_client()
-    prompt = f"""
-    あなたはタスク計画アシスタントです。
-    目的: 既存カレンダー予定を避けて、新規タスクをスケジューリングしてください。
-
-    制約:
-    - 既存予定(existing_events)の時間帯には絶対に重ねない
-    - window_start〜window_end の範囲内に収める
-    - 作業可能時間(availability)の範囲内に入れる
-    - deadline が近い/priority が高いタスクを優先
-    - desired_at があるタスクは可能な限りその日時に寄せる（無理なら最も近い空き枠）
-    - estimated_minutes が null のタスクは内容(memo/title)から推定して埋める
-    - 1日の中で無理な詰め込みを避ける（連続作業は最大90分、間に10分休憩）
-    - 出力は JSON配列のみ。余計な文章は禁止。
-    - 各要素に order を必ず付ける（1からの連番）
-    追加の重要ルール（固定値の尊重）:
-    - tasks の *_locked が true の項目は絶対に変更しない
-    - desired_at_locked=true のタスクは start_at/end_at を desired_at に合わせる（衝突時のみ最寄り空きへ）
-    - estimated_minutes_locked=true のタスクは estimated_minutes を変更しない
-    - priority_locked=true のタスクは priority を変更しない
-    - *_locked=false または値が null の項目だけ推定・決定してよい
-
-    出力方針:
-    - 既に決まっている値を「上書き」するのは禁止
-    - 未定な項目のみを決めて出力する
-
-
-    入力:
-    tasks: {task_dicts}
-
-    existing_events:{existing_events}
-
-    availability: {availability}
-
-    window_start: "{window_start}"
-    window_end: "{window_end}"
-    """.strip()
+    config = types.GenerateContentConfig(
+        response_mime_type="application/json",
+    )
+
+    # 入力はコンパクトに符号化し、トークン予算を超える場合は複数リクエストに分割する
+    builder = PlanPrompt(task_dicts, existing_events, availability, window_start, window_end, draft=draft)
+    batches = builder.batches(getattr(settings, "AI_PROMPT_TOKEN_BUDGET", DEFAULT_TOKEN_BUDGET))
+
+    result: List[PlanItem] = []
+    planned_spans = []
+    for tasks, memo_limit in batches:
+        # 前のバッチで置いた時間帯は、次のバッチでは busy として扱う
+        prompt = builder.render(tasks, memo_limit, extra_busy=planned_spans)
+        items = builder.decode(_dispatch(client, prompt, config))
+        result.extend(items)
+        planned_spans.extend(builder.spans(items))
+
+    _renumber(result, len(batches))
+
+    if backend is not None:
+        backend.set(cache_key, result)
+    return result
+
+
+async def ai_plan_tasks_async(
+    task_dicts,
+    existing_events,
+    availability,
+    window_start: str,
+    window_end: str,
+    draft=None,
+    cache_user_id=None,
+) -> List[PlanItem]:
+    """
+    ai_plan_tasks の async 版（ASGI のビューから使う）。
+    Gemini は client.aio で呼ぶので、応答待ちの間スレッドを占有しない。
+    キャッシュ（ファイル/DB の場合がある）はスレッドで読み書きする。
+    """
+    backend, cache_key, cached = await sync_to_async(_cached_plan)(
+        task_dicts, existing_events, availability, window_start, window_end, draft, cache_user_id
+    )
+    if cached is not None:
+        return cached
+
+    client = _get_client()
+    config = types.GenerateContentConfig(
+        response_mime_type="application/json",
+    )
+
+    builder = PlanPrompt(task_dicts, existing_events, availability, window_start, window_end, draft=draft)
+    batches = builder.batches(getattr(settings, "AI_PROMPT_TOKEN_BUDGET", DEFAULT_TOKEN_BUDGET))
+
+    result: List[PlanItem] = []
+    planned_spans = []
+    for tasks, memo_limit in batches:
+        prompt = builder.render(tasks, memo_limit, extra_busy=planned_spans)
+        items = builder.decode(await _adispatch(client, prompt, config))
+        result.extend(items)
+        planned_spans.extend(builder.spans(items))
+
+    _renumber(result, len(batches))
+
+    if backend is not None:
+        await sync_to_async(backend.set)(cache_key, result)
+    return result
+
+
+def _renumber(result: List[PlanItem], batch_count: int) -> None:
+    """複数バッチに分けたときは開始順に並べ直して order を振り直す"""
+    if batch_count > 1:
+        result.sort(key=lambda r: (r.get("start_at") or "", r.get("id") or 0))
+        for order, r in enumerate(result, start=1):
+            r["order"] = order
 
+
+def ai_plan_tasks_stream(
+    task_dicts,
+    existing_events,
+    availability,
+    window_start: str,
+    window_end: str,
+    draft=None,
+    cache_user_id=None,
+) -> Iterator[PlanItem]:
+    """
+    ai_plan_tasks のストリーミング版。PlanItem が1件そろうたびに yield する。
+    （ヘッジはせず、1件も返していない間だけ次のモデルに切り替える）
+    """
+    backend, cache_key, cached = _cached_plan(
+        task_dicts, existing_events, availability, window_start, window_end, draft, cache_user_id
+    )
+    if cached is not None:
+        yield from cached
+        return
+
+    client = _get_client()
     config = types.GenerateContentConfig(
         response_mime_type="application/json",
     )
 
+    builder = PlanPrompt(task_dicts, existing_events, availability, window_start, window_end, draft=draft)
+    batches = builder.batches(getattr(settings, "AI_PROMPT_TOKEN_BUDGET", DEFAULT_TOKEN_BUDGET))
+
+    result: List[PlanItem] = []
+    planned_spans = []
+    for tasks, memo_limit in batches:
+        prompt = builder.render(tasks, memo_limit, extra_busy=planned_spans)
+        for item in _stream_batch(client, prompt, config, builder):
+            if len(batches) > 1:
+                item["order"] = len(result) + 1
+            result.append(item)
+            planned_spans.extend(builder.spans([item]))
+            yield item
+
+    if backend is not None:
+        backend.set(cache_key, result)
+
+
+def _valid_item(item) -> bool:
+    try:
+        int(item.get("id"))
+    except (TypeError, ValueError):
+        return False
+    return isinstance(item.get("start_at"), str) and isinstance(item.get("end_at"), str)
+
+
+def _stream_batch(client, prompt: str, config, builder: PlanPrompt) -> Iterator[PlanItem]:
     last_err = None
     for model in MODEL_CANDIDATES:
+        breaker = get_breaker(model)
+        if not breaker.allow():
+            continue
+
+        parser = JsonArrayParser()
+        yielded = 0
+        started = time.monotonic()
         try:
-            resp = client.models.generate_content(
-                model=model,
-                contents=prompt,
-                config=config,
-            )
+            for chunk in client.models.generate_content_stream(model=model, contents=prompt, config=config):
+                for obj in parser.feed(getattr(chunk, "text", None) or ""):
+                    for item in builder.decode([obj]):
+                        if _valid_item(item):
+                            yielded += 1
+                            yield item
+            parser.close()
+        except Exception as e:
+            breaker.record_failure()
+            record_ai_attempt(model, time.monotonic() - started, "error")
+            last_err = e
+            if yielded:
+                # 途中まで返してしまったので、別モデルでやり直すと重複する
+                raise
+            continue
 
-            # --- ここから：自前でJSONパース ---
-            text = getattr(resp, "text", None)
-            if not text:
-                # SDKによっては candidates から取れることもあるので保険
-                raise ValueError("AI応答に text がありません")
+        breaker.record_success()
+        record_ai_attempt(model, time.monotonic() - started, "ok")
+        return
 
-            # たまに ```json ... ``` で返ってくる事故対策
-            text = text.strip()
-            text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text)
+    if last_err is None:
+        last_err = RuntimeError("AIモデルが全て一時停止中です（503 UNAVAILABLE）")
+    raise last_err
 
-            data = json.loads(text)
 
-            if not isinstance(data, list):
-                raise ValueError(f"AI出力がlistではありません: {type(data)}")
+def _parse_plan_text(text) -> List[PlanItem]:
+    if not text:
+        # SDKによっては candidates から取れることもあるので保険
+        raise ValueError("AI応答に text がありません")
 
-            return data
-            # --- ここまで ---
-        except Exception as e:
-            last_err = e
+    # たまに ```json ... ``` で返ってくる事故対策
+    text = text.strip()
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text)
+
+    data = json.loads(text)
+
+    if not isinstance(data, list):
+        raise ValueError(f"AI出力がlistではありません: {type(data)}")
+
+    return data
+
+
+def _attempt(client, model: str, prompt: str, config) -> List[PlanItem]:
+    """1モデル分の呼び出し。結果はブレーカーに記録する（打ち切られた呼び出しも含めて）"""
+    breaker = get_breaker(model)
+    started = time.monotonic()
+    try:
+        resp = client.models.generate_content(
+            model=model,
+            contents=prompt,
+            config=config,
+        )
+        data = _parse_plan_text(getattr(resp, "text", None))
+    except Exception:
+        breaker.record_failure()
+        record_ai_attempt(model, time.monotonic() - started, "error")
+        raise
+    breaker.record_success()
+    record_ai_attempt(model, time.monotonic() - started, "ok")
+    return data
+
+
+def _dispatch(client, prompt: str, config) -> List[PlanItem]:
+    """
+    MODEL_CANDIDATES を順に試すが、前のモデルが AI_HEDGE_DELAY_SECONDS 秒返ってこなければ
+    次のモデルも並行して走らせる（ヘッジ）。最初に正しいJSON配列を返したものを採用し、残りは捨てる。
+    サーキットが開いているモデルは最初から呼ばない。
+    """
+    delay = getattr(settings, "AI_HEDGE_DELAY_SECONDS", 2.0)
+    hedging = delay is not None and delay >= 0
+
+    executor = ThreadPoolExecutor(max_workers=len(MODEL_CANDIDATES), thread_name_prefix="ai-dispatch")
+    pending = {}
+    remaining = list(MODEL_CANDIDATES)
+    last_err = None
+
+    def launch() -> bool:
+        # ブレーカーへの問い合わせは「実際に投げる直前」に行う（half_open のお試し枠を無駄にしない）
+        while remaining:
+            model = remaining.pop(0)
+            if get_breaker(model).allow():
+                # 計測中のリクエスト（contextvar）をスレッドにも引き継ぐ
+                ctx = contextvars.copy_context()
+                pending[executor.submit(ctx.run, _attempt, client, model, prompt, config)] = model
+                return True
+        return False
+
+    try:
+        launch()
+        launched_at = time.monotonic()
+        while pending:
+            timeout = None
+            if hedging and remaining:
+                timeout = max(0.0, launched_at + delay - time.monotonic())
+
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # 返事が遅い：次のモデルを並行で投げる
+                launch()
+                launched_at = time.monotonic()
+                continue
+
+            for f in done:
+                pending.pop(f)
+                try:
+                    return f.result()
+                except Exception as e:
+                    last_err = e
+
+            # 失敗したら待たずに次のモデルへ
+            if not pending:
+                launch()
+                launched_at = time.monotonic()
+    finally:
+        for f in pending:
+            f.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if last_err is None:
+        last_err = RuntimeError("AIモデルが全て一時停止中です（503 UNAVAILABLE）")
+    raise last_err
+
+
+async def _aattempt(client, model: str, prompt: str, config) -> List[PlanItem]:
+    """_attempt の async 版。ヘッジで負けて打ち切られたときは成功/失敗に数えない"""
+    breaker = get_breaker(model)
+    started = time.monotonic()
+    try:
+        resp = await client.aio.models.generate_content(
+            model=model,
+            contents=prompt,
+            config=config,
+        )
+        data = _parse_plan_text(getattr(resp, "text", None))
+    except asyncio.CancelledError:
+        breaker.record_abandoned()
+        record_ai_attempt(model, time.monotonic() - started, "abandoned")
+        raise
+    except Exception:
+        breaker.record_failure()
+        record_ai_attempt(model, time.monotonic() - started, "error")
+        raise
+    breaker.record_success()
+    record_ai_attempt(model, time.monotonic() - started, "ok")
+    return data
+
+
+async def _adispatch(client, prompt: str, config) -> List[PlanItem]:
+    """_dispatch の async 版（スレッドの代わりにタスクでヘッジする）"""
+    delay = getattr(settings, "AI_HEDGE_DELAY_SECONDS", 2.0)
+    hedging = delay is not None and delay >= 0
+
+    pending = {}
+    remaining = list(MODEL_CANDIDATES)
+    last_err = None
+
+    def launch() -> bool:
+        while remaining:
+            model = remaining.pop(0)
+            if get_breaker(model).allow():
+                pending[asyncio.ensure_future(_aattempt(client, model, prompt, config))] = model
+                return True
+        return False
+
+    try:
+        launch()
+        launched_at = time.monotonic()
+        while pending:
+            timeout = None
+            if hedging and remaining:
+                timeout = max(0.0, launched_at + delay - time.monotonic())
+
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                launch()
+                launched_at = time.monotonic()
+                continue
+
+            for t in done:
+                pending.pop(t)
+                try:
+                    return t.result()
+                except Exception as e:
+                    last_err = e
+
+            if not pending:
+                launch()
+                launched_at = time.monotonic()
+    finally:
+        # 負けた側は打ち切る（ブレーカーの後始末が済むまで待つ）
+        for t in pending:
+            t.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
 
+    if last_err is None:
+        last_err = RuntimeError("AIモデルが全て一時停止中です（503 UNAVAILABLE）")
     raise last_err
@@ -0,0 +1,89 @@
+"""
+ストリーミング応答用のインクリメンタル JSON 配列パーサ
+
+Gemini から少しずつ届くテキスト（例: '[{"id":1,"s":540', ',"e":570}, {"id":2...'）を feed() に渡すと、
+配列の要素が1つ閉じた時点でその要素を返す。文字列中の {} や \\" も正しく扱う。
+"""
+import json
+
+
+class JsonArrayParser:
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0          # 次に走査する位置
+        self._start = None     # 読み途中の要素の開始位置
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self.started = False   # '[' を読んだか
+        self.finished = False  # ']' を読んだか
+
+    def feed(self, text: str) -> list:
+        if not text or self.finished:
+            return []
+        self._buf += text
+        out = []
+        buf = self._buf
+        i = self._pos
+
+        while i < len(buf):
+            ch = buf[i]
+
+            if not self.started:
+                # ```json などの前置きは '[' まで読み飛ばす
+                if ch == "[":
+                    self.started = True
+                i += 1
+                continue
+
+            if self._start is None:
+                if ch in " \t\r\n,":
+                    i += 1
+                    continue
+                if ch == "]":
+                    self.finished = True
+                    i += 1
+                    break
+                self._start = i
+                self._depth = 0
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif self._depth == 0 and ch in ",]" and buf[self._start] not in "{[":
+                # 数値などのスカラー要素
+                out.append(json.loads(buf[self._start:i].strip()))
+                self._start = None
+                if ch == "]":
+                    self.finished = True
+                    i += 1
+                    break
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    out.append(json.loads(buf[self._start:i + 1]))
+                    self._start = None
+            i += 1
+
+        # 読み終えた部分は捨ててバッファを小さく保つ
+        keep = self._start if self._start is not None else i
+        self._buf = buf[keep:]
+        if self._start is not None:
+            self._start = 0
+        self._pos = i - keep
+        return out
+
+    def close(self) -> None:
+        """ストリーム終了時に呼ぶ。配列が閉じていなければ ValueError"""
+        if not self.started:
+            raise ValueError("AI出力がlistではありません")
+        if not self.finished:
+            raise ValueError("AI出力のJSON配列が途中で終わっています")
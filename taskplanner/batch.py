@@ -0,0 +1,233 @@
+"""
+全ユーザーのプランをまとめて作る夜間バッチ（manage.py plan_all_users から使う）
+
+- 対象（有効でタスクのあるユーザー）を id 順に chunk_size 件ずつ読み、計画の入力をチャンクごとに数クエリで作る
+- 計画は ProcessPoolExecutor の子プロセス（batch_worker）で並列に行う。AIも使うときはプロセスごとに呼び出しの間隔を空ける
+- 書き込みはチャンクごとに1トランザクションの bulk で。差分の再計画なので、変わっていないタスクと手で直した提案は動かさない
+- 進み具合（PlanBatchRun.cursor）も同じトランザクションで進めるので、途中で落ちても続きから再開できる
+- サイトを止めずに流せるよう、待機/実行中の PlanJob があるユーザーと、読んでから書くまでに提案かタスクが変わったユーザーは飛ばす
+  （次の実行か、本人のボタンで作られる）
+"""
+from __future__ import annotations
+
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .batch_worker import init_worker, plan_user
+from .freebusy import overlapping_schedules_for_users
+from .models import PlanBatchRun, PlanJob, PlanSuggestion, PlanTask
+from .plan_service import (
+    plan_inputs, plan_window, suggestion_rows, suggestion_snapshot, suggestion_writes, task_snapshot,
+    write_suggestion_diff,
+)
+from .recurrence import load_occurrences_by_user
+from .signals import plan_bulk_changed
+
+DEFAULT_CHUNK_SIZE = 200
+# bulk_create / bulk_update の1文あたりの行数
+WRITE_BATCH_SIZE = 500
+
+
+def target_user_ids(after: int, limit: int, active_days=None) -> list:
+    """計画する対象（有効で、タスクがある）ユーザーの id を after より後から limit 件"""
+    qs = User.objects.filter(is_active=True, id__gt=after).filter(
+        Exists(PlanTask.objects.filter(user=OuterRef("pk")))
+    )
+    if active_days:
+        qs = qs.filter(last_login__gte=timezone.now() - timedelta(days=active_days))
+    return list(qs.order_by("id").values_list("id", flat=True)[:limit])
+
+
+def _by_user(rows) -> dict:
+    grouped = defaultdict(list)
+    for row in rows:
+        grouped[row.user_id].append(row)
+    return grouped
+
+
+def _busy_user_ids(user_ids) -> set:
+    return set(
+        PlanJob.objects.filter(user_id__in=user_ids, status__in=PlanJob.ACTIVE_STATUSES).values_list("user_id", flat=True)
+    )
+
+
+def load_chunk(user_ids) -> dict:
+    """
+    チャンクのユーザーの計画の入力（user_id → plan_inputs の結果）。クエリ数はユーザー数によらず一定。
+    実行中のジョブがあるユーザーは入れない
+    """
+    window = plan_window()
+    now = timezone.now()
+    busy = _busy_user_ids(user_ids)
+    ids = [u for u in user_ids if u not in busy]
+
+    tasks = _by_user(PlanTask.objects.filter(user_id__in=ids))
+    schedules = _by_user(overlapping_schedules_for_users(ids, *window))
+    suggestions = _by_user(PlanSuggestion.objects.filter(user_id__in=ids))
+    occurrences = load_occurrences_by_user(ids, *window)
+
+    prepared = {}
+    for user_id in ids:
+        if not tasks[user_id]:
+            continue
+        rows = suggestions[user_id]
+        prepared[user_id] = plan_inputs(
+            tasks[user_id],
+            schedules[user_id] + occurrences.get(user_id, []),
+            rows,
+            window,
+            now,
+        )
+        prepared[user_id]["snapshot"] = suggestion_snapshot(
+            (s.id, s.suggested_start, s.suggested_end, s.user_edited) for s in rows
+        )
+        # suggestion_rows がタスクに所要時間/優先度を書き込む前に取っておく
+        prepared[user_id]["task_snapshot"] = task_snapshot(tasks[user_id])
+    return prepared
+
+
+def save_chunk(run: PlanBatchRun, user_ids, prepared: dict, outcomes, elapsed: float) -> dict:
+    """チャンクの結果をまとめて書き、run の cursor/件数を同じトランザクションで進める"""
+    to_delete, to_update, to_create, changed_tasks = [], [], [], []
+    written_users = []
+
+    with transaction.atomic():
+        # 読んだあとにジョブが積まれた/提案やタスクが変わったユーザーは書かない
+        # （提案とタスクの行はコミットまでロックしておく。タスクは読んだときと同じ内容のときだけ書き戻すことになる）
+        busy = _busy_user_ids(list(prepared))
+        current = defaultdict(list)
+        rows = (
+            PlanSuggestion.objects.select_for_update()
+            .filter(user_id__in=list(prepared))
+            .values_list("user_id", "id", "suggested_start", "suggested_end", "user_edited")
+        )
+        for user_id, *row in rows:
+            current[user_id].append(row)
+        current_tasks = _by_user(
+            PlanTask.objects.select_for_update()
+            .filter(user_id__in=list(prepared))
+            .only("id", "user_id", "estimated_minutes", "priority", "deadline", "desired_at")
+        )
+
+        for outcome in outcomes:
+            user_id = outcome["user_id"]
+            inputs = prepared[user_id]
+            if (
+                user_id in busy
+                or suggestion_snapshot(current[user_id]) != inputs["snapshot"]
+                or task_snapshot(current_tasks[user_id]) != inputs["task_snapshot"]
+            ):
+                continue
+            new_suggestions, changed = suggestion_rows(user_id, inputs["tasks_by_id"], outcome["result"])
+            deletes, updates, creates = suggestion_writes(inputs, new_suggestions)
+            to_delete += deletes
+            to_update += updates
+            to_create += creates
+            changed_tasks += changed.values()
+            written_users.append(user_id)
+
+        write_suggestion_diff(
+            PlanSuggestion.objects.filter(id__in=to_delete) if to_delete else None,
+            to_update,
+            to_create,
+            changed_tasks,
+            batch_size=WRITE_BATCH_SIZE,
+        )
+
+        # 変わったタスクが無く計画しなかったユーザーも「済み」に数える
+        unchanged = sum(1 for inputs in prepared.values() if not inputs["tasks_by_id"])
+        skipped = len(user_ids) - len(written_users) - unchanged
+        run.cursor = user_ids[-1]
+        run.users_planned += len(written_users) + unchanged
+        run.users_skipped += skipped
+        run.suggestions_written += len(to_update) + len(to_create)
+        run.elapsed_seconds += elapsed
+        run.save(update_fields=["cursor", "users_planned", "users_skipped", "suggestions_written", "elapsed_seconds"])
+
+    for user_id in written_users:
+        plan_bulk_changed(user_id)
+
+    return {
+        "users": len(user_ids),
+        "written": len(written_users),
+        "unchanged": unchanged,
+        "skipped": skipped,
+        "ai": sum(1 for o in outcomes if o["used_ai"]),
+        "ai_errors": sum(1 for o in outcomes if o["ai_error"]),
+    }
+
+
+def current_run(restart: bool = False) -> PlanBatchRun:
+    """途中で終わった実行があればその続きから。restart なら最初から数え直す"""
+    if restart:
+        PlanBatchRun.objects.filter(finished_at__isnull=True).update(finished_at=timezone.now())
+    run = PlanBatchRun.objects.filter(finished_at__isnull=True).order_by("-id").first()
+    return run or PlanBatchRun.objects.create()
+
+
+def run_batch(
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    processes=None,
+    use_ai: bool = False,
+    ai_rate: float = 1.0,
+    active_days=None,
+    restart: bool = False,
+    on_chunk=None,
+) -> PlanBatchRun:
+    """
+    processes: 計画する子プロセス数（None なら CPU 数、0 ならこのプロセスで順に）
+    ai_rate: use_ai のとき、全プロセス合わせた AI の呼び出し回数/秒の上限
+    on_chunk(run, stats): チャンクを書き終えるたびに呼ばれる（進捗の表示用）
+    """
+    run = current_run(restart)
+    if processes is None:
+        # CPU が1つなら子プロセスに渡す手間の分だけ遅くなるので、このプロセスで順に
+        cpus = os.cpu_count() or 1
+        processes = cpus if cpus > 1 else 0
+    ai_interval = max(processes, 1) / ai_rate if use_ai and ai_rate > 0 else 0.0
+
+    pool = None
+    if processes > 0:
+        # 子プロセスは DB に触らないが、親の DB 接続を持ち越さないよう fork ではなく spawn で起動する
+        pool = ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(ai_interval,),
+        )
+    else:
+        init_worker(ai_interval)
+
+    try:
+        while True:
+            started = time.monotonic()
+            user_ids = target_user_ids(run.cursor, chunk_size, active_days)
+            if not user_ids:
+                break
+            prepared = load_chunk(user_ids)
+
+            work = [(u, p["ai_args"], p["now"], use_ai) for u, p in prepared.items() if p["tasks_by_id"]]
+            if pool is not None and work:
+                outcomes = list(pool.map(plan_user, *zip(*work), chunksize=max(1, len(work) // (processes * 4))))
+            else:
+                outcomes = [plan_user(*args) for args in work]
+
+            stats = save_chunk(run, user_ids, prepared, outcomes, time.monotonic() - started)
+            if on_chunk is not None:
+                on_chunk(run, stats)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    run.finished_at = timezone.now()
+    run.save(update_fields=["finished_at"])
+    return run
@@ -0,0 +1,60 @@
+"""
+plan_all_users の子プロセス側（ProcessPoolExecutor の中で動く）
+
+子プロセスは DB に触らない。入力（plan_service.plan_inputs の ai_args）も結果も素の dict / list で受け渡す。
+spawn で起動するので、このモジュールはモデルを import しない（Django の初期化は init_worker で行う）。
+"""
+from __future__ import annotations
+
+import time
+
+from .planner import LocalPlanner
+
+# AI を呼ぶ最短間隔（秒）。プロセスごとに持つので、全体の上限はプロセス数で割って渡す
+_ai_interval = 0.0
+_next_ai_call = 0.0
+
+
+def init_worker(ai_interval: float = 0.0) -> None:
+    global _ai_interval
+    _ai_interval = ai_interval
+
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+
+
+def _throttle() -> None:
+    global _next_ai_call
+    now = time.monotonic()
+    if _next_ai_call > now:
+        time.sleep(_next_ai_call - now)
+        now = _next_ai_call
+    _next_ai_call = now + _ai_interval
+
+
+def plan_user(user_id, ai_args, not_before, use_ai: bool = False) -> dict:
+    """
+    1ユーザー分を計画する。result はAIの結果（使えたとき）かローカル計画。
+    AIが失敗した/検証を通らなかったときはローカル計画のまま（ai_error に理由）
+    """
+    planner = LocalPlanner(*ai_args, not_before=not_before)
+    local_plan = planner.plan()
+    outcome = {"user_id": user_id, "result": local_plan, "used_ai": False, "ai_error": None}
+
+    if use_ai and local_plan:
+        from .ai_service import ai_plan_tasks
+
+        _throttle()
+        try:
+            result = ai_plan_tasks(*ai_args, draft=local_plan, cache_user_id=user_id)
+        except Exception as e:
+            outcome["ai_error"] = str(e)
+        else:
+            if isinstance(result, list) and planner.accepts(result):
+                outcome.update(result=result, used_ai=True)
+            else:
+                outcome["ai_error"] = "AIの提案が既存予定や作業可能時間と衝突しました"
+    return outcome
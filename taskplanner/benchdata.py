@@ -0,0 +1,98 @@
+"""
+ベンチマーク用のデータ生成（manage.py bench から使う）
+
+乱数は seed 固定なので、同じ引数なら毎回同じデータになる（コミット間で比較できる）。
+"""
+from __future__ import annotations
+
+import random
+from datetime import datetime, time, timedelta
+
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from .models import PlanSuggestion, PlanTask, Schedule, ScheduleSeries
+
+BENCH_PASSWORD = "bench-pass"
+
+TITLES = ("打ち合わせ", "レポート", "買い物", "通院", "ジム", "勉強会", "読書", "掃除", "面談", "移動")
+
+
+def seed_user(
+    username: str,
+    schedules: int = 1000,
+    tasks: int = 20,
+    suggestions: int = 20,
+    series: int = 3,
+    days: int = 180,
+    seed: int = 0,
+) -> User:
+    """
+    schedules 件の予定を今日を中心に ±days/2 日へ散らし、tasks 件のタスク、
+    そのうち suggestions 件の提案（今後2週間の夜）、series 件の繰り返し予定を持つユーザーを作る。
+    """
+    rng = random.Random(f"{seed}:{username}")
+    jst = timezone.get_current_timezone()
+    user = User.objects.create_user(username, f"{username}@example.com", BENCH_PASSWORD)
+    today = timezone.localdate()
+    first_day = today - timedelta(days=days // 2)
+
+    rows = []
+    for i in range(schedules):
+        day = first_day + timedelta(days=rng.randrange(days))
+        start = timezone.make_aware(datetime.combine(day, time(rng.randrange(7, 22), rng.choice((0, 15, 30, 45)))), jst)
+        s = Schedule(
+            user=user,
+            title=f"{rng.choice(TITLES)}{i}",
+            memo="メモ" * rng.randrange(0, 20),
+            date=start,
+            priority=rng.choice((1, 2, 2, 3)),
+            duration_minutes=rng.choice((15, 30, 60, 60, 90, 120)),
+        )
+        s.end_at = s.compute_end_at()
+        rows.append(s)
+    Schedule.objects.bulk_create(rows, batch_size=1000)
+
+    now = timezone.now()
+    task_rows = PlanTask.objects.bulk_create(
+        PlanTask(
+            user=user,
+            title=f"タスク{i}",
+            memo="詳細" * rng.randrange(0, 10),
+            estimated_minutes=rng.choice((None, 30, 45, 60, 90, 120)),
+            priority=rng.choice((1, 2, 3)),
+            deadline=now + timedelta(days=rng.randrange(1, 14)) if rng.random() < 0.6 else None,
+        )
+        for i in range(tasks)
+    )
+
+    # 提案は平日夜の 19:00 から1時間ずつ（互いには重ならない。既存予定とは重なることがある）
+    suggestion_rows = []
+    for n, task in enumerate(task_rows[:suggestions]):
+        day = today + timedelta(days=1 + n // 3)
+        start = timezone.make_aware(datetime.combine(day, time(19 + n % 3)), jst)
+        suggestion_rows.append(
+            PlanSuggestion(user=user, task=task, suggested_start=start, suggested_end=start + timedelta(hours=1), order=n + 1)
+        )
+    PlanSuggestion.objects.bulk_create(suggestion_rows)
+
+    ScheduleSeries.objects.bulk_create(
+        ScheduleSeries(
+            user=user,
+            title=f"定例{i}",
+            dtstart=timezone.make_aware(datetime.combine(first_day + timedelta(days=i), time(8, 30)), jst),
+            freq=ScheduleSeries.FREQ_WEEKLY,
+            byweekday=str(i % 5),
+            duration_minutes=30,
+        )
+        for i in range(series)
+    )
+    return user
+
+
+def percentile(sorted_values, pct) -> float:
+    """昇順に並んだ値の pct パーセンタイル（最近傍）"""
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
@@ -0,0 +1,49 @@
+"""
+ユーザー単位の「キャッシュ世代」（バージョン）管理
+
+キャッシュキーに世代を混ぜておき、データが変わったら世代を進めて古いキャッシュを一括で無効にする。
+世代はカウンタではなく時刻ベースの値にしているので、キャッシュから消えて作り直されても
+過去の世代と衝突しない（古いエントリが蘇らない）。
+"""
+import time
+
+from django.core.cache import cache
+
+
+def _version_key(user_id, namespace: str) -> str:
+    return f"ver:{namespace}:{user_id}"
+
+
+def user_version(user_id, namespace: str) -> str:
+    key = _version_key(user_id, namespace)
+    version = cache.get(key)
+    if version is None:
+        version = str(time.time_ns())
+        # 他のプロセスが先に作っていたらそちらを使う
+        if not cache.add(key, version, None):
+            version = cache.get(key) or version
+    return version
+
+
+def user_versions(user_id, namespaces) -> dict:
+    """複数の世代をまとめて取る（キャッシュへの問い合わせ1回。無いものだけ user_version で作る）"""
+    keys = {_version_key(user_id, ns): ns for ns in namespaces}
+    found = cache.get_many(list(keys))
+    return {ns: found.get(key) or user_version(user_id, ns) for key, ns in keys.items()}
+
+
+def bump_user_version(user_id, namespace: str) -> str:
+    version = str(time.time_ns())
+    cache.set(_version_key(user_id, namespace), version, None)
+    return version
+
+
+async def auser_version(user_id, namespace: str) -> str:
+    """user_version の async 版（ASGI のビューから使う）"""
+    key = _version_key(user_id, namespace)
+    version = await cache.aget(key)
+    if version is None:
+        version = str(time.time_ns())
+        if not await cache.aadd(key, version, None):
+            version = await cache.aget(key) or version
+    return version
@@ -0,0 +1,94 @@
+"""
+月表示用の「日ごとの混み具合」インデックス
+
+1か月分を1クエリで日ごとに集計（件数・優先度の内訳・予定の合計分）し、繰り返し予定の回を足して
+ユーザー×月でキャッシュする。Schedule/ScheduleSeries の保存/削除でユーザーの世代が進み無効になる。
+"""
+from datetime import datetime
+
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import ExtractDay
+from django.utils import timezone
+
+from .caching import user_version
+from .models import Schedule
+from .recurrence import occurrences_for
+
+CACHE_NAMESPACE = "calendar_month"
+CACHE_TTL = 60 * 60 * 24
+
+# 合計分 → ヒートマップの段階（0〜4）
+LOAD_LEVELS = (0, 60, 180, 360)
+
+
+def _load_level(minutes: int) -> int:
+    level = 0
+    for threshold in LOAD_LEVELS:
+        if minutes > threshold:
+            level += 1
+    return level
+
+
+def _month_range(year: int, month: int):
+    jst = timezone.get_current_timezone()
+    start = timezone.make_aware(datetime(year, month, 1), jst)
+    if month == 12:
+        end = timezone.make_aware(datetime(year + 1, 1, 1), jst)
+    else:
+        end = timezone.make_aware(datetime(year, month + 1, 1), jst)
+    return start, end
+
+
+def build_month_index(user_id, year: int, month: int) -> dict:
+    start, end = _month_range(year, month)
+    jst = timezone.get_current_timezone()
+
+    rows = (
+        Schedule.objects.filter(user_id=user_id, date__gte=start, date__lt=end)
+        .annotate(day=ExtractDay("date", tzinfo=jst))
+        .values("day")
+        .annotate(
+            count=Count("id"),
+            high=Count("id", filter=Q(priority=1)),
+            mid=Count("id", filter=Q(priority=2)),
+            low=Count("id", filter=Q(priority=3)),
+            minutes=Sum("duration_minutes"),
+        )
+        .order_by()
+    )
+
+    index = {}
+    for r in rows:
+        index[r["day"]] = {
+            "count": r["count"],
+            "high": r["high"],
+            "mid": r["mid"],
+            "low": r["low"],
+            "minutes": int(r["minutes"] or 0),
+        }
+
+    priority_keys = {1: "high", 2: "mid", 3: "low"}
+    for occ in occurrences_for(user_id, start, end, cached=False):
+        day = index.setdefault(
+            timezone.localtime(occ.date, jst).day,
+            {"count": 0, "high": 0, "mid": 0, "low": 0, "minutes": 0},
+        )
+        day["count"] += 1
+        if occ.priority in priority_keys:
+            day[priority_keys[occ.priority]] += 1
+        day["minutes"] += occ.duration_minutes
+
+    for day in index.values():
+        day["level"] = _load_level(day["minutes"])
+    return index
+
+
+def month_index(user_id, year: int, month: int) -> dict:
+    """{日: {"count", "high", "mid", "low", "minutes", "level"}}（予定の無い日は含まない）"""
+    key = f"monthidx:{user_id}:{user_version(user_id, CACHE_NAMESPACE)}:{year:04d}-{month:02d}"
+    index = cache.get(key)
+    if index is None:
+        index = build_month_index(user_id, year, month)
+        cache.set(key, index, CACHE_TTL)
+    return index
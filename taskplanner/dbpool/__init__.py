@@ -0,0 +1,7 @@
+"""
+MySQL + コネクションプールの DB バックエンド（ENGINE = "taskplanner.dbpool"）
+
+ASGI では DB 接続がリクエストごとになり CONN_MAX_AGE で使い回せないので、
+プロセス内のプールから借りて、リクエストの終わりに返す。設定は OPTIONS["pool"]:
+    {"size": 5, "max_overflow": 10, "recycle": 1800, "timeout": 10, "pre_ping": True}
+"""
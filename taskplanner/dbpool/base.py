@@ -0,0 +1,49 @@
+from django.db.backends.mysql import base as mysql_base
+from django.utils.asyncio import async_unsafe
+
+from .pool import ConnectionPool, PoolTimeout, get_pool
+
+Database = mysql_base.Database
+
+POOL_DEFAULTS = {"size": 5, "max_overflow": 10, "recycle": 1800, "timeout": 10.0, "pre_ping": True}
+
+
+class DatabaseWrapper(mysql_base.DatabaseWrapper):
+    """
+    接続を開く/閉じる代わりにプールから借りる/返す MySQL バックエンド。
+    CONN_MAX_AGE=0 と組み合わせて、リクエストの終わりに毎回プールへ返す。
+    """
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        params.pop("pool", None)
+        return params
+
+    def _pool(self) -> ConnectionPool:
+        def create():
+            conn_params = self.get_connection_params()
+            options = {**POOL_DEFAULTS, **(self.settings_dict["OPTIONS"].get("pool") or {})}
+
+            def connect():
+                connection = Database.connect(**conn_params)
+                # mysql_base.DatabaseWrapper.get_new_connection と同じ後処理
+                if connection.encoders.get(bytes) is bytes:
+                    connection.encoders.pop(bytes)
+                return connection
+
+            return ConnectionPool(connect, **options)
+
+        return get_pool(self.alias, create)
+
+    @async_unsafe
+    def get_new_connection(self, conn_params):
+        try:
+            return self._pool().checkout()
+        except PoolTimeout as e:
+            # wrap_database_errors で django.db.utils.OperationalError になる
+            raise Database.OperationalError(str(e)) from e
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self._pool().checkin(self.connection)
@@ -0,0 +1,205 @@
+"""
+DB に依存しないコネクションプール（dbpool.base から使う）
+
+- 常に持っておく接続は size 本まで。混んでいるときは size + max_overflow 本まで作り、返ってきた余りは閉じる
+- 上限まで貸し出し中なら timeout 秒まで空きを待つ（待った回数/秒数は stats() で見られる）
+- recycle 秒を超えた接続は貸さずに作り直す（サーバー側の wait_timeout 対策）
+- pre_ping なら貸す前に ping し、切れていたら作り直す
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def _ping(conn):
+    conn.ping()
+
+
+def _reset(conn):
+    # 途中のトランザクションを残したまま次の人に渡さない
+    conn.rollback()
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        connect: Callable,
+        size: int = 5,
+        max_overflow: int = 10,
+        recycle: float = 1800,
+        timeout: float = 10.0,
+        pre_ping: bool = True,
+        ping: Callable = _ping,
+        reset: Callable = _reset,
+        close: Callable = _close,
+    ):
+        self.connect = connect
+        self.size = max(0, size)
+        self.max_overflow = max(0, max_overflow)
+        self.recycle = recycle
+        self.timeout = timeout
+        self.pre_ping = pre_ping
+        self._ping = ping
+        self._reset = reset
+        self._close = close
+
+        self._idle = deque()  # (接続, 作った時刻)。新しく返ったものから貸す
+        self._born = {}  # 貸し出し中の id(接続) → 作った時刻
+        self._total = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            "created": 0,
+            "recycled": 0,
+            "discarded": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+        }
+
+    @property
+    def limit(self) -> int:
+        return self.size + self.max_overflow
+
+    def _expired(self, born: float) -> bool:
+        return bool(self.recycle) and time.monotonic() - born > self.recycle
+
+    def checkout(self):
+        started = time.monotonic()
+        waited = False
+        conn = born = None
+
+        with self._cond:
+            while True:
+                while self._idle:
+                    conn, born = self._idle.pop()
+                    if not self._expired(born):
+                        break
+                    self._discard(conn, "recycled")
+                    conn = None
+                if conn is not None:
+                    break
+                if self._total < self.limit:
+                    self._total += 1
+                    break
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self._record_wait(started)
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"DB接続の空き待ちが {self.timeout} 秒を超えました（上限 {self.limit} 本）")
+                waited = True
+                self._cond.wait(remaining)
+
+            if waited:
+                self._record_wait(started)
+
+        if conn is not None and self.pre_ping:
+            try:
+                self._ping(conn)
+            except Exception:
+                # 枠はそのまま使って作り直す
+                self._close(conn)
+                with self._cond:
+                    self._stats["discarded"] += 1
+                conn = None
+
+        if conn is None:
+            try:
+                conn = self.connect()
+            except Exception:
+                with self._cond:
+                    self._total -= 1
+                    self._cond.notify()
+                raise
+            born = time.monotonic()
+            with self._cond:
+                self._stats["created"] += 1
+
+        with self._cond:
+            self._born[id(conn)] = born
+        return conn
+
+    def checkin(self, conn) -> None:
+        with self._cond:
+            born = self._born.pop(id(conn), None)
+        if born is None:
+            # このプールから借りたものではない
+            self._close(conn)
+            return
+
+        try:
+            self._reset(conn)
+        except Exception:
+            with self._cond:
+                self._discard(conn, "discarded")
+                self._cond.notify()
+            return
+
+        with self._cond:
+            if len(self._idle) < self.size and not self._expired(born):
+                self._idle.append((conn, born))
+            else:
+                self._discard(conn, "recycled" if self._expired(born) else None)
+            self._cond.notify()
+
+    def _record_wait(self, started: float) -> None:
+        """ロックを持った状態で呼ぶ"""
+        self._stats["waits"] += 1
+        self._stats["wait_seconds"] += time.monotonic() - started
+
+    def _discard(self, conn, reason) -> None:
+        """ロックを持った状態で呼ぶ"""
+        self._close(conn)
+        self._total -= 1
+        if reason:
+            self._stats[reason] += 1
+
+    def close_all(self) -> None:
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn, None)
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            return {
+                "size": self.size,
+                "max_overflow": self.max_overflow,
+                "open": self._total,
+                "idle": len(self._idle),
+                "in_use": len(self._born),
+                **self._stats,
+            }
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias: str, factory: Callable[[], ConnectionPool]) -> ConnectionPool:
+    """DB エイリアスごとにプロセスで1つ"""
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None:
+            pool = _pools[alias] = factory()
+        return pool
+
+
+def pool_stats() -> Dict[str, Dict[str, float]]:
+    """{エイリアス: stats}（プールを使っていなければ空）"""
+    with _pools_lock:
+        pools = dict(_pools)
+    return {alias: pool.stats() for alias, pool in pools.items()}
@@ -1,8 +1,10 @@
 import itertools
 from django import forms
 from django.forms import HiddenInput
-from .models import Schedule, PlanTask, PlanSuggestion
+from .models import Schedule, ScheduleSeries, PlanTask, PlanSuggestion
+from .freebusy import conflict_message, find_conflicts
 from django.utils import timezone
+from datetime import datetime, timedelta
 from django.contrib.auth.models import User
 
 
@@ -83,7 +85,8 @@ def duration_minute_choices_no_undecided():
 
 # =========================
 # Schedule（予定入力）用：時間＋分（未定なし）
-# duration は CharField なので「合計分を文字」で保存
+# 合計分を Schedule.duration_minutes に保存する
+# （フォームの duration_minutes は「分」のプルダウンなのでモデルへは直接書かない）
 # =========================
 class ScheduleForm(forms.ModelForm):
     duration_hours = forms.ChoiceField(
@@ -102,9 +105,6 @@ class ScheduleForm(forms.ModelForm):
         initial="30",  # 好きな初期値に変えてOK
     )
 
-    # DB保存用（ユーザーには見せない）
-    duration = forms.CharField(required=False, widget=HiddenInput())
-
     class Meta:
         model = Schedule
         fields = [
@@ -112,9 +112,6 @@ class ScheduleForm(forms.ModelForm):
             "date",
             "priority",
             "memo",
-            "duration_hours",
-            "duration_minutes",
-            "duration",
         ]
         widgets = {
             "title": forms.TextInput(attrs={"class": "input-box"}),
@@ -141,25 +138,25 @@ class ScheduleForm(forms.ModelForm):
         if total <= 0:
             raise forms.ValidationError("所要時間は0分以外を選んでください。")
 
-        cleaned["duration"] = str(total)
+        # 既存の予定と重なっていないか（編集時は自分自身を除く）
+        start = cleaned.get("date")
+        if self.user is not None and start:
+            conflicts = find_conflicts(self.user, start, start + timedelta(minutes=total), exclude_id=self.instance.pk)
+            if conflicts:
+                raise forms.ValidationError(conflict_message(conflicts))
+
+        # _post_clean（モデル側の検証）より前にインスタンスへ入れておく
+        self.instance.duration_minutes = total
         return cleaned
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, user=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.user = user
 
-        # 編集時：保存済み duration（"75" など）から hours/minutes を復元
+        # 編集時：保存済みの duration_minutes から hours/minutes を復元
         inst = getattr(self, "instance", None)
-        if inst and getattr(inst, "duration", ""):
-            text = str(inst.duration)
-
-            # "2時間15分" のような形式が入っていたら復元できないので初期値にする
-            if ("時間" in text) or ("分" in text):
-                return
-
-            try:
-                total = int(text)
-            except ValueError:
-                return
+        if inst and inst.pk and inst.duration_minutes:
+            total = inst.duration_minutes
 
             hh = total // 60
             mm = total % 60
@@ -169,6 +166,119 @@ class ScheduleForm(forms.ModelForm):
             self.fields["duration_minutes"].initial = str(mm) if str(mm) in allowed else self.fields["duration_minutes"].initial
 
 
+# =========================
+# ScheduleSeries（繰り返し予定）用
+# 所要時間は ScheduleForm と同じく時間＋分のプルダウンから duration_minutes に入れる
+# =========================
+WEEKDAY_CHOICES = [
+    ("0", "月"), ("1", "火"), ("2", "水"), ("3", "木"), ("4", "金"), ("5", "土"), ("6", "日"),
+]
+
+
+class ScheduleSeriesForm(forms.ModelForm):
+    duration_hours = forms.ChoiceField(
+        choices=duration_hour_choices(),
+        label="時間",
+        widget=forms.Select(attrs={"class": "input-box"}),
+        initial="1",
+    )
+
+    duration_minutes = forms.ChoiceField(
+        choices=[("0", "0分")] + duration_minute_choices_no_undecided(),
+        label="分",
+        widget=forms.Select(attrs={"class": "input-box"}),
+        initial="0",
+    )
+
+    weekdays = forms.MultipleChoiceField(
+        choices=WEEKDAY_CHOICES,
+        required=False,
+        label="曜日（毎週のとき。未選択なら初回の曜日）",
+        widget=forms.CheckboxSelectMultiple,
+    )
+
+    exdates_text = forms.CharField(
+        required=False,
+        label="お休みの日（1行に1日 YYYY-MM-DD）",
+        widget=forms.Textarea(attrs={"class": "textarea-box", "rows": 3}),
+    )
+
+    class Meta:
+        model = ScheduleSeries
+        fields = ["title", "dtstart", "freq", "interval", "count", "until", "priority", "memo"]
+        labels = {
+            "title": "タイトル",
+            "dtstart": "初回の日時",
+            "freq": "繰り返し",
+            "interval": "間隔",
+            "count": "回数（空なら無制限）",
+            "until": "終了日時（空なら無期限）",
+            "priority": "優先度",
+            "memo": "メモ",
+        }
+        widgets = {
+            "title": forms.TextInput(attrs={"class": "input-box"}),
+            "dtstart": forms.DateTimeInput(
+                format="%Y-%m-%dT%H:%M",
+                attrs={"type": "datetime-local", "class": "input-box"},
+            ),
+            "until": forms.DateTimeInput(
+                format="%Y-%m-%dT%H:%M",
+                attrs={"type": "datetime-local", "class": "input-box"},
+            ),
+            "freq": forms.Select(attrs={"class": "input-box"}),
+            "interval": forms.NumberInput(attrs={"class": "input-box", "min": 1}),
+            "count": forms.NumberInput(attrs={"class": "input-box", "min": 1}),
+            "priority": forms.Select(attrs={"class": "input-box"}),
+            "memo": forms.Textarea(attrs={"class": "textarea-box"}),
+        }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        inst = getattr(self, "instance", None)
+        if inst and inst.pk:
+            self.fields["duration_hours"].initial = str(inst.duration_minutes // 60)
+            mm = str(inst.duration_minutes % 60)
+            allowed = {v for v, _ in self.fields["duration_minutes"].choices}
+            self.fields["duration_minutes"].initial = mm if mm in allowed else "0"
+            self.fields["weekdays"].initial = [str(d) for d in inst.weekdays()]
+            self.fields["exdates_text"].initial = "\n".join(inst.exdates or [])
+
+    def clean_exdates_text(self):
+        days = []
+        for line in (self.cleaned_data.get("exdates_text") or "").splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                days.append(datetime.strptime(line, "%Y-%m-%d").date().isoformat())
+            except ValueError:
+                raise forms.ValidationError(f"日付の形式が正しくありません: {line}")
+        return sorted(set(days))
+
+    def clean(self):
+        cleaned = super().clean()
+
+        try:
+            total = int(cleaned.get("duration_hours")) * 60 + int(cleaned.get("duration_minutes"))
+        except (TypeError, ValueError):
+            raise forms.ValidationError("所要時間を正しく選択してください。")
+        if total <= 0:
+            raise forms.ValidationError("所要時間は0分以外を選んでください。")
+
+        dtstart = cleaned.get("dtstart")
+        until = cleaned.get("until")
+        if dtstart and until and until < dtstart:
+            raise forms.ValidationError("終了日時は初回より後にしてください。")
+
+        # フォーム専用の項目をモデルの形に直してインスタンスへ（_post_clean の検証より前）
+        self.instance.duration_minutes = total
+        self.instance.byweekday = ",".join(cleaned.get("weekdays") or [])
+        self.instance.exdates = cleaned.get("exdates_text") or []
+        return cleaned
+
+
 # =========================
 # PlanTask（プラン設計：タスク追加）用：時間＋分（未定あり）
 # estimated_minutes は IntegerField なので int/None 保存
@@ -299,11 +409,31 @@ class PlanSuggestionForm(forms.ModelForm):
             "memo": forms.Textarea(attrs={"class": "textarea-box", "rows": 3}),
         }
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, user=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.user = user
+        if user is not None:
+            self.fields["task"].queryset = PlanTask.objects.filter(user=user)
 
         inst = getattr(self, "instance", None)
         if inst and getattr(inst, "suggested_start", None):
             self.initial["suggested_start"] = inst.suggested_start.strftime("%Y-%m-%dT%H:%M")
         if inst and getattr(inst, "suggested_end", None):
             self.initial["suggested_end"] = inst.suggested_end.strftime("%Y-%m-%dT%H:%M")
+
+    def clean(self):
+        cleaned = super().clean()
+
+        start = cleaned.get("suggested_start")
+        end = cleaned.get("suggested_end")
+        if not start or not end:
+            return cleaned
+
+        if end <= start:
+            raise forms.ValidationError("終了は開始より後にしてください。")
+
+        if self.user is not None:
+            conflicts = find_conflicts(self.user, start, end)
+            if conflicts:
+                raise forms.ValidationError(conflict_message(conflicts))
+        return cleaned
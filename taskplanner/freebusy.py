@@ -0,0 +1,128 @@
+"""
+予定（Schedule）の空き/埋まり計算
+
+- 期間と重なる予定を (user, date) インデックスの範囲で1クエリ取得し、繰り返し予定の回（recurrence）と合わせて
+  開始順に1回なめて busy 区間に結合する
+- 重なり判定は結合済み区間への二分探索なので、予定が何万件あっても1回の判定は O(log n)
+"""
+from __future__ import annotations
+
+from bisect import bisect_right
+from django.utils import timezone
+
+from .models import MAX_SCHEDULE_LENGTH, Schedule
+from .recurrence import aoccurrences_for, occurrences_for
+
+
+def overlapping_schedules(user, start, end, exclude_id=None):
+    """[start, end) と重なる予定（開始順）"""
+    qs = Schedule.objects.filter(
+        user=user,
+        date__gte=start - MAX_SCHEDULE_LENGTH,
+        date__lt=end,
+        end_at__gt=start,
+    ).order_by("date")
+    if exclude_id is not None:
+        qs = qs.exclude(pk=exclude_id)
+    return qs
+
+
+def overlapping_schedules_for_users(user_ids, start, end):
+    """overlapping_schedules の複数ユーザー版（plan_all_users がチャンク単位で1クエリで読む）"""
+    return Schedule.objects.filter(
+        user_id__in=user_ids,
+        date__gte=start - MAX_SCHEDULE_LENGTH,
+        date__lt=end,
+        end_at__gt=start,
+    ).order_by("date")
+
+
+def merge_intervals(intervals):
+    """開始順に並んだ (start, end) を1回なめて重なり/接する区間を結合する"""
+    merged = []
+    for s, e in intervals:
+        if e <= s:
+            continue
+        if merged and s <= merged[-1][1]:
+            if e > merged[-1][1]:
+                merged[-1][1] = e
+        else:
+            merged.append([s, e])
+    return [(s, e) for s, e in merged]
+
+
+class FreeBusy:
+    """ある期間の busy 区間（結合済み）と、その補集合の free 区間"""
+
+    def __init__(self, start, end, busy, events=()):
+        self.start = start
+        self.end = end
+        self.busy = [(max(s, start), min(e, end)) for s, e in busy if e > start and s < end]
+        self._starts = [s for s, _ in self.busy]
+        # 結合前の (開始, 終了, タイトル)（開始順）。どの予定と重なったかを報告するときに使う
+        self.events = list(events)
+        self._event_starts = [s for s, _, _ in self.events]
+
+    @classmethod
+    def for_user(cls, user, start, end, exclude_id=None):
+        rows = list(overlapping_schedules(user, start, end, exclude_id).values_list("date", "end_at", "title"))
+        return cls._build(start, end, rows, occurrences_for(user.pk, start, end))
+
+    @classmethod
+    async def afor_user(cls, user, start, end, exclude_id=None):
+        """for_user の async 版（async ORM で読む）"""
+        qs = overlapping_schedules(user, start, end, exclude_id).values_list("date", "end_at", "title")
+        rows = [r async for r in qs]
+        return cls._build(start, end, rows, await aoccurrences_for(user.pk, start, end))
+
+    @classmethod
+    def _build(cls, start, end, rows, occurrences):
+        if occurrences:
+            rows = sorted(rows + [(o.date, o.end_at, o.title) for o in occurrences], key=lambda r: r[0])
+        return cls(start, end, merge_intervals((s, e) for s, e, _ in rows), rows)
+
+    @property
+    def free(self):
+        out = []
+        cursor = self.start
+        for s, e in self.busy:
+            if s > cursor:
+                out.append((cursor, s))
+            cursor = max(cursor, e)
+        if cursor < self.end:
+            out.append((cursor, self.end))
+        return out
+
+    def conflicts(self, start, end) -> bool:
+        """[start, end) が busy のどれかと重なるか"""
+        i = bisect_right(self._starts, start) - 1
+        if i >= 0 and self.busy[i][1] > start:
+            return True
+        return i + 1 < len(self.busy) and self.busy[i + 1][0] < end
+
+    def overlapping_titles(self, start, end):
+        """[start, end) と重なる予定のタイトル（1件の長さは MAX_SCHEDULE_LENGTH まで）"""
+        hi = bisect_right(self._event_starts, end)
+        lo = bisect_right(self._event_starts, start - MAX_SCHEDULE_LENGTH)
+        return [title for s, e, title in self.events[lo:hi] if s < end and e > start]
+
+    def reserve(self, start, end) -> None:
+        """[start, end) を busy に足す（plan_apply で適用した分を後続の判定に反映する）"""
+        self.busy = merge_intervals(sorted(self.busy + [(start, end)]))
+        self._starts = [s for s, _ in self.busy]
+
+
+def find_conflicts(user, start, end, exclude_id=None, limit=3):
+    """フォームの検証用：重なっている予定（繰り返し予定の回を含む）を数件（エラーメッセージに出す）"""
+    conflicts = list(overlapping_schedules(user, start, end, exclude_id).only("id", "title", "date", "end_at")[:limit])
+    # 入力ごとに期間が違うので展開結果はキャッシュしない
+    conflicts += occurrences_for(user.pk, start, end, cached=False)
+    return conflicts[:limit]
+
+
+def conflict_message(conflicts) -> str:
+    names = "、".join(
+        f"「{c.title}」({timezone.localtime(c.date):%m/%d %H:%M}-{timezone.localtime(c.end_at):%H:%M})"
+        for c in conflicts
+    )
+    return f"{names} と時間が重なっています。"
@@ -0,0 +1,440 @@
+"""
+iCalendar (.ics) の書き出し / 取り込み
+
+- 書き出し：予定をチャンクごとに読みながら VEVENT を順に文字列で返す（全件をメモリに載せない）
+- 取り込み：ファイルを1行ずつ読み、VEVENT が1件そろうたびに Schedule にする。
+  保存は batch 件ごとの bulk_create で、取り込み済みの UID はスキップする
+"""
+from __future__ import annotations
+
+import hashlib
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import AsyncIterator, Dict, Iterable, Iterator, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import MAX_SCHEDULE_LENGTH, Schedule, ScheduleSeries
+from .signals import schedules_bulk_changed
+from .streaming import aiter_queryset
+
+PRODID = "-//myapp//taskplanner//JA"
+UID_DOMAIN = "taskplanner"
+EXPORT_CHUNK = 1000
+# uid__in の IN 句の長さも兼ねるので SQLite の変数上限(999)より小さく
+IMPORT_BATCH = 500
+DEFAULT_MINUTES = 60
+
+# 予定の優先度 ⇔ iCalendar の PRIORITY（1〜4 高 / 5 中 / 6〜9 低 / 0 未指定）
+ICS_PRIORITY = {1: 1, 2: 5, 3: 9}
+
+FREQ_RRULE = {
+    ScheduleSeries.FREQ_DAILY: "DAILY",
+    ScheduleSeries.FREQ_WEEKLY: "WEEKLY",
+    ScheduleSeries.FREQ_MONTHLY: "MONTHLY",
+}
+BYDAY = ["MO", "TU", "WE", "TH", "FR", "SA", "SU"]
+
+
+# ===== テキストのエスケープ / 行の折り返し =====
+def escape_text(value: str) -> str:
+    return (
+        (value or "")
+        .replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+
+_ESCAPED = re.compile(r"\\(.)")
+
+
+def unescape_text(value: str) -> str:
+    return _ESCAPED.sub(lambda m: "\n" if m.group(1) in "nN" else m.group(1), value)
+
+
+def fold(line: str) -> str:
+    """1行75オクテットまでで折り返す（UTF-8 の文字の途中では切らない）"""
+    if len(line.encode("utf-8")) <= 75:
+        return line + "\r\n"
+    parts, buf, size, limit = [], "", 0, 75
+    for ch in line:
+        n = len(ch.encode("utf-8"))
+        if size + n > limit:
+            parts.append(buf)
+            buf, size, limit = "", 0, 74  # 継続行は先頭の空白1文字ぶん短い
+        buf += ch
+        size += n
+    parts.append(buf)
+    return "\r\n ".join(parts) + "\r\n"
+
+
+# ===== 書き出し =====
+def _utc(dt: datetime) -> str:
+    return dt.astimezone(dt_timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def _local(dt: datetime) -> str:
+    return timezone.localtime(dt).strftime("%Y%m%dT%H%M%S")
+
+
+def _vevent(uid, when, title, memo, priority, stamp) -> str:
+    """when: DTSTART/DTEND（繰り返しなら RRULE/EXDATE も）の行"""
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{uid}",
+        f"DTSTAMP:{stamp}",
+        *when,
+        f"SUMMARY:{escape_text(title)}",
+    ]
+    if memo:
+        lines.append(f"DESCRIPTION:{escape_text(memo)}")
+    lines.append(f"PRIORITY:{ICS_PRIORITY.get(priority, 0)}")
+    lines.append("END:VEVENT")
+    return "".join(fold(line) for line in lines)
+
+
+def _series_lines(series: ScheduleSeries):
+    """繰り返しは曜日がずれないようにローカル時刻(TZID)で書く"""
+    tzid = timezone.get_current_timezone_name()
+    end = series.dtstart + timedelta(minutes=series.duration_minutes)
+    rule = [f"FREQ={FREQ_RRULE[series.freq]}"]
+    if series.interval and series.interval > 1:
+        rule.append(f"INTERVAL={series.interval}")
+    if series.freq == ScheduleSeries.FREQ_WEEKLY and series.weekdays():
+        rule.append("BYDAY=" + ",".join(BYDAY[d] for d in series.weekdays()))
+    if series.count:
+        rule.append(f"COUNT={series.count}")
+    if series.until:
+        rule.append(f"UNTIL={_utc(series.until)}")
+
+    lines = [
+        f"DTSTART;TZID={tzid}:{_local(series.dtstart)}",
+        f"DTEND;TZID={tzid}:{_local(end)}",
+        "RRULE:" + ";".join(rule),
+    ]
+    if series.exdates:
+        at = timezone.localtime(series.dtstart).strftime("T%H%M%S")
+        lines.append(f"EXDATE;TZID={tzid}:" + ",".join(d.replace("-", "") + at for d in series.exdates))
+    return lines
+
+
+def _export_header() -> str:
+    return "".join(fold(line) for line in [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        f"PRODID:{PRODID}",
+        "CALSCALE:GREGORIAN",
+    ])
+
+
+EXPORT_FOOTER = "END:VCALENDAR\r\n"
+
+
+def _export_querysets(user):
+    rows = (
+        Schedule.objects.filter(user=user)
+        .order_by("date", "id")
+        .values_list("id", "uid", "title", "memo", "date", "end_at", "priority")
+    )
+    return rows, ScheduleSeries.objects.filter(user=user).order_by("id")
+
+
+def _schedule_vevent(row, stamp) -> str:
+    pk, uid, title, memo, start, end, priority = row
+    when = [f"DTSTART:{_utc(start)}", f"DTEND:{_utc(end)}"]
+    return _vevent(uid or f"schedule-{pk}@{UID_DOMAIN}", when, title, memo, priority, stamp)
+
+
+def _series_vevent(series, stamp) -> str:
+    return _vevent(
+        f"series-{series.id}@{UID_DOMAIN}", _series_lines(series), series.title, series.memo, series.priority, stamp
+    )
+
+
+def export_ics(user, chunk_events: int = 200) -> Iterator[str]:
+    """ユーザーの予定と繰り返し予定を .ics として少しずつ返す（StreamingHttpResponse 用）"""
+    stamp = _utc(timezone.now())
+    yield _export_header()
+
+    rows, series_qs = _export_querysets(user)
+    buf = []
+    for row in rows.iterator(chunk_size=EXPORT_CHUNK):
+        buf.append(_schedule_vevent(row, stamp))
+        if len(buf) >= chunk_events:
+            yield "".join(buf)
+            buf = []
+    if buf:
+        yield "".join(buf)
+
+    for series in series_qs.iterator(chunk_size=EXPORT_CHUNK):
+        yield _series_vevent(series, stamp)
+
+    yield EXPORT_FOOTER
+
+
+async def aexport_ics(user, chunk_events: int = 200) -> AsyncIterator[str]:
+    """export_ics の async 版（ASGI 用。streaming.py を参照）"""
+    stamp = _utc(timezone.now())
+    yield _export_header()
+
+    rows, series_qs = _export_querysets(user)
+    buf = []
+    async for row in aiter_queryset(rows, EXPORT_CHUNK):
+        buf.append(_schedule_vevent(row, stamp))
+        if len(buf) >= chunk_events:
+            yield "".join(buf)
+            buf = []
+    if buf:
+        yield "".join(buf)
+
+    async for series in aiter_queryset(series_qs, EXPORT_CHUNK):
+        yield _series_vevent(series, stamp)
+
+    yield EXPORT_FOOTER
+
+
+# ===== 取り込み：行 → イベント =====
+def iter_lines(stream: Iterable) -> Iterator[str]:
+    """
+    折り返し（次の行の先頭が空白/タブ）を戻しながら論理行を返す。
+    UTF-8 の文字の途中で折り返されていても壊れないよう、バイト列のままつないでから decode する。
+    """
+    current = None
+    for raw in stream:
+        if isinstance(raw, str):
+            raw = raw.encode("utf-8")
+        raw = raw.rstrip(b"\r\n")
+        if raw[:1] in (b" ", b"\t"):
+            if current is not None:
+                current += raw[1:]
+            continue
+        if current is not None:
+            yield current.decode("utf-8", errors="replace")
+        current = raw
+    if current is not None:
+        yield current.decode("utf-8", errors="replace")
+
+
+def split_line(line: str):
+    """'NAME;PARAM=x:value' → ("NAME", {"PARAM": "x"}, "value")。読めなければ None"""
+    in_quote = False
+    for i, ch in enumerate(line):
+        if ch == '"':
+            in_quote = not in_quote
+        elif ch == ":" and not in_quote:
+            head, value = line[:i], line[i + 1:]
+            break
+    else:
+        return None
+
+    name, *items = head.split(";")
+    params = {}
+    for item in items:
+        key, _, val = item.partition("=")
+        params[key.upper()] = val.strip('"')
+    return name.upper(), params, value
+
+
+def iter_events(lines: Iterable[str]) -> Iterator[Dict[str, tuple]]:
+    """VEVENT ごとに {プロパティ名: (params, value)} を返す（VALARM などの中身は無視）"""
+    event = None
+    nested = 0
+    for line in lines:
+        parsed = split_line(line)
+        if parsed is None:
+            continue
+        name, params, value = parsed
+
+        if name == "BEGIN":
+            if value.upper() == "VEVENT":
+                event, nested = {}, 0
+            elif event is not None:
+                nested += 1
+            continue
+        if name == "END":
+            if value.upper() == "VEVENT" and event is not None:
+                yield event
+                event = None
+            elif event is not None and nested:
+                nested -= 1
+            continue
+
+        if event is not None and not nested and name not in event:
+            event[name] = (params, value)
+
+
+# ===== 取り込み：イベント → Schedule =====
+_DURATION = re.compile(r"^([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+
+
+def parse_duration(value: str) -> Optional[timedelta]:
+    m = _DURATION.match(value.strip())
+    if not m:
+        return None
+    sign, w, d, h, mi, s = m.groups()
+    delta = timedelta(weeks=int(w or 0), days=int(d or 0), hours=int(h or 0), minutes=int(mi or 0), seconds=int(s or 0))
+    return -delta if sign == "-" else delta
+
+
+def _basic_datetime(value: str) -> datetime:
+    """'YYYYMMDD' / 'YYYYMMDDTHHMMSS'（数万件を読むので strptime ではなく切り出しで）"""
+    if len(value) == 8:
+        return datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+    if len(value) != 15 or value[8] != "T":
+        raise ValueError(value)
+    return datetime(
+        int(value[0:4]), int(value[4:6]), int(value[6:8]),
+        int(value[9:11]), int(value[11:13]), int(value[13:15]),
+    )
+
+
+def parse_dt(value: str, params: dict, default_tz):
+    """(aware datetime, 終日か) を返す。読めなければ (None, False)"""
+    value = value.strip()
+    try:
+        if params.get("VALUE", "").upper() == "DATE" or len(value) == 8:
+            return timezone.make_aware(_basic_datetime(value[:8]), default_tz), True
+
+        if value.endswith("Z"):
+            return _basic_datetime(value[:-1]).replace(tzinfo=dt_timezone.utc), False
+
+        naive = _basic_datetime(value)
+    except ValueError:
+        return None, False
+
+    tz = default_tz
+    if params.get("TZID"):
+        try:
+            tz = ZoneInfo(params["TZID"])
+        except (ZoneInfoNotFoundError, ValueError):
+            pass  # Windows 形式のTZ名などはローカル時刻として扱う
+    return timezone.make_aware(naive, tz), False
+
+
+def _priority(value: str) -> int:
+    try:
+        p = int(value)
+    except (TypeError, ValueError):
+        return 2
+    if 1 <= p <= 4:
+        return 1
+    if p >= 6:
+        return 3
+    return 2
+
+
+def event_to_schedule(user, event: dict, default_tz) -> Optional[Schedule]:
+    if "DTSTART" not in event:
+        return None
+    if event.get("STATUS", ({}, ""))[1].upper() == "CANCELLED":
+        return None
+
+    start, all_day = parse_dt(event["DTSTART"][1], event["DTSTART"][0], default_tz)
+    if start is None:
+        return None
+
+    end = None
+    if "DTEND" in event:
+        end, _ = parse_dt(event["DTEND"][1], event["DTEND"][0], default_tz)
+    elif "DURATION" in event:
+        length = parse_duration(event["DURATION"][1])
+        end = start + length if length is not None else None
+    if end is None:
+        end = start + (timedelta(days=1) if all_day else timedelta(minutes=DEFAULT_MINUTES))
+
+    # 空き計算は「1件は最長1日」を前提にしているので、複数日にまたがる予定は1日分にそろえる
+    length = min(max(end - start, timedelta(0)), MAX_SCHEDULE_LENGTH)
+    minutes = int(length.total_seconds() // 60)
+
+    title = unescape_text(event.get("SUMMARY", ({}, ""))[1]).strip()[:100] or "(無題)"
+    memo = unescape_text(event.get("DESCRIPTION", ({}, ""))[1])
+
+    uid = event.get("UID", ({}, ""))[1].strip()
+    if not uid:
+        # UID が無いファイルでも再取り込みで重複しないよう、開始日時とタイトルから作る
+        uid = "nouid-" + hashlib.sha1(f"{start.isoformat()}|{title}".encode()).hexdigest()
+
+    schedule = Schedule(
+        user=user,
+        title=title,
+        memo=memo,
+        date=start,
+        duration_minutes=minutes,
+        priority=_priority(event.get("PRIORITY", ({}, ""))[1]),
+        uid=uid[:255],
+    )
+    schedule.end_at = schedule.compute_end_at()
+    return schedule
+
+
+# 書き出しで UID の無い予定/繰り返し予定に付けた UID（行には保存していない）
+OWN_UID_RE = re.compile(rf"^(schedule|series)-(\d+)@{re.escape(UID_DOMAIN)}$")
+
+
+def _own_uids(user, uids) -> set:
+    """uids のうち、このユーザーの予定/繰り返し予定を書き出したときの UID（取り込むと重複になる）"""
+    ids = {"schedule": set(), "series": set()}
+    for uid in uids:
+        m = OWN_UID_RE.match(uid)
+        if m:
+            ids[m.group(1)].add(int(m.group(2)))
+    found = set()
+    if ids["schedule"]:
+        found |= {
+            f"schedule-{pk}@{UID_DOMAIN}"
+            for pk in Schedule.objects.filter(user=user, id__in=ids["schedule"]).values_list("id", flat=True)
+        }
+    if ids["series"]:
+        found |= {
+            f"series-{pk}@{UID_DOMAIN}"
+            for pk in ScheduleSeries.objects.filter(user=user, id__in=ids["series"]).values_list("id", flat=True)
+        }
+    return found
+
+
+def _flush(user, batch, stats) -> None:
+    uids = {s.uid for s in batch}
+    existing = set(Schedule.objects.filter(user=user, uid__in=uids).values_list("uid", flat=True))
+    existing |= _own_uids(user, uids)
+    new = []
+    for s in batch:
+        if s.uid in existing:
+            stats["duplicates"] += 1
+            continue
+        existing.add(s.uid)
+        new.append(s)
+
+    with transaction.atomic():
+        Schedule.objects.bulk_create(new)
+    stats["created"] += len(new)
+
+
+def import_ics(user, stream: Iterable, batch_size: int = IMPORT_BATCH) -> Dict[str, int]:
+    """
+    stream は行（bytes/str）を返すもの（開いたファイル、UploadedFile など）。
+    メモリに載るのは常に batch_size 件ぶんだけ。
+    """
+    default_tz = timezone.get_current_timezone()
+    stats = {"created": 0, "duplicates": 0, "skipped": 0}
+
+    batch = []
+    for event in iter_events(iter_lines(stream)):
+        schedule = event_to_schedule(user, event, default_tz)
+        if schedule is None:
+            stats["skipped"] += 1
+            continue
+        batch.append(schedule)
+        if len(batch) >= batch_size:
+            _flush(user, batch, stats)
+            batch = []
+    if batch:
+        _flush(user, batch, stats)
+
+    if stats["created"]:
+        schedules_bulk_changed(user.id)
+    return stats
@@ -0,0 +1,223 @@
+"""
+プラン生成ジョブのキュー（DBテーブル PlanJob を使う）
+
+- Web側は enqueue_plan_job() でジョブを積むだけ（LLMを待たない）
+- manage.py run_plan_worker が claim_next_job() → run_job() で処理する
+- PLAN_JOBS_INLINE=true のときはその場で実行する（ローカル開発/テスト用。ASGI なら本番でも使える）
+"""
+import logging
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.db import close_old_connections, transaction
+from django.db.models import Exists, Q
+from django.utils import timezone
+
+from .models import PlanJob, PlanWorker
+from .plan_service import agenerate_plan, generate_plan
+
+logger = logging.getLogger(__name__)
+
+# これより長く running のままのジョブはワーカーが落ちたとみなす
+STALE_AFTER = timedelta(minutes=10)
+# これより長く queued のままのジョブは、動いているワーカーが1つも無ければ失敗にする（plan_ai 画面のポーリングを止める）。
+# ワーカーが動いていて混んでいるだけなら待たせる
+QUEUED_TIMEOUT = timedelta(minutes=5)
+# run_plan_worker はこの間隔（秒）で PlanWorker.last_seen を更新する。WORKER_DEAD_AFTER 更新が無ければ止まっているとみなす
+HEARTBEAT_INTERVAL = 15
+WORKER_DEAD_AFTER = timedelta(minutes=1)
+
+TIMEOUT_MESSAGE = "プラン生成が時間切れになりました。もう一度お試しください。"
+
+# 進捗（受信済み件数）をDBに書く最短間隔（秒）
+PROGRESS_INTERVAL = 0.5
+
+
+def record_heartbeat(name: str) -> None:
+    PlanWorker.objects.update_or_create(name=name, defaults={"last_seen": timezone.now()})
+
+
+def forget_dead_workers() -> int:
+    """再起動のたびに名前（pid）が変わるので、止まって1日経った記録は消す"""
+    return PlanWorker.objects.filter(last_seen__lt=timezone.now() - timedelta(days=1)).delete()[0]
+
+
+def _stale_jobs(now, include_queued: bool = True):
+    stale = Q(status=PlanJob.STATUS_RUNNING, started_at__lt=now - STALE_AFTER)
+    if include_queued:
+        alive = PlanWorker.objects.filter(last_seen__gte=now - WORKER_DEAD_AFTER)
+        stale |= Q(status=PlanJob.STATUS_QUEUED, created_at__lt=now - QUEUED_TIMEOUT) & ~Exists(alive)
+    return PlanJob.objects.filter(stale)
+
+
+def _timed_out(now) -> dict:
+    return {
+        "status": PlanJob.STATUS_FAILED,
+        "finished_at": now,
+        "result_messages": [[messages.ERROR, TIMEOUT_MESSAGE]],
+    }
+
+
+def expire_stale_jobs(include_queued: bool = True, **filters) -> int:
+    """
+    実行中のまま時間が経ちすぎたジョブと、ワーカーが動いていないのに待機中のままのジョブを失敗にする
+    （filters で対象を絞れる）。件数を返す
+    """
+    now = timezone.now()
+    return _stale_jobs(now, include_queued).filter(**filters).update(**_timed_out(now))
+
+
+async def aexpire_stale_jobs(**filters) -> int:
+    now = timezone.now()
+    return await _stale_jobs(now).filter(**filters).aupdate(**_timed_out(now))
+
+
+def _active_or_new_job(user, full: bool = False):
+    """
+    ユーザーごとに同時に1件だけ。既に待機/実行中のジョブがあればそれを返す。
+    戻り値: (ジョブ, その場で実行するか)。PLAN_JOBS_INLINE のときは待機中のジョブを同じトランザクションの中で
+    running にできた呼び出しだけがその場で実行する（二重クリックで2回生成しないように）
+    """
+    # ワーカーが止まっていて積まれたままのジョブを返し続けないように
+    expire_stale_jobs(user=user)
+    with transaction.atomic():
+        job = (
+            PlanJob.objects.select_for_update()
+            .filter(user=user, status__in=PlanJob.ACTIVE_STATUSES)
+            .order_by("-id")
+            .first()
+        )
+        if job is None:
+            job = PlanJob.objects.create(user=user, full=full)
+
+        inline = False
+        if getattr(settings, "PLAN_JOBS_INLINE", False) and job.status == PlanJob.STATUS_QUEUED:
+            now = timezone.now()
+            inline = bool(
+                PlanJob.objects.filter(pk=job.pk, status=PlanJob.STATUS_QUEUED)
+                .update(status=PlanJob.STATUS_RUNNING, started_at=now)
+            )
+            if inline:
+                job.status = PlanJob.STATUS_RUNNING
+                job.started_at = now
+    return job, inline
+
+
+def enqueue_plan_job(user, full: bool = False) -> PlanJob:
+    job, inline = _active_or_new_job(user, full)
+    if inline:
+        run_job(job)
+    return job
+
+
+async def aenqueue_plan_job(user, full: bool = False) -> PlanJob:
+    """
+    enqueue_plan_job の async 版（ASGI のビュー用）。
+    PLAN_JOBS_INLINE のときは agenerate_plan でその場で実行するが、Gemini の応答待ちでワーカーを塞がない。
+    """
+    # select_for_update はトランザクションが要るので async ORM ではなくスレッドで
+    job, inline = await sync_to_async(_active_or_new_job)(user, full)
+    if inline:
+        await arun_job(job, user)
+    return job
+
+
+def claim_next_job():
+    """待機中のジョブを1件取り出して running にする（複数ワーカーでも重複しない）"""
+    with transaction.atomic():
+        # 待機中のジョブは失敗にしない（ワーカー自身が動いているので、混んでいるだけ）
+        expire_stale_jobs(include_queued=False)
+
+        job = (
+            PlanJob.objects.select_for_update(skip_locked=True)
+            .filter(status=PlanJob.STATUS_QUEUED)
+            .order_by("id")
+            .first()
+        )
+        if job is None:
+            return None
+
+        job.status = PlanJob.STATUS_RUNNING
+        job.started_at = timezone.now()
+        job.save(update_fields=["status", "started_at"])
+    return job
+
+
+def _progress_recorder(job: PlanJob):
+    """ストリーミングで届いた件数を PlanJob.progress に書く（書き込みは PROGRESS_INTERVAL 秒に1回まで）"""
+    last = [0.0]
+
+    def record(item, count):
+        now = time.monotonic()
+        if now - last[0] < PROGRESS_INTERVAL:
+            return
+        last[0] = now
+        PlanJob.objects.filter(pk=job.pk).update(progress=count)
+
+    return record
+
+
+JOB_RESULT_FIELDS = ["status", "started_at", "finished_at", "created_count", "progress", "result_messages"]
+
+
+def _record_failure(job: PlanJob, e: Exception) -> None:
+    logger.exception("plan job %s failed", job.pk)
+    job.status = PlanJob.STATUS_FAILED
+    job.result_messages = [[messages.ERROR, f"プラン生成に失敗しました。（詳細: {e}）"]]
+    job.finished_at = timezone.now()
+
+
+def _record_outcome(job: PlanJob, outcome) -> None:
+    job.status = PlanJob.STATUS_DONE
+    job.created_count = outcome["created_count"]
+    job.progress = outcome["created_count"]
+    job.result_messages = [list(m) for m in outcome["messages"]]
+    job.finished_at = timezone.now()
+
+
+def run_job(job: PlanJob) -> PlanJob:
+    job.status = PlanJob.STATUS_RUNNING
+    job.started_at = job.started_at or timezone.now()
+
+    try:
+        outcome = generate_plan(job.user, on_item=_progress_recorder(job), full=job.full)
+    except Exception as e:
+        _record_failure(job, e)
+    else:
+        _record_outcome(job, outcome)
+
+    job.save(update_fields=JOB_RESULT_FIELDS)
+    return job
+
+
+async def arun_job(job: PlanJob, user) -> PlanJob:
+    """run_job の async 版（進捗の途中経過は書かない：ストリーミングはワーカー側だけ）"""
+    job.status = PlanJob.STATUS_RUNNING
+    job.started_at = job.started_at or timezone.now()
+
+    try:
+        outcome = await agenerate_plan(user, full=job.full)
+    except Exception as e:
+        _record_failure(job, e)
+    else:
+        _record_outcome(job, outcome)
+
+    await job.asave(update_fields=JOB_RESULT_FIELDS)
+    return job
+
+
+def run_pending_jobs(limit=None) -> int:
+    """キューが空になる（または limit 件処理する）まで実行する。処理した件数を返す"""
+    done = 0
+    while limit is None or done < limit:
+        close_old_connections()
+        job = claim_next_job()
+        if job is None:
+            break
+        run_job(job)
+        done += 1
+    close_old_connections()
+    return done
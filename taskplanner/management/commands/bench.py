@@ -0,0 +1,237 @@
+"""
+プラン生成/適用・カレンダー・一覧・ログインのベンチマーク
+
+    # SQLite（ローカル）で計測して基準値を保存
+    DB_ENGINE=sqlite python manage.py bench --sizes 100,1000,10000 --output bench-base.json
+    # 変更後に比較（クエリ数が増えた / p50 が tolerance 倍を超えたら終了コード 1）
+    DB_ENGINE=sqlite python manage.py bench --sizes 100,1000,10000 --compare bench-base.json
+
+    # MySQL（コンテナ）
+    docker run -d --name bench-mysql -e MYSQL_ROOT_PASSWORD=bench -p 3306:3306 mysql:8.0
+    DB_HOST=127.0.0.1 DB_USER=root DB_PASSWORD=bench DB_NAME=bench python manage.py bench --output bench-mysql.json
+
+既定ではテスト用DB（test_<NAME>）を作って使い、終わったら消す。データ投入も計測も全てトランザクション内で
+ロールバックするので、各回は同じデータに対して計測される。LLM は taskplanner.ai_fake（ネットワークに出ない）。
+"""
+import json
+import platform
+import statistics
+import subprocess
+import time
+import uuid
+
+import django
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from taskplanner import ai_cache, ai_service
+from taskplanner.benchdata import BENCH_PASSWORD, percentile, seed_user
+
+# seed_user のタイトルは「<語><連番>」。件数の多いユーザーでは数百〜千件程度に当たる
+SEARCH_QUERY = "勉強会12"
+
+BENCH_SETTINGS = {
+    "PLAN_JOBS_INLINE": True,
+    "PLAN_AI_POLISH": True,
+    "AI_STREAMING": False,
+    "AI_PLAN_CACHE": {"BACKEND": None},
+    "AI_CLIENT_FACTORY": "taskplanner.ai_fake.FakeGeminiClient",
+    "METRICS": {"ENABLED": False},
+}
+
+
+class Command(BaseCommand):
+    help = "データ量ごとに主要画面/処理の p50/p95 とクエリ数を測り、JSON に保存・比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="100,1000,10000", help="ユーザーあたりの予定件数（カンマ区切り）")
+        parser.add_argument("--tasks", type=int, default=20, help="ユーザーあたりのタスク数")
+        parser.add_argument("--suggestions", type=int, default=20, help="ユーザーあたりの提案数")
+        parser.add_argument("--repeat", type=int, default=20, help="1シナリオの計測回数")
+        parser.add_argument("--warmup", type=int, default=2, help="計測前に捨てる回数")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="結果の JSON を書き出すパス")
+        parser.add_argument("--compare", help="基準の JSON（--output で保存したもの）")
+        parser.add_argument("--tolerance", type=float, default=1.25, help="p50 がこの倍率を超えたら劣化とみなす")
+        parser.add_argument("--keepdb", action="store_true", help="テスト用DBを消さずに残す（次回の作成を省く）")
+        parser.add_argument(
+            "--in-place", action="store_true", help="テスト用DBを作らず今のDBで行う（全てロールバックされる）"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(s) for s in options["sizes"].split(",") if s.strip()]
+        except ValueError:
+            raise CommandError(f"--sizes が不正です: {options['sizes']}")
+
+        baseline = None
+        if options["compare"]:
+            try:
+                with open(options["compare"], encoding="utf-8") as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"基準の JSON を読めません: {e}")
+
+        # テスト用の Client が使えるように（ALLOWED_HOSTS に testserver など）。テスト中なら既に済んでいる
+        try:
+            setup_test_environment()
+            own_environment = True
+        except RuntimeError:
+            own_environment = False
+
+        old_name = None
+        if not options["in_place"]:
+            old_name = connection.settings_dict["NAME"]
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options["keepdb"], serialize=False)
+
+        try:
+            with override_settings(**BENCH_SETTINGS):
+                _clear_ai_state()
+                results = self._run(sizes, options)
+        finally:
+            _clear_ai_state()
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options["keepdb"])
+            if own_environment:
+                teardown_test_environment()
+
+        report = {"meta": _meta(sizes, options), "results": results}
+        self._print(results)
+
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(f"saved {options['output']}")
+
+        if baseline is not None:
+            regressions = compare(report, baseline, options["tolerance"])
+            if baseline.get("meta", {}).get("vendor") != report["meta"]["vendor"]:
+                self.stdout.write(self.style.WARNING("基準と DB の種類が違うので時間の比較は参考程度です"))
+            if regressions:
+                for line in regressions:
+                    self.stdout.write(self.style.ERROR(line))
+                raise CommandError(f"{len(regressions)} 件の劣化があります（基準: {options['compare']}）")
+            self.stdout.write(self.style.SUCCESS("基準からの劣化はありません"))
+
+    # ===== 計測 =====
+
+    def _run(self, sizes, options):
+        results = {}
+        # 投入したデータも最後に丸ごと捨てる
+        with transaction.atomic():
+            for size in sizes:
+                started = time.monotonic()
+                user = seed_user(
+                    f"bench{size}",
+                    schedules=size,
+                    tasks=options["tasks"],
+                    suggestions=min(options["suggestions"], options["tasks"]),
+                    seed=options["seed"],
+                )
+                self.stdout.write(f"seeded bench{size} ({time.monotonic() - started:.1f}s)")
+                results[str(size)] = {
+                    name: self._measure(name, run, setup, options["repeat"], options["warmup"])
+                    for name, run, setup in _scenarios(user)
+                }
+            transaction.set_rollback(True)
+        return results
+
+    def _measure(self, name, run, setup, repeat, warmup):
+        timings = []
+        queries = 0
+        for i in range(max(0, warmup) + max(1, repeat)):
+            if setup is not None:
+                setup()
+            with transaction.atomic():
+                with CaptureQueriesContext(connection) as ctx:
+                    started = time.perf_counter()
+                    response = run()
+                    elapsed = time.perf_counter() - started
+                transaction.set_rollback(True)
+            if response.status_code >= 400:
+                raise CommandError(f"{name}: status {response.status_code}")
+            if i >= warmup:
+                timings.append(elapsed * 1000)
+                queries = max(queries, len(ctx.captured_queries))
+
+        timings.sort()
+        return {
+            "p50_ms": round(percentile(timings, 50), 2),
+            "p95_ms": round(percentile(timings, 95), 2),
+            "mean_ms": round(statistics.fmean(timings), 2),
+            "queries": queries,
+            "n": len(timings),
+        }
+
+    def _print(self, results):
+        self.stdout.write(f"{'size':>7}  {'scenario':<15} {'p50 ms':>9} {'p95 ms':>9} {'queries':>8}")
+        for size, scenarios in results.items():
+            for name, r in scenarios.items():
+                self.stdout.write(f"{size:>7}  {name:<15} {r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['queries']:>8}")
+
+
+def _scenarios(user):
+    """(名前, 計測する処理, 計測前の準備)"""
+    client = Client()
+    client.force_login(user)
+    today = timezone.localdate()
+    calendar_url = f"{reverse('calendar')}?year={today.year}&month={today.month}&day={today.day}"
+    xhr = {"HTTP_X_REQUESTED_WITH": "XMLHttpRequest"}
+
+    return [
+        ("login", lambda: Client().post(reverse("login"), {"login_id": user.username, "password": BENCH_PASSWORD}), None),
+        ("calendar", lambda: client.get(calendar_url), cache.clear),
+        ("calendar_warm", lambda: client.get(calendar_url), None),
+        ("schedule_list", lambda: client.get(reverse("schedule_list")), None),
+        # 全文検索：関連度順（予定+タスク）と、一覧の絞り込み（日付順）
+        ("search", lambda: client.get(reverse("search"), {"q": SEARCH_QUERY}), None),
+        ("schedule_search", lambda: client.get(reverse("schedule_list"), {"q": SEARCH_QUERY}), None),
+        # 毎回同じ仕事量になるよう差分ではなく全部作り直す
+        ("plan_generate", lambda: client.post(reverse("plan_generate"), {"full": "1"}, **xhr), None),
+        ("plan_apply", lambda: client.post(reverse("plan_apply"), {"apply_token": uuid.uuid4().hex}, **xhr), None),
+    ]
+
+
+def _clear_ai_state():
+    ai_service._get_client.cache_clear()
+    ai_service._breakers.clear()
+    ai_cache.get_backend.cache_clear()
+
+
+def _meta(sizes, options):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    return {
+        "commit": commit,
+        "vendor": connection.vendor,
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "sizes": sizes,
+        "tasks": options["tasks"],
+        "repeat": options["repeat"],
+        "created_at": timezone.now().isoformat(),
+    }
+
+
+def compare(report, baseline, tolerance):
+    """劣化の一覧（クエリ数が増えた / p50 が tolerance 倍を超えて 1ms 以上遅くなった）"""
+    regressions = []
+    for size, scenarios in report["results"].items():
+        for name, r in scenarios.items():
+            b = baseline.get("results", {}).get(size, {}).get(name)
+            if not b:
+                continue
+            if r["queries"] > b["queries"]:
+                regressions.append(f"{size} {name}: queries {b['queries']} -> {r['queries']}")
+            if r["p50_ms"] > b["p50_ms"] * tolerance and r["p50_ms"] - b["p50_ms"] >= 1.0:
+                regressions.append(f"{size} {name}: p50 {b['p50_ms']}ms -> {r['p50_ms']}ms")
+    return regressions
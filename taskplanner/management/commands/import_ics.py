@@ -0,0 +1,33 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from taskplanner.ics import IMPORT_BATCH, import_ics
+
+
+class Command(BaseCommand):
+    help = ".ics ファイルの予定をユーザーの Schedule に取り込む（取り込み済みの UID はスキップ）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+        parser.add_argument("path")
+        parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH, help="1回の bulk_create の件数")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["username"])
+        except User.DoesNotExist:
+            raise CommandError(f"ユーザーが見つかりません: {options['username']}")
+
+        started = time.monotonic()
+        try:
+            with open(options["path"], "rb") as f:
+                stats = import_ics(user, f, batch_size=max(1, options["batch_size"]))
+        except OSError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(
+            f"created={stats['created']} duplicates={stats['duplicates']} skipped={stats['skipped']} "
+            f"({time.monotonic() - started:.1f}s)"
+        )
@@ -0,0 +1,116 @@
+import statistics
+from collections import Counter
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+from taskplanner.benchdata import percentile
+
+
+class Command(BaseCommand):
+    help = (
+        "起動中のサーバーに同時リクエストを投げて、スループットと応答時間（p50/p95）を測る。"
+        "SERVER_MODE=wsgi / asgi それぞれで起動して比較する"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+        parser.add_argument("--username", required=True)
+        parser.add_argument("--password", required=True)
+        parser.add_argument(
+            "--users",
+            type=int,
+            default=1,
+            help="2以上なら <username>0..N-1 でログインして順番に使う（プラン生成はユーザーごとに1件ずつなので）",
+        )
+        parser.add_argument(
+            "--path",
+            action="append",
+            dest="paths",
+            help="叩くパス（複数指定で順番に回す）。POST は 'POST /plan/generate/' のように書く",
+        )
+        parser.add_argument("--concurrency", type=int, default=20, help="同時に投げる数")
+        parser.add_argument("--requests", type=int, default=200, help="合計リクエスト数")
+        parser.add_argument("--basic-auth", default="", help="Basic 認証が有効なとき 'user:pass'")
+        parser.add_argument("--timeout", type=float, default=60.0)
+
+    def handle(self, *args, **options):
+        base = options["base_url"].rstrip("/")
+        targets = [self._parse_target(p) for p in (options["paths"] or ["GET /freebusy/"])]
+        timeout = options["timeout"]
+        auth = tuple(options["basic_auth"].split(":", 1)) if options["basic_auth"] else None
+
+        users = max(1, options["users"])
+        usernames = [options["username"]] if users == 1 else [f"{options['username']}{i}" for i in range(users)]
+        logins = [self._login(base, name, options["password"], auth, timeout) for name in usernames]
+
+        # スレッドごとに接続を持つ（requests.Session はスレッド間で共有しない）
+        local = threading.local()
+
+        def session():
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+                local.session.auth = auth
+            return local.session
+
+        def hit(n):
+            method, path = targets[n % len(targets)]
+            cookies = logins[n % len(logins)]
+            s = session()
+            started = time.monotonic()
+            try:
+                res = s.request(
+                    method,
+                    base + path,
+                    cookies=cookies,
+                    headers={"X-CSRFToken": cookies.get("csrftoken", ""), "X-Requested-With": "XMLHttpRequest"},
+                    allow_redirects=False,
+                    timeout=timeout,
+                )
+                status = res.status_code
+            except requests.RequestException:
+                status = "error"
+            return time.monotonic() - started, status
+
+        total = max(1, options["requests"])
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, options["concurrency"])) as pool:
+            results = list(pool.map(hit, range(total)))
+        elapsed = time.monotonic() - started
+
+        latencies = sorted(t for t, _ in results)
+        statuses = Counter(status for _, status in results)
+        errors = sum(n for status, n in statuses.items() if status == "error" or status >= 400)
+        self.stdout.write(
+            f"requests={total} errors={errors} concurrency={options['concurrency']} "
+            f"elapsed={elapsed:.2f}s rps={total / elapsed:.1f} "
+            f"p50={percentile(latencies, 50) * 1000:.0f}ms p95={percentile(latencies, 95) * 1000:.0f}ms "
+            f"max={latencies[-1] * 1000:.0f}ms mean={statistics.fmean(latencies) * 1000:.0f}ms "
+            f"status={dict(statuses)}"
+        )
+
+    def _parse_target(self, value):
+        method, _, path = value.strip().rpartition(" ")
+        return (method or "GET").upper(), path
+
+    def _login(self, base, username, password, auth, timeout):
+        s = requests.Session()
+        s.auth = auth
+        try:
+            s.get(base + "/", timeout=timeout)
+            res = s.post(
+                base + "/",
+                data={"login_id": username, "password": password},
+                headers={"X-CSRFToken": s.cookies.get("csrftoken", "")},
+                allow_redirects=False,
+                timeout=timeout,
+            )
+        except requests.RequestException as e:
+            raise CommandError(f"サーバーに接続できません: {e}")
+        if "sessionid" not in s.cookies:
+            raise CommandError(f"ログインできませんでした（status={res.status_code}）")
+        return s.cookies.get_dict()
+
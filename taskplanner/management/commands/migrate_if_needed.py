@@ -0,0 +1,30 @@
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from taskplanner.startup import disk_migrations, migration_state_hash, pending_migrations
+
+
+class Command(BaseCommand):
+    help = (
+        "未適用のマイグレーションがあるときだけ migrate する（コンテナ起動用）。"
+        "全部 django_migrations に記録済みなら、システムチェックや post_migrate ごと飛ばす"
+    )
+    # 起動を速くしたいのでチェックは migrate を流すときだけ
+    requires_system_checks = []
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        pending = pending_migrations()
+        state = migration_state_hash(disk_migrations())
+
+        if not pending:
+            self.stdout.write(
+                f"migrations up to date (state {state}), migrate skipped in {time.perf_counter() - started:.2f}s"
+            )
+            return
+
+        self.stdout.write(f"{len(pending)} pending migrations (state {state}): {', '.join(pending[:5])}")
+        call_command("migrate", interactive=False, skip_checks=False, verbosity=options["verbosity"], stdout=self.stdout)
+        self.stdout.write(f"migrate finished in {time.perf_counter() - started:.2f}s")
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+
+from taskplanner.batch import DEFAULT_CHUNK_SIZE, run_batch
+
+
+class Command(BaseCommand):
+    help = (
+        "有効な全ユーザーのプランをまとめて作る（夜間バッチ）。差分の再計画なので手で直した提案は動かさない。"
+        "途中で止まっても、もう一度流せば続きから再開する"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="1回に読み書きするユーザー数")
+        parser.add_argument(
+            "--processes", type=int, default=None, help="計画する子プロセス数（既定は CPU 数。0 ならこのプロセスで順に）"
+        )
+        parser.add_argument("--ai", action="store_true", help="ローカル計画をAIに仕上げてもらう（既定はローカル計画のみ）")
+        parser.add_argument("--ai-rate", type=float, default=1.0, help="--ai のときのAI呼び出しの上限（回/秒、全プロセス合計）")
+        parser.add_argument(
+            "--active-days", type=int, default=30, help="この日数以内にログインしたユーザーだけ（0 なら全員）"
+        )
+        parser.add_argument("--restart", action="store_true", help="途中で終わった実行の続きではなく最初からやり直す")
+
+    def handle(self, *args, **options):
+        def report(run, stats):
+            self.stdout.write(
+                f"users<={run.cursor}: {stats['users']} users "
+                f"(written {stats['written']}, unchanged {stats['unchanged']}, skipped {stats['skipped']}"
+                + (f", ai {stats['ai']}, ai errors {stats['ai_errors']}" if options["ai"] else "")
+                + f") {run.users_per_second:.1f} users/s"
+            )
+
+        run = run_batch(
+            chunk_size=max(1, options["chunk_size"]),
+            processes=options["processes"],
+            use_ai=options["ai"],
+            ai_rate=options["ai_rate"],
+            active_days=options["active_days"] or None,
+            restart=options["restart"],
+            on_chunk=report,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"planned {run.users_planned} users, skipped {run.users_skipped}, "
+            f"{run.suggestions_written} suggestions written in {run.elapsed_seconds:.1f}s "
+            f"({run.users_per_second:.1f} users/s)"
+        ))
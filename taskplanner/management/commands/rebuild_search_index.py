@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from taskplanner.search import install_index
+
+
+class Command(BaseCommand):
+    help = "全文検索の索引を（無ければ作って）今のデータから作り直す。SQLite でテーブルを作り直すマイグレーションの後に流す"
+
+    def handle(self, *args, **options):
+        if install_index():
+            self.stdout.write(self.style.SUCCESS("search index rebuilt"))
+        else:
+            self.stdout.write(self.style.WARNING("この DB では全文検索の索引を使いません（LIKE で検索します）"))
@@ -0,0 +1,48 @@
+import os
+import socket
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from taskplanner.jobs import HEARTBEAT_INTERVAL, forget_dead_workers, record_heartbeat, run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = "PlanJob キューを処理するワーカー（プラン生成をWebリクエストの外で実行する）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=2, help="同時に処理するジョブ数（スレッド数）")
+        parser.add_argument("--poll", type=float, default=1.0, help="キューが空のときの待ち秒数")
+        parser.add_argument("--once", action="store_true", help="キューを空にしたら終了する")
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options["concurrency"])
+        poll = options["poll"]
+        once = options["once"]
+
+        def loop():
+            while True:
+                if run_pending_jobs() == 0:
+                    if once:
+                        return
+                    time.sleep(poll)
+
+        # 生存確認はメインスレッドで（待機中のジョブは、動いているワーカーが無いときだけ時間切れにされる）
+        name = f"{socket.gethostname()}:{os.getpid()}"[:100]
+        forget_dead_workers()
+        record_heartbeat(name)
+
+        self.stdout.write(f"plan worker started (concurrency={concurrency})")
+        threads = [threading.Thread(target=loop, daemon=True) for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        try:
+            while any(t.is_alive() for t in threads):
+                for t in threads:
+                    t.join(HEARTBEAT_INTERVAL / len(threads))
+                record_heartbeat(name)
+                close_old_connections()
+        except KeyboardInterrupt:
+            pass
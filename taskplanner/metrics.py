@@ -0,0 +1,263 @@
+"""
+リクエストごとの計測（クエリ数・DB時間・AI呼び出し時間）と Prometheus 形式の集計
+
+- 計測中のリクエストは contextvar に持つので、ASGI で sync_to_async のスレッドに移っても同じ記録に足される
+- DB は connection.execute_wrappers、AI は ai_service の各モデル呼び出しから記録する
+- ヒストグラムはプロセス内の集計（gunicorn のワーカーごと）。系列が混ざらないように worker ラベルに pid を付ける
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+import traceback
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connections
+
+DEFAULTS = {
+    "ENABLED": False,
+    "SAMPLE_RATE": 1.0,
+    "SLOW_REQUEST_MS": 1000,
+    "CAPTURE_STACKS": False,
+    "SLOW_QUERY_MS": 100,
+    "TOKEN": "",
+}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+AI_BUCKETS = (0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+
+def config() -> dict:
+    return {**DEFAULTS, **(getattr(settings, "METRICS", None) or {})}
+
+
+# ===== リクエスト単位の記録 =====
+
+class RequestMetrics:
+    __slots__ = ("queries", "db_seconds", "ai", "slow_queries", "slow_query_seconds")
+
+    def __init__(self, slow_query_seconds: Optional[float] = None):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.ai: List[Tuple[str, float, str]] = []  # (モデル, 秒, ok/error/abandoned)
+        self.slow_queries: List[dict] = []
+        # None ならスタックは取らない
+        self.slow_query_seconds = slow_query_seconds
+
+    @property
+    def ai_seconds(self) -> float:
+        return sum(seconds for _, seconds, _ in self.ai)
+
+
+_current: ContextVar[Optional[RequestMetrics]] = ContextVar("taskplanner_request_metrics", default=None)
+
+
+def begin(rm: RequestMetrics):
+    _attach_db_wrapper()
+    return _current.set(rm)
+
+
+def end(token) -> None:
+    _current.reset(token)
+
+
+def current() -> Optional[RequestMetrics]:
+    return _current.get()
+
+
+def _execute(execute, sql, params, many, context):
+    rm = _current.get()
+    if rm is None:
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        rm.queries += 1
+        rm.db_seconds += elapsed
+        if rm.slow_query_seconds is not None and elapsed >= rm.slow_query_seconds:
+            rm.slow_queries.append({
+                "ms": round(elapsed * 1000, 1),
+                "sql": sql[:300],
+                # この関数と execute の呼び出し部分は除く
+                "stack": [line.strip() for line in traceback.format_stack(limit=14)[:-3]],
+            })
+
+
+def _attach_db_wrapper() -> None:
+    # 接続オブジェクトはスレッド/リクエストごとに作られるので、計測の開始時に付いているか確認する
+    for conn in connections.all():
+        if _execute not in conn.execute_wrappers:
+            conn.execute_wrappers.append(_execute)
+
+
+def record_ai_attempt(model: str, seconds: float, outcome: str) -> None:
+    """ai_service のモデル呼び出し1回分（リクエスト外＝ワーカーでもヒストグラムには入る）"""
+    if not config()["ENABLED"]:
+        return
+    AI_ATTEMPT_SECONDS.observe((model, outcome), seconds)
+    rm = _current.get()
+    if rm is not None:
+        rm.ai.append((model, seconds, outcome))
+
+
+# ===== Prometheus 形式の集計 =====
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{_escape(v)}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames) + ("worker",)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple, amount: float = 1.0) -> None:
+        key = tuple(labels) + (os.getpid(),)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, key)} {value:g}" for key, value in items]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames) + ("worker",)
+        self.buckets = tuple(buckets)
+        # ラベル → [バケットごとの件数..., +Inf の件数, 合計]
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float) -> None:
+        key = tuple(labels) + (os.getpid(),)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[i] += 1
+            row[-1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        lines = []
+        for key, row in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), row[:-1]):
+                cumulative += n
+                le = bound if bound == "+Inf" else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {row[-1]:g}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+REQUESTS = Counter("taskplanner_requests_total", "リクエスト数", ("view", "method", "status"))
+REQUEST_SECONDS = Histogram(
+    "taskplanner_request_duration_seconds", "レスポンスを返すまでの時間", ("view", "method")
+)
+REQUEST_QUERIES = Histogram(
+    "taskplanner_request_queries", "1リクエストのクエリ数（サンプルしたもの）", ("view",), QUERY_BUCKETS
+)
+REQUEST_DB_SECONDS = Histogram(
+    "taskplanner_request_db_seconds", "1リクエストのDB時間（サンプルしたもの）", ("view",)
+)
+AI_ATTEMPT_SECONDS = Histogram(
+    "taskplanner_ai_attempt_duration_seconds", "Gemini 1モデル分の呼び出し時間", ("model", "outcome"), AI_BUCKETS
+)
+
+REGISTRY = [REQUESTS, REQUEST_SECONDS, REQUEST_QUERIES, REQUEST_DB_SECONDS, AI_ATTEMPT_SECONDS]
+
+
+def _pool_lines() -> List[str]:
+    from .dbpool.pool import pool_stats
+
+    stats = pool_stats()
+    if not stats:
+        return []
+    pid = os.getpid()
+    lines = [
+        "# HELP taskplanner_db_pool_connections DB コネクションプールの接続数",
+        "# TYPE taskplanner_db_pool_connections gauge",
+    ]
+    for alias, s in sorted(stats.items()):
+        for state in ("open", "idle", "in_use"):
+            lines.append(
+                f'taskplanner_db_pool_connections{{alias="{alias}",state="{state}",worker="{pid}"}} {s[state]}'
+            )
+    for key, help_text in (
+        ("waits", "空きを待った回数"),
+        ("wait_seconds", "空きを待った秒数"),
+        ("timeouts", "待ちきれずに失敗した回数"),
+    ):
+        name = f"taskplanner_db_pool_{key}_total"
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        lines += [f'{name}{{alias="{alias}",worker="{pid}"}} {s[key]:g}' for alias, s in sorted(stats.items())]
+    return lines
+
+
+def _startup_lines() -> List[str]:
+    from .startup import startup_timings
+
+    timings = startup_timings()
+    if not timings:
+        return []
+    pid = os.getpid()
+    return [
+        "# HELP taskplanner_startup_seconds 起動の段階ごとの秒数（master で測った分はワーカーに引き継がれる）",
+        "# TYPE taskplanner_startup_seconds gauge",
+    ] + [
+        f'taskplanner_startup_seconds{{phase="{name}",worker="{pid}"}} {seconds:g}'
+        for name, seconds in timings.items()
+    ]
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    lines.extend(_pool_lines())
+    lines.extend(_startup_lines())
+    return "\n".join(lines) + "\n"
+
+
+def reset() -> None:
+    """テスト用"""
+    for metric in REGISTRY:
+        metric.clear()
@@ -0,0 +1,137 @@
+"""
+計測ミドルウェア（settings.METRICS["ENABLED"] のときだけ有効。無効なら MIDDLEWARE から外れて何もしない）
+
+- 全リクエスト：ビューごとの件数と所要時間のヒストグラム
+- SAMPLE_RATE の割合のリクエスト：クエリ数/DB時間/AI呼び出し時間を数え、Server-Timing ヘッダと
+  JSON 1行のログ（logger "taskplanner.metrics"）を出す。SLOW_REQUEST_MS を超えたものはサンプル外でもログに出す
+- CAPTURE_STACKS のときだけ、SLOW_QUERY_MS を超えたクエリの呼び出し元スタックをログに含める
+"""
+import json
+import logging
+import random
+import time
+
+from functools import partial
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.functional import SimpleLazyObject
+
+from . import metrics
+from .sessions import aget_user, get_user
+
+logger = logging.getLogger("taskplanner.metrics")
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        conf = metrics.config()
+        if not conf["ENABLED"]:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = float(conf["SAMPLE_RATE"])
+        self.slow_request = conf["SLOW_REQUEST_MS"] / 1000
+        self.slow_query = conf["SLOW_QUERY_MS"] / 1000 if conf["CAPTURE_STACKS"] else None
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        rm, token, started = self._begin()
+        try:
+            response = self.get_response(request)
+        finally:
+            if token is not None:
+                metrics.end(token)
+        return self._finish(request, response, rm, started)
+
+    async def __acall__(self, request):
+        rm, token, started = self._begin()
+        try:
+            response = await self.get_response(request)
+        finally:
+            if token is not None:
+                metrics.end(token)
+        return self._finish(request, response, rm, started)
+
+    def _begin(self):
+        started = time.perf_counter()
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None, None, started
+        rm = metrics.RequestMetrics(self.slow_query)
+        return rm, metrics.begin(rm), started
+
+    def _finish(self, request, response, rm, started):
+        elapsed = time.perf_counter() - started
+        match = getattr(request, "resolver_match", None)
+        view = (match.view_name if match else "") or "unmatched"
+
+        metrics.REQUESTS.inc((view, request.method, response.status_code))
+        metrics.REQUEST_SECONDS.observe((view, request.method), elapsed)
+
+        if rm is not None:
+            metrics.REQUEST_QUERIES.observe((view,), rm.queries)
+            metrics.REQUEST_DB_SECONDS.observe((view,), rm.db_seconds)
+            response["Server-Timing"] = _server_timing(rm, elapsed)
+
+        if rm is not None or elapsed >= self.slow_request:
+            logger.info(json.dumps(_log_record(request, response, view, rm, elapsed), ensure_ascii=False))
+        return response
+
+
+def _server_timing(rm, elapsed) -> str:
+    parts = [f'db;dur={rm.db_seconds * 1000:.1f};desc="{rm.queries} queries"']
+    if rm.ai:
+        parts.append(f'ai;dur={rm.ai_seconds * 1000:.1f};desc="{len(rm.ai)} attempts"')
+    parts.append(f"total;dur={elapsed * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def _log_record(request, response, view, rm, elapsed) -> dict:
+    record = {
+        "view": view,
+        "method": request.method,
+        "path": request.path,
+        "status": response.status_code,
+        "ms": round(elapsed * 1000, 1),
+        "sampled": rm is not None,
+    }
+    if rm is not None:
+        record["queries"] = rm.queries
+        record["db_ms"] = round(rm.db_seconds * 1000, 1)
+        if rm.ai:
+            record["ai"] = [
+                {"model": model, "ms": round(seconds * 1000, 1), "outcome": outcome}
+                for model, seconds, outcome in rm.ai
+            ]
+        if rm.slow_queries:
+            record["slow_queries"] = rm.slow_queries
+    return record
+
+
+# ===== ログインユーザー =====
+
+def _get_user(request):
+    if not hasattr(request, "_cached_user"):
+        request._cached_user = get_user(request)
+    return request._cached_user
+
+
+async def _auser(request):
+    if not hasattr(request, "_acached_user"):
+        request._acached_user = await aget_user(request)
+    return request._acached_user
+
+
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+    """AuthenticationMiddleware と同じだが、request.user / auser() は sessions.get_user でキャッシュから引く"""
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: _get_user(request))
+        request.auser = partial(_auser, request)
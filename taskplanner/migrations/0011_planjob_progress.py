@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-18 19:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskplanner', '0010_planjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='planjob',
+            name='progress',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.10 on 2026-10-18 19:13
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskplanner', '0011_planjob_progress'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='plansuggestion',
+            index=models.Index(fields=['user', 'order'], name='plansugg_user_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='plantask',
+            index=models.Index(fields=['user', '-created_at'], name='plantask_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['user', 'date'], name='schedule_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['user', 'title'], name='schedule_user_title_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    型付きの所要時間(分)と終了日時を追加する。
+    旧カラム(duration/start_time/end_time)からの移行は 0014、旧カラムの削除は 0015。
+    """
+
+    dependencies = [
+        ('taskplanner', '0012_hot_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedule',
+            name='duration_minutes',
+            field=models.PositiveIntegerField(default=60),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='end_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,86 @@
+"""
+Schedule.duration（"90" / "1時間30分" / ゴミ）と end_time を duration_minutes / end_at に移す。
+
+- 1000件ずつ別トランザクションで更新する（大きなテーブルでもロックを長く持たない）
+- end_at が NULL の行だけを対象にするので、途中で落ちても再実行すれば続きから進む
+"""
+import re
+from datetime import datetime, timedelta
+
+from django.db import migrations, transaction
+from django.utils import timezone
+
+BATCH_SIZE = 1000
+DEFAULT_MINUTES = 60
+
+_HOURS = re.compile(r"(\d+)\s*時間")
+_MINUTES = re.compile(r"(\d+)\s*分")
+
+
+def parse_legacy_duration(text):
+    """旧 duration 文字列 → 分。読めなければ None"""
+    text = (text or "").strip()
+    if not text:
+        return None
+    if text.isdigit():
+        return int(text)
+    h = _HOURS.search(text)
+    m = _MINUTES.search(text)
+    if not h and not m:
+        return None
+    return (int(h.group(1)) * 60 if h else 0) + (int(m.group(1)) if m else 0)
+
+
+def legacy_minutes(schedule, tz):
+    """
+    カレンダー上の位置を変えないよう end_time を最優先（旧 plan_generate と同じ扱い）。
+    無ければ duration の文字列、それも読めなければ60分。
+    """
+    if schedule.end_time:
+        start = schedule.date.astimezone(tz)
+        end = timezone.make_aware(datetime.combine(start.date(), schedule.end_time), tz)
+        if end <= start:
+            end += timedelta(days=1)
+        return int((end - start).total_seconds() // 60)
+
+    minutes = parse_legacy_duration(schedule.duration)
+    if minutes is None:
+        return DEFAULT_MINUTES
+    return minutes
+
+
+def backfill(apps, schema_editor):
+    Schedule = apps.get_model("taskplanner", "Schedule")
+    db = schema_editor.connection.alias
+    tz = timezone.get_current_timezone()
+
+    last_id = 0
+    while True:
+        batch = list(
+            Schedule.objects.using(db)
+            .filter(end_at__isnull=True, id__gt=last_id)
+            .order_by("id")
+            .only("id", "date", "duration", "end_time")[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+
+        for s in batch:
+            s.duration_minutes = legacy_minutes(s, tz)
+            s.end_at = s.date + timedelta(minutes=s.duration_minutes)
+
+        with transaction.atomic(using=db):
+            Schedule.objects.using(db).bulk_update(batch, ["duration_minutes", "end_at"])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('taskplanner', '0013_schedule_duration_minutes_end_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskplanner', '0014_backfill_schedule_duration'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='schedule',
+            name='duration',
+        ),
+        migrations.RemoveField(
+            model_name='schedule',
+            name='end_time',
+        ),
+        migrations.RemoveField(
+            model_name='schedule',
+            name='start_time',
+        ),
+        migrations.AlterField(
+            model_name='schedule',
+            name='end_at',
+            field=models.DateTimeField(),
+        ),
+    ]
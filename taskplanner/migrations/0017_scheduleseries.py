@@ -0,0 +1,38 @@
+# Generated by Django 5.2.10 on 2026-10-18 19:22
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskplanner', '0016_planapplication'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduleSeries',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=100)),
+                ('memo', models.TextField(blank=True)),
+                ('priority', models.IntegerField(choices=[(1, '高'), (2, '中'), (3, '低')], default=2)),
+                ('duration_minutes', models.PositiveIntegerField(default=60)),
+                ('dtstart', models.DateTimeField()),
+                ('freq', models.CharField(choices=[('daily', '毎日'), ('weekly', '毎週'), ('monthly', '毎月')], default='weekly', max_length=10)),
+                ('interval', models.PositiveSmallIntegerField(default=1)),
+                ('byweekday', models.CharField(blank=True, max_length=20)),
+                ('count', models.PositiveIntegerField(blank=True, null=True)),
+                ('until', models.DateTimeField(blank=True, null=True)),
+                ('exdates', models.JSONField(blank=True, default=list)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'dtstart'], name='series_user_dtstart_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+"""
+予定/タスクの全文検索の索引（taskplanner.search）
+
+MySQL は FULLTEXT INDEX ... WITH PARSER ngram、SQLite は FTS5 trigram の表とトリガー。
+どちらでもない DB では何もしない（検索は LIKE になる）。
+"""
+from django.db import migrations
+
+
+def install(apps, schema_editor):
+    from taskplanner.search import install_index
+
+    install_index(schema_editor.connection)
+
+
+def uninstall(apps, schema_editor):
+    from taskplanner.search import uninstall_index
+
+    uninstall_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+    # MySQL の ALTER TABLE はトランザクションに入らない
+    atomic = False
+
+    dependencies = [
+        ('taskplanner', '0018_schedule_uid'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.10 on 2026-10-18 20:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskplanner', '0019_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='planjob',
+            name='full',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='plansuggestion',
+            name='task_fingerprint',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='plansuggestion',
+            name='user_edited',
+            field=models.BooleanField(default=False),
+        ),
+    ]
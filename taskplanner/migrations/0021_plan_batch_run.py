@@ -0,0 +1,26 @@
+# Generated by Django 5.2.10 on 2026-10-18 20:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskplanner', '0020_incremental_replan'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlanBatchRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cursor', models.IntegerField(default=0)),
+                ('users_planned', models.IntegerField(default=0)),
+                ('users_skipped', models.IntegerField(default=0)),
+                ('suggestions_written', models.IntegerField(default=0)),
+                ('elapsed_seconds', models.FloatField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.10 on 2026-10-18 21:01
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskplanner', '0022_plan_worker'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='schedule',
+            name='schedule_user_title_idx',
+        ),
+    ]
@@ -1,14 +1,19 @@
+from datetime import timedelta
+
 from django.db import models
 from django.contrib.auth.models import User
 
+# 予定1件の長さの上限（フォームは23時間45分まで）。重なり検索で開始日時の下限をこれだけ前に広げる
+MAX_SCHEDULE_LENGTH = timedelta(days=1)
+
 
 class Schedule(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     title = models.CharField(max_length=100)
     memo = models.TextField(blank=True)
     date = models.DateTimeField()
-    start_time = models.TimeField(null=True, blank=True)
-    end_time = models.TimeField(null=True, blank=True)
+    # 終了日時は date + duration_minutes（save() で毎回計算し直す）
+    end_at = models.DateTimeField()
 
     PRIORITY_CHOICES = [
         (1, "高"),
@@ -17,24 +22,36 @@ class Schedule(models.Model):
     ]
     priority = models.IntegerField(choices=PRIORITY_CHOICES, default=2)
 
-    duration = models.CharField(max_length=50, blank=True)
+    duration_minutes = models.PositiveIntegerField(default=60)
+
+    # iCalendar の UID（.ics から取り込んだ予定だけ。再取り込み時の重複判定に使う）
+    uid = models.CharField(max_length=255, blank=True, default="")
+
+    class Meta:
+        indexes = [
+            # calendar_view / schedule_list_view / plan_generate は全て user + date 範囲で絞る
+            models.Index(fields=["user", "date"], name="schedule_user_date_idx"),
+            models.Index(fields=["user", "uid"], name="schedule_user_uid_idx"),
+        ]
 
     def __str__(self):
         return self.title
 
-    def get_duration_display(self):
-        if not self.duration:
-            return "0分"
-        text = str(self.duration)
-
-        if "分" in text or "時間" in text:
-            return text
+    def save(self, *args, **kwargs):
+        self.end_at = self.compute_end_at()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"date", "duration_minutes"} & set(update_fields):
+            kwargs["update_fields"] = set(update_fields) | {"end_at"}
+        super().save(*args, **kwargs)
 
-        try:
-            total = int(text)
-        except ValueError:
-            return text
+    def compute_end_at(self):
+        """bulk_create など save() を通らない経路でも同じ計算を使う"""
+        if self.date is None:
+            return None
+        return self.date + timedelta(minutes=self.duration_minutes or 0)
 
+    def get_duration_display(self):
+        total = self.duration_minutes or 0
         h = total // 60
         m = total % 60
 
@@ -43,6 +60,56 @@ class Schedule(models.Model):
         return f"{m}分"
 
 
+class ScheduleSeries(models.Model):
+    """
+    繰り返し予定（RRULE 相当）。回ごとの行は作らず、表示する期間の分だけ recurrence.expand で展開する。
+    時刻は dtstart のローカル時刻（JST）で毎回同じ。
+    """
+
+    FREQ_DAILY = "daily"
+    FREQ_WEEKLY = "weekly"
+    FREQ_MONTHLY = "monthly"
+    FREQ_CHOICES = [
+        (FREQ_DAILY, "毎日"),
+        (FREQ_WEEKLY, "毎週"),
+        (FREQ_MONTHLY, "毎月"),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    title = models.CharField(max_length=100)
+    memo = models.TextField(blank=True)
+    priority = models.IntegerField(choices=Schedule.PRIORITY_CHOICES, default=2)
+    duration_minutes = models.PositiveIntegerField(default=60)
+
+    # 初回の開始日時
+    dtstart = models.DateTimeField()
+    freq = models.CharField(max_length=10, choices=FREQ_CHOICES, default=FREQ_WEEKLY)
+    interval = models.PositiveSmallIntegerField(default=1)
+    # 毎週のときの曜日（"0,2" = 月・水。空なら dtstart の曜日）
+    byweekday = models.CharField(max_length=20, blank=True)
+    # 終わり：回数か日時（どちらも空なら無期限）
+    count = models.PositiveIntegerField(null=True, blank=True)
+    until = models.DateTimeField(null=True, blank=True)
+    # この回だけ休み（ローカル日付 "YYYY-MM-DD" の配列）
+    exdates = models.JSONField(default=list, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "dtstart"], name="series_user_dtstart_idx"),
+        ]
+
+    def __str__(self):
+        return self.title
+
+    def weekdays(self):
+        return sorted({int(d) for d in self.byweekday.split(",") if d.strip().isdigit() and int(d) < 7})
+
+    def get_duration_display(self):
+        return Schedule.get_duration_display(self)
+
+
 class PlanTask(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     title = models.CharField(max_length=100)
@@ -63,6 +130,11 @@ class PlanTask(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "-created_at"], name="plantask_user_created_idx"),
+        ]
+
     def __str__(self):
         return self.title
     
@@ -87,3 +159,100 @@ class PlanSuggestion(models.Model):
     order = models.IntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
     memo = models.TextField(blank=True)
+    # 計画したときのタスクの内容（所要時間・優先度・締切・希望日時）のハッシュ。差分の再計画で変わったタスクを見分ける
+    task_fingerprint = models.CharField(max_length=32, blank=True, default="")
+    # plan_suggestion_edit で手で直した提案（差分の再計画では動かさない）
+    user_edited = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "order"], name="plansugg_user_order_idx"),
+        ]
+
+
+class PlanJob(models.Model):
+    """プラン生成のバックグラウンドジョブ（run_plan_worker が処理する）"""
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "待機中"),
+        (STATUS_RUNNING, "実行中"),
+        (STATUS_DONE, "完了"),
+        (STATUS_FAILED, "失敗"),
+    ]
+    ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    created_count = models.IntegerField(default=0)
+    # AIから受信済みの提案数（AI_STREAMING のとき実行中に増えていく）
+    progress = models.IntegerField(default=0)
+    # [[level, text], ...]（完了後に plan_ai 画面で messages として表示する）
+    result_messages = models.JSONField(default=list, blank=True)
+    notified = models.BooleanField(default=False)
+    # 前回の提案を使わずに全部作り直す（手で直した提案も消える）
+    full = models.BooleanField(default=False)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "id"], name="planjob_status_id_idx"),
+            models.Index(fields=["user", "-id"], name="planjob_user_id_idx"),
+        ]
+
+    @property
+    def is_active(self):
+        return self.status in self.ACTIVE_STATUSES
+
+
+class PlanWorker(models.Model):
+    """run_plan_worker のプロセスの生存確認（last_seen を定期的に更新する。jobs.record_heartbeat）"""
+
+    # ホスト名:pid
+    name = models.CharField(max_length=100, unique=True)
+    started_at = models.DateTimeField(auto_now_add=True)
+    last_seen = models.DateTimeField()
+
+
+class PlanApplication(models.Model):
+    """plan_apply の実行記録。同じ token の2回目以降は何もしない（二重クリック/再送対策）"""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    token = models.CharField(max_length=64)
+    created_count = models.IntegerField(default=0)
+    # [{"suggestion_id", "title", "start", "end", "with": [重なった予定のタイトル]}, ...]
+    conflicts = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "token"], name="planapply_user_token_uniq"),
+        ]
+
+
+class PlanBatchRun(models.Model):
+    """
+    plan_all_users の実行記録。cursor（処理済みの最後のユーザー id）はチャンクの書き込みと同じトランザクションで進めるので、
+    途中で落ちても次の実行で続きから再開できる
+    """
+
+    cursor = models.IntegerField(default=0)
+    users_planned = models.IntegerField(default=0)
+    # 実行中のジョブがある/途中で提案が変わった/タスクが無いなどで飛ばしたユーザー
+    users_skipped = models.IntegerField(default=0)
+    suggestions_written = models.IntegerField(default=0)
+    # 実際に計画していた秒数の合計（再開をまたいでも、止まっていた時間は入れない）
+    elapsed_seconds = models.FloatField(default=0)
+
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def users_per_second(self):
+        return self.users_planned / self.elapsed_seconds if self.elapsed_seconds else 0.0
@@ -0,0 +1,115 @@
+"""
+カレンダー/プラン設計画面のユーザー単位キャッシュ
+
+- ページ：関係する世代（caching.user_version）から ETag/Last-Modified を作り、ブラウザの持っている版から
+  変わっていなければビューを呼ばずに 304 を返す（DB は見ない。ログイン確認のセッション/ユーザーは別）
+- 断片：月グリッド・その日の予定・タスク一覧・提案一覧はテンプレートの {% cache %} に
+  fragment_key() のキーを渡して描画結果を使い回す。一覧のクエリは遅延評価にしておき、当たれば流れない
+世代は signals.py の post_save/post_delete で進む。bulk_* で書いたときは書いた側から進める。
+"""
+import hashlib
+from datetime import datetime, timezone as dt_timezone
+from functools import wraps
+
+from django.conf import settings
+from django.contrib import messages
+from django.middleware.csrf import get_token
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from .caching import user_versions
+# 予定（カレンダー）の画面は月グリッドの集計と同じ世代を使う（予定・繰り返し予定・bulk_* で進む）
+from .calendar_index import CACHE_NAMESPACE as SCHEDULES_NAMESPACE  # noqa: F401
+
+TASKS_NAMESPACE = "plan_tasks"
+# 提案一覧とジョブの状態（AI相談の画面）
+SUGGESTIONS_NAMESPACE = "plan_suggestions"
+
+
+def fragment_timeout() -> int:
+    return getattr(settings, "PAGE_CACHE_SECONDS", 3600)
+
+
+def _versions(request, namespaces) -> dict:
+    # ETag と Last-Modified と断片のキーで同じ値を使う（キャッシュへの問い合わせは1回）
+    cached = getattr(request, "_page_versions", None)
+    if cached is None:
+        cached = request._page_versions = {}
+    missing = [ns for ns in namespaces if ns not in cached]
+    if missing:
+        cached.update(user_versions(request.user.id, missing))
+    return {ns: cached[ns] for ns in namespaces}
+
+
+def _csrf_key(request) -> str:
+    # 画面のフォームには CSRF トークンが入るので、秘密が変わったら（ログインし直しなど）別物として扱う
+    get_token(request)
+    return hashlib.sha256(request.META["CSRF_COOKIE"].encode()).hexdigest()[:16]
+
+
+def fragment_key(request, *namespaces, vary=()) -> str:
+    """{% cache %} の vary_on に渡すキー（ユーザー・世代・CSRF の秘密と、描画に効く値）"""
+    versions = _versions(request, namespaces)
+    parts = [str(request.user.id), *(versions[ns] for ns in namespaces), _csrf_key(request), *map(str, vary)]
+    return ":".join(parts)
+
+
+def no_validators(request) -> None:
+    """このレスポンスは 304 で使い回させない（実行中のジョブを表示しているときなど）"""
+    request._page_no_validators = True
+
+
+def _has_pending_messages(request) -> bool:
+    # len() は読み込むだけで「表示済み」にはしない
+    return bool(len(messages.get_messages(request)))
+
+
+def cached_page(*namespaces):
+    """
+    GET/HEAD を世代で条件付きにするビューのデコレーター（login_required の内側に付ける）
+
+    ETag はユーザー・世代・URL（クエリ込み）・今日の日付・CSRF の秘密から作る。
+    未表示のメッセージがあるとき、描画でメッセージを出したときは ETag/Last-Modified を付けない。
+    Cache-Control: private, no-cache で、ブラウザには毎回確認させる。
+    """
+
+    def etag(request, *args, **kwargs):
+        if _has_pending_messages(request):
+            return None
+        versions = _versions(request, namespaces)
+        raw = "|".join([
+            str(request.user.id),
+            request.get_full_path(),
+            timezone.localdate().isoformat(),
+            _csrf_key(request),
+            *(versions[ns] for ns in namespaces),
+        ])
+        return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+    def last_modified(request, *args, **kwargs):
+        if _has_pending_messages(request):
+            return None
+        # 世代は time_ns。秒未満は落ちるが、ブラウザは If-None-Match も送るのでそちらが優先される
+        newest = max(int(v) for v in _versions(request, namespaces).values())
+        return datetime.fromtimestamp(newest / 1_000_000_000, tz=dt_timezone.utc)
+
+    def decorator(view_func):
+        conditional = condition(etag_func=etag, last_modified_func=last_modified)(view_func)
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view_func(request, *args, **kwargs)
+
+            response = conditional(request, *args, **kwargs)
+            storage = getattr(request, "_messages", None)
+            if getattr(request, "_page_no_validators", False) or (storage is not None and storage.used):
+                del response["ETag"]
+                del response["Last-Modified"]
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+
+        return wrapper
+
+    return decorator
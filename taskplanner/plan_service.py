@@ -0,0 +1,638 @@
+"""
+プラン生成の本体（ビュー/バックグラウンドジョブの両方から呼ぶ）
+
+request に依存しないように、ユーザーへのメッセージは (level, text) の配列で返す。
+"""
+from __future__ import annotations
+
+import hashlib
+import typing
+from collections import defaultdict
+from datetime import timedelta
+from itertools import zip_longest
+from typing import List, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .freebusy import FreeBusy, merge_intervals, overlapping_schedules
+from .models import PlanApplication, PlanSuggestion, PlanTask, Schedule
+from .planner import BREAK_MINUTES, LocalPlanner
+from .recurrence import occurrences_for
+from .signals import plan_bulk_changed, schedules_bulk_changed
+
+DEFAULT_AVAILABILITY = {
+    "timezone": "Asia/Tokyo",
+    "weekday": [{"start": "18:00", "end": "23:00"}],
+    "weekend": [{"start": "10:00", "end": "22:00"}],
+    "slot_minutes": 15,
+}
+
+PLAN_WINDOW_DAYS = 14
+
+
+class PlanOutcome(typing.TypedDict):
+    created_count: int
+    used_ai: bool
+    messages: List[Tuple[int, str]]
+
+
+class ApplyOutcome(typing.TypedDict):
+    created_count: int
+    conflicts: list
+    replayed: bool
+
+
+def plan_window(now=None):
+    """計画する期間（今日の 09:00 から14日間）"""
+    jst = timezone.get_current_timezone()
+    now = now or timezone.now()
+    start = now.astimezone(jst).replace(hour=9, minute=0, second=0, microsecond=0)
+    return start, start + timedelta(days=PLAN_WINDOW_DAYS)
+
+
+def build_task_payload(tasks, minutes=None):
+    """minutes: {task_id: 分}。手で直した提案で一部埋まっているタスクは残りの分だけ計画する"""
+    minutes = minutes or {}
+    return [
+        {
+            "id": t.id,
+            "title": t.title,
+            "memo": t.memo,
+
+            "priority": t.priority,
+            "priority_locked": True,
+
+            "deadline": t.deadline.isoformat() if t.deadline else None,
+
+            "desired_at": t.desired_at.isoformat() if t.desired_at else None,
+            "desired_at_locked": bool(t.desired_at),
+
+            "estimated_minutes": minutes.get(t.id, t.estimated_minutes),
+            "estimated_minutes_locked": bool(t.estimated_minutes),
+        }
+        for t in tasks
+    ]
+
+
+def build_existing_events(schedules):
+    jst = timezone.get_current_timezone()
+    return [
+        {
+            "title": s.title,
+            "start": s.date.astimezone(jst).isoformat(),
+            "end": s.end_at.astimezone(jst).isoformat(),
+        }
+        for s in schedules
+    ]
+
+
+def build_pinned_events(pinned, tasks_by_id):
+    """動かさない提案も busy として渡す（ローカル計画と同じく後ろに休憩を取る）"""
+    jst = timezone.get_current_timezone()
+    return [
+        {
+            "title": f"{tasks_by_id[s.task_id].title}（確定済みの提案）",
+            "start": s.suggested_start.astimezone(jst).isoformat(),
+            "end": (s.suggested_end + timedelta(minutes=BREAK_MINUTES)).astimezone(jst).isoformat(),
+        }
+        for s in pinned
+    ]
+
+
+def task_fingerprint(task) -> str:
+    """計画に効くタスクの内容のハッシュ（タイトルやメモだけの変更では計画し直さない）"""
+    raw = "|".join(
+        str(v) for v in (
+            task.estimated_minutes,
+            task.priority,
+            task.deadline.isoformat() if task.deadline else "",
+            task.desired_at.isoformat() if task.desired_at else "",
+        )
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+
+def suggestion_snapshot(rows) -> set:
+    """
+    (id, 開始, 終了, 手で直したか) の集合。読んだときと書く直前（行をロックしてから）で比べ、
+    計画中に提案が生成/編集/削除されていたら書かない
+    """
+    return {(s_id, start, end, edited) for s_id, start, end, edited in rows}
+
+
+def task_snapshot(tasks) -> set:
+    """(id, task_fingerprint) の集合。タスクが追加/削除されたり計画に効く内容が変わっていたら書かない"""
+    return {(t.id, task_fingerprint(t)) for t in tasks}
+
+
+def _block_minutes(rows) -> int:
+    return sum(int((s.suggested_end - s.suggested_start).total_seconds() // 60) for s in rows)
+
+
+def _pinned_suggestions(tasks, suggestions, schedules, window, now):
+    """
+    前回の提案のうち、そのまま残すもの（タスク単位で判断する）。
+    提案のブロックは、まだ先で・予定と重ならず・締め切りまでに終わるときだけ残せる。
+    - 内容が変わっておらず、どのブロックも残せるタスク：全部残す
+    - それ以外で手で直したブロックがあるタスク：残せる手直しのブロックだけ残し、
+      見積もりのうちそれで埋まらない分だけ計画し直す（埋まっていれば計画しない）
+    - それ以外（追加/変更されたタスク、過ぎた・予定と重なった提案のタスク）は全部計画し直す
+    削除されたタスクの提案は CASCADE で消えているので、その時間は計画し直すタスクが使える。
+
+    戻り値: (残す提案, {一部だけ計画し直すタスクの id: 残りの分}, 手直しのブロックで埋まったタスクの id,
+             内容の変わったタスクに合わせて task_fingerprint を付け直した残す提案)
+    """
+    busy = FreeBusy(*window, merge_intervals(sorted((s.date, s.end_at) for s in schedules)))
+    tasks_by_id = {t.id: t for t in tasks}
+
+    by_task = defaultdict(list)
+    for s in suggestions:
+        by_task[s.task_id].append(s)
+
+    pinned, remaining, covered, refreshed = [], {}, set(), []
+    for task_id, rows in by_task.items():
+        task = tasks_by_id.get(task_id)
+        if task is None:
+            continue
+        fingerprint = task_fingerprint(task)
+
+        def usable(s):
+            return (
+                s.suggested_start >= now
+                and not busy.conflicts(s.suggested_start, s.suggested_end)
+                and (task.deadline is None or s.suggested_end <= task.deadline)
+            )
+
+        if all(s.task_fingerprint == fingerprint and usable(s) for s in rows):
+            pinned.extend(rows)
+            continue
+
+        edited = [s for s in rows if s.user_edited and usable(s)]
+        if not edited:
+            continue
+        pinned.extend(edited)
+        # 次回は「変わっていない」と判断できるよう、今の内容で計画し直したことにする
+        for s in edited:
+            if s.task_fingerprint != fingerprint:
+                s.task_fingerprint = fingerprint
+                refreshed.append(s)
+        left = (task.estimated_minutes or 0) - _block_minutes(edited)
+        if left > 0:
+            remaining[task_id] = left
+        else:
+            # 見積もりが無い/手直しのブロックで足りている
+            covered.add(task_id)
+    return pinned, remaining, covered, refreshed
+
+
+def plan_inputs(tasks, schedules, suggestions, window, now):
+    """
+    計画の入力を組み立てる（DB は読まない。plan_all_users はチャンク単位でまとめて読んだものを渡す）
+
+    suggestions が None なら全部作り直す。そうでなければ差分の再計画：前回の提案のうち動かさないもの（pinned）を
+    busy として固定し、残りのタスク（tasks_by_id）だけを計画する。tasks_by_id が空なら計画し直すものは無い。
+    """
+    pinned, remaining, covered, refreshed = [], {}, set(), []
+    if suggestions:
+        pinned, remaining, covered, refreshed = _pinned_suggestions(tasks, suggestions, schedules, window, now)
+    # 全部残すタスク（一部だけ計画し直すタスクは除く）
+    pinned_task_ids = {s.task_id for s in pinned} - remaining.keys()
+    replan = [t for t in tasks if t.id not in pinned_task_ids]
+
+    # ===== AIに渡す「タスク」「既存予定」「作業可能時間」「期間」 =====
+    payload = build_task_payload(replan, remaining)
+    existing_events = build_existing_events(schedules) + build_pinned_events(pinned, {t.id: t for t in tasks})
+    availability = DEFAULT_AVAILABILITY
+    window_start = window[0].isoformat()
+    window_end = window[1].isoformat()
+
+    return {
+        "tasks_by_id": {t.id: t for t in replan},
+        "ai_args": (payload, existing_events, availability, window_start, window_end),
+        "now": now,
+        # 差分の書き込み用（全部作り直すときは None）
+        "suggestions": suggestions,
+        "pinned": pinned,
+        "refreshed": refreshed,
+        "pinned_task_count": len(pinned_task_ids - covered),
+    }
+
+
+def _prepare_plan(user, full: bool = False):
+    """
+    AIに渡す入力とローカル計画を作る（DBを読むのはここだけ）。タスクが無ければ None。
+    """
+    # タスクは1クエリでまとめて取得し、以降は id→task の辞書で引く
+    tasks = list(PlanTask.objects.filter(user=user))
+    if not tasks:
+        return None
+
+    window_start_dt, window_end_dt = plan_window()
+
+    # 期間の前から始まって期間内に食い込む予定、繰り返し予定の回も busy に含める
+    schedules = list(overlapping_schedules(user, window_start_dt, window_end_dt))
+    schedules += occurrences_for(user.id, window_start_dt, window_end_dt)
+
+    # 全部作り直すときも、書く直前に比べるために今の提案は読んでおく
+    suggestions = list(PlanSuggestion.objects.filter(user=user))
+    prepared = plan_inputs(
+        tasks, schedules, None if full else suggestions, (window_start_dt, window_end_dt), timezone.now()
+    )
+    prepared["snapshot"] = suggestion_snapshot(
+        (s.id, s.suggested_start, s.suggested_end, s.user_edited) for s in suggestions
+    )
+    # suggestion_rows がタスクに所要時間/優先度を書き込む前に取っておく
+    prepared["task_snapshot"] = task_snapshot(tasks)
+
+    # ===== ローカル計画エンジン（ネットワーク不要・これが土台になる）=====
+    planner = LocalPlanner(*prepared["ai_args"], not_before=prepared["now"])
+    prepared["planner"] = planner
+    prepared["local_plan"] = planner.plan()
+    return prepared
+
+
+def _no_tasks_outcome() -> PlanOutcome:
+    return {"created_count": 0, "used_ai": False, "messages": [(messages.INFO, "タスクが無いのでプランを作れませんでした。")]}
+
+
+def _unchanged_outcome() -> PlanOutcome:
+    return {
+        "created_count": 0,
+        "used_ai": False,
+        "messages": [(messages.INFO, "前回のプランから変わったタスクが無いので、提案はそのままです。")],
+    }
+
+
+def _changed_outcome(used_ai: bool) -> PlanOutcome:
+    return {
+        "created_count": 0,
+        "used_ai": used_ai,
+        "messages": [(messages.WARNING, "プランを作っている間にタスクか提案が変わったため、保存しませんでした。もう一度お試しください。")],
+    }
+
+
+def _accepted(prepared, result, notes):
+    """AIの結果を検証する。使えないときは None（ローカル計画に戻す）"""
+    if not isinstance(result, list):
+        raise ValueError(f"AI結果がlistではありません: {type(result)}")
+    if not prepared["planner"].accepts(result):
+        notes.append((messages.INFO, "AIの提案が既存予定や作業可能時間と衝突したため、ローカル計画を使いました。"))
+        return None
+    return result
+
+
+def _ai_error_note(e: Exception) -> Tuple[int, str]:
+    msg = str(e)
+    # メッセージはここで出す（成功時には出さない）
+    if ("503" in msg) or ("UNAVAILABLE" in msg) or ("high demand" in msg):
+        return (messages.ERROR, "AIが混雑しています（503）。ローカル計画でプランを作りました。")
+    return (messages.ERROR, f"AIエラーが発生しました。ローカル計画でプランを作りました。（詳細: {msg}）")
+
+
+def generate_plan(user, on_item=None, full: bool = False) -> PlanOutcome:
+    """
+    on_item: AI_STREAMING のとき、AIの提案が1件届くたびに呼ばれる（進捗表示用）。
+    full: 前回の提案を全部捨てて作り直す（既定は変わったタスクだけ計画し直す）。
+    提案の保存は全件そろって検証が済んでから1トランザクションで行う。
+    """
+    from .ai_service import ai_plan_tasks, ai_plan_tasks_stream
+
+    prepared = _prepare_plan(user, full)
+    if prepared is None:
+        return _no_tasks_outcome()
+    if not prepared["tasks_by_id"]:
+        return _unchanged_outcome()
+
+    notes: List[Tuple[int, str]] = []
+    result = None
+    used_fallback = False
+
+    # ===== Gemini呼び出し（ローカル計画を下書きとして仕上げてもらう）=====
+    if getattr(settings, "PLAN_AI_POLISH", True):
+        try:
+            ai_args = prepared["ai_args"]
+            local_plan = prepared["local_plan"]
+            if getattr(settings, "AI_STREAMING", False):
+                result = []
+                for item in ai_plan_tasks_stream(*ai_args, draft=local_plan, cache_user_id=user.id):
+                    result.append(item)
+                    if on_item is not None:
+                        on_item(item, len(result))
+            else:
+                result = ai_plan_tasks(*ai_args, draft=local_plan, cache_user_id=user.id)
+            result = _accepted(prepared, result, notes)
+            used_fallback = result is None
+        except Exception as e:
+            result = None
+            used_fallback = True
+            notes.append(_ai_error_note(e))
+
+    return _save_plan(user, prepared, result, used_fallback, notes)
+
+
+async def agenerate_plan(user, full: bool = False) -> PlanOutcome:
+    """
+    generate_plan の async 版（ASGI で PLAN_JOBS_INLINE のとき）。
+    DBの読み書きはスレッドで、Gemini の応答待ちはイベントループ上で行う。
+    """
+    from .ai_service import ai_plan_tasks_async
+
+    prepared = await sync_to_async(_prepare_plan)(user, full)
+    if prepared is None:
+        return _no_tasks_outcome()
+    if not prepared["tasks_by_id"]:
+        return _unchanged_outcome()
+
+    notes: List[Tuple[int, str]] = []
+    result = None
+    used_fallback = False
+
+    if getattr(settings, "PLAN_AI_POLISH", True):
+        try:
+            result = await ai_plan_tasks_async(
+                *prepared["ai_args"], draft=prepared["local_plan"], cache_user_id=user.id
+            )
+            result = _accepted(prepared, result, notes)
+            used_fallback = result is None
+        except Exception as e:
+            result = None
+            used_fallback = True
+            notes.append(_ai_error_note(e))
+
+    return await sync_to_async(_save_plan)(user, prepared, result, used_fallback, notes)
+
+
+def suggestion_rows(user_id, tasks_by_id, result):
+    """計画の結果（AI/ローカル）→ 保存する PlanSuggestion と、所要時間/優先度を埋めたタスク {id: task}"""
+    tz = timezone.get_current_timezone()
+    new_suggestions = []
+    changed_tasks = {}
+    skipped_count = 0  # ★スキップした件数（デバッグに便利）
+
+    for r in sorted(result, key=lambda x: int(x.get("order", 999999))):
+        try:
+            task = tasks_by_id.get(int(r.get("id")))
+        except (TypeError, ValueError):
+            task = None
+        if not task:
+            skipped_count += 1
+            continue
+
+        # ローカル計画/検証済みのAI結果なので start_at/end_at は必ず入っている
+        start = parse_datetime(r["start_at"])
+        end = parse_datetime(r["end_at"])
+        if timezone.is_naive(start):
+            start = timezone.make_aware(start, tz)
+        if timezone.is_naive(end):
+            end = timezone.make_aware(end, tz)
+
+        # 90分を超えるタスクは複数ブロックに分かれるので、所要時間は estimated_minutes を優先
+        try:
+            minutes = int(r.get("estimated_minutes") or 0)
+        except (TypeError, ValueError):
+            minutes = 0
+        if minutes <= 0:
+            minutes = int((end - start).total_seconds() // 60)
+
+        # 所要時間をタスクに保存（未設定のときだけ）
+        if task.estimated_minutes is None and minutes > 0:
+            task.estimated_minutes = minutes
+            changed_tasks[task.id] = task
+
+        # 優先度をAIが返してきたら反映（1〜3のみ）
+        p = r.get("priority")
+        if p in (1, 2, 3) and task.priority != p:
+            task.priority = p
+            changed_tasks[task.id] = task
+
+        # order を安全に決める（AIがorder返さない場合に備える）
+        try:
+            order_val = int(r.get("order", 999999))
+        except (TypeError, ValueError):
+            order_val = 999999
+
+        new_suggestions.append(
+            PlanSuggestion(
+                user_id=user_id,
+                task=task,
+                suggested_start=start,
+                suggested_end=end,
+                order=order_val,
+            )
+        )
+
+    # 所要時間/優先度を埋めたあとの内容で（次回の差分の再計画で比べる）
+    for suggestion in new_suggestions:
+        suggestion.task_fingerprint = task_fingerprint(suggestion.task)
+    return new_suggestions, changed_tasks
+
+
+def suggestion_writes(prepared, new_suggestions):
+    """(消す提案の id の配列（None なら全部）, 更新する行, 作る行)"""
+    if prepared["suggestions"] is None:
+        return None, [], new_suggestions
+    return _suggestion_diff(prepared["suggestions"], prepared["pinned"], new_suggestions, prepared["refreshed"])
+
+
+def write_suggestion_diff(to_delete, to_update, to_create, changed_tasks, batch_size=None) -> None:
+    """
+    提案の差分をまとめて書く（_save_plan と batch.save_chunk から、呼ぶ側のトランザクションの中で）。
+    to_delete は消す提案の QuerySet（無ければ None）。PlanSuggestion には削除のシグナルの受け手を
+    置いていないので .delete() は1文で済む。世代は書いたユーザーごとに呼ぶ側が plan_bulk_changed で進める
+    """
+    if to_delete is not None:
+        to_delete.delete()
+    if to_update:
+        PlanSuggestion.objects.bulk_update(to_update, SUGGESTION_DIFF_FIELDS, batch_size=batch_size)
+    if to_create:
+        PlanSuggestion.objects.bulk_create(to_create, batch_size=batch_size)
+    if changed_tasks:
+        PlanTask.objects.bulk_update(changed_tasks, ["estimated_minutes", "priority"], batch_size=batch_size)
+
+
+def _save_plan(user, prepared, result, used_fallback: bool, notes) -> PlanOutcome:
+    planner = prepared["planner"]
+
+    # ===== AIを使わない/使えなかった場合はローカル計画をそのまま使う =====
+    used_ai = result is not None
+    if result is None:
+        result = prepared["local_plan"]
+
+    # ===== PlanSuggestion 作成（まとめて書き込む）=====
+    new_suggestions, changed_tasks = suggestion_rows(user.id, prepared["tasks_by_id"], result)
+    to_delete, to_update, to_create = suggestion_writes(prepared, new_suggestions)
+
+    # 提案の削除〜保存までを1トランザクションで（タスク数に関係なく定数クエリ）
+    if to_delete is None:
+        old_suggestions = PlanSuggestion.objects.filter(user=user)
+    elif to_delete:
+        old_suggestions = PlanSuggestion.objects.filter(user=user, id__in=to_delete)
+    else:
+        old_suggestions = None
+    with transaction.atomic():
+        # AIを待っている間に提案やタスクが変わっていたら書かない（手での編集・削除を古い差分で上書きしない）。
+        # 比べた行はコミットまでロックしておく
+        current = (
+            PlanSuggestion.objects.select_for_update()
+            .filter(user=user)
+            .values_list("id", "suggested_start", "suggested_end", "user_edited")
+        )
+        current_tasks = (
+            PlanTask.objects.select_for_update()
+            .filter(user=user)
+            .only("id", "estimated_minutes", "priority", "deadline", "desired_at")
+        )
+        if (
+            suggestion_snapshot(current) != prepared["snapshot"]
+            or task_snapshot(current_tasks) != prepared["task_snapshot"]
+        ):
+            return _changed_outcome(used_ai)
+        write_suggestion_diff(old_suggestions, to_update, to_create, list(changed_tasks.values()))
+    plan_bulk_changed(user.id)
+
+    created_count = len(new_suggestions)  # ★実際に作れた件数
+
+    # ===== メッセージ：ここが一番重要 =====
+    if planner.unplaced:
+        notes.append((messages.INFO, f"空き時間が足りず {len(planner.unplaced)} 件のタスクは配置できませんでした。"))
+    if prepared["pinned_task_count"]:
+        notes.append((messages.INFO, f"変更の無い {prepared['pinned_task_count']} 件のタスクの提案はそのままにしました。"))
+
+    if created_count == 0:
+        # resultはあるのに保存できてないパターンを確実に拾う
+        notes.append((messages.ERROR, "プランを作れませんでした（空き時間が無いか、タスクIDが一致していません）。"))
+    else:
+        if used_ai:
+            notes.append((messages.SUCCESS, f"AIプランを {created_count} 件生成しました。"))
+        elif used_fallback:
+            notes.append((messages.INFO, f"ローカル計画でプランを {created_count} 件生成しました。"))
+        else:
+            notes.append((messages.SUCCESS, f"プランを {created_count} 件生成しました。"))
+
+    return {"created_count": created_count, "used_ai": used_ai, "messages": notes}
+
+
+SUGGESTION_DIFF_FIELDS = ["suggested_start", "suggested_end", "task_fingerprint", "order"]
+
+
+def _suggestion_diff(existing, pinned, new_rows, refreshed=()):
+    """
+    前回の提案 → 今回の提案の差分。計画し直したタスクの行は同じタスクの古い行を開始順に使い回し、
+    足りなければ作り、余れば消す。順番（order）は全体の開始順で振り直し、変わった行だけ書く。
+    refreshed（task_fingerprint を付け直した残す行）も書く。
+    戻り値: (消す id の配列, 更新する行, 作る行)
+    """
+    pinned_ids = {s.id for s in pinned}
+    old_by_task = defaultdict(list)
+    for s in existing:
+        if s.id not in pinned_ids:
+            old_by_task[s.task_id].append(s)
+    new_by_task = defaultdict(list)
+    for s in new_rows:
+        new_by_task[s.task_id].append(s)
+
+    to_delete, to_update, to_create = [], {s.id: s for s in refreshed}, []
+    final = list(pinned)
+    for task_id in old_by_task.keys() | new_by_task.keys():
+        olds = sorted(old_by_task.get(task_id, []), key=lambda s: (s.suggested_start, s.id))
+        news = sorted(new_by_task.get(task_id, []), key=lambda s: s.suggested_start)
+        for old, new in zip_longest(olds, news):
+            if new is None:
+                to_delete.append(old.id)
+            elif old is None:
+                to_create.append(new)
+                final.append(new)
+            else:
+                if (old.suggested_start, old.suggested_end, old.task_fingerprint) != (
+                    new.suggested_start, new.suggested_end, new.task_fingerprint
+                ):
+                    old.suggested_start = new.suggested_start
+                    old.suggested_end = new.suggested_end
+                    old.task_fingerprint = new.task_fingerprint
+                    to_update[old.id] = old
+                final.append(old)
+
+    final.sort(key=lambda s: (s.suggested_start, s.task_id))
+    for order, s in enumerate(final, start=1):
+        if s.order != order:
+            s.order = order
+            if s.pk is not None:
+                to_update[s.pk] = s
+    return to_delete, list(to_update.values()), to_create
+
+
+def plan_fingerprint(suggestions) -> str:
+    """token が送られてこなかったときの代わり：同じ提案の組み合わせなら同じ値"""
+    h = hashlib.sha256()
+    for s in suggestions:
+        h.update(f"{s.id}:{s.suggested_start.isoformat()}:{s.suggested_end.isoformat()};".encode())
+    return h.hexdigest()
+
+
+def apply_plan(user, token=None) -> ApplyOutcome:
+    """
+    提案を Schedule に一括で追加する。
+    - 既存予定/先に追加した提案と重なるものは追加せず conflicts に入れる
+    - 同じ token での再実行は何もせず、前回の結果を replayed=True で返す
+    - クエリ数は提案の件数によらずほぼ一定（提案1 + 予定1 + 記録 + bulk_create）
+    """
+    suggestions = list(
+        PlanSuggestion.objects.filter(user=user).select_related("task").order_by("suggested_start", "id")
+    )
+    if not suggestions:
+        return {"created_count": 0, "conflicts": [], "replayed": False}
+
+    token = (token or "")[:64] or plan_fingerprint(suggestions)
+
+    with transaction.atomic():
+        # 同時に来た2回目は一意制約の待ちになり、1回目のコミット後に IntegrityError になる
+        try:
+            with transaction.atomic():
+                application = PlanApplication.objects.create(user=user, token=token)
+        except IntegrityError:
+            previous = PlanApplication.objects.get(user=user, token=token)
+            return {"created_count": 0, "conflicts": previous.conflicts, "replayed": True}
+
+        busy = FreeBusy.for_user(user, suggestions[0].suggested_start, max(s.suggested_end for s in suggestions))
+
+        new_schedules = []
+        conflicts = []
+        for s in suggestions:
+            if busy.conflicts(s.suggested_start, s.suggested_end):
+                conflicts.append({
+                    "suggestion_id": s.id,
+                    "title": s.task.title,
+                    "start": s.suggested_start.isoformat(),
+                    "end": s.suggested_end.isoformat(),
+                    "with": busy.overlapping_titles(s.suggested_start, s.suggested_end),
+                })
+                continue
+            busy.reserve(s.suggested_start, s.suggested_end)
+
+            schedule = Schedule(
+                user=user,
+                title=s.task.title,
+                memo=s.task.memo,
+                date=s.suggested_start,
+                priority=s.task.priority,
+                # 90分超のタスクは複数の提案に分かれるので、この枠の長さを所要時間にする
+                duration_minutes=int((s.suggested_end - s.suggested_start).total_seconds() // 60),
+            )
+            schedule.end_at = schedule.compute_end_at()
+            new_schedules.append(schedule)
+
+        Schedule.objects.bulk_create(new_schedules)
+
+        application.created_count = len(new_schedules)
+        application.conflicts = conflicts
+        application.save(update_fields=["created_count", "conflicts"])
+
+    if new_schedules:
+        schedules_bulk_changed(user.id)
+
+    return {"created_count": len(new_schedules), "conflicts": conflicts, "replayed": False}
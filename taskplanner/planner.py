@@ -0,0 +1,505 @@
+"""
+ローカル計画エンジン（AIを使わない決定的なスケジューラ）
+
+ai_plan_tasks と同じ入力（tasks / existing_events / availability / window）を受け取り、
+同じ形式の PlanItem の配列を返す。ネットワーク呼び出しは一切しない。
+
+- 作業可能時間(availability) から既存予定を引いた「空き枠インデックス」を作る
+- desired_at があるタスクは最寄りの空き枠へ、それ以外は締切→優先度の順に先頭から詰める
+- 締切に間に合わないタスクは、締切の無い/優先度の低いタスクと入れ替えて救済する
+- 連続作業は最大90分、ブロックの後ろに10分休憩、開始時刻は15分単位
+"""
+from __future__ import annotations
+
+import bisect
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+DEFAULT_MINUTES = 60
+MAX_CONTINUOUS_MINUTES = 90
+BREAK_MINUTES = 10
+SLOT_MINUTES = 15
+
+# 救済パスで入れ替えを試す最大回数（タスク数が多くても時間が伸びないように）
+MAX_IMPROVE_ATTEMPTS = 200
+
+
+def _parse_dt(value) -> Optional[datetime]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def _parse_clock(text: str) -> Tuple[int, int]:
+    hh, mm = str(text).split(":")[:2]
+    return int(hh), int(mm)
+
+
+class FreeSlotIndex:
+    """
+    空き時間を「window_start からの分オフセット」の半開区間 [start, end) で持つインデックス。
+    区間は重ならずソート済み。bisect で探索し、予約/解放で分割・結合する。
+    """
+
+    def __init__(self, intervals, slot_minutes: int = SLOT_MINUTES, slot_base: int = 0):
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+        self.slot = max(1, int(slot_minutes))
+        # オフセット0 が「時計の何分」に当たるか（15分単位を時計に揃えるため）
+        self.slot_base = slot_base % self.slot
+
+        for s, e in _merge(intervals):
+            if e > s:
+                self.starts.append(s)
+                self.ends.append(e)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def copy(self) -> "FreeSlotIndex":
+        other = FreeSlotIndex([], self.slot, self.slot_base)
+        other.starts = list(self.starts)
+        other.ends = list(self.ends)
+        return other
+
+    def intervals(self) -> List[Tuple[int, int]]:
+        return list(zip(self.starts, self.ends))
+
+    def _ceil(self, x: int) -> int:
+        return x + (-(x + self.slot_base)) % self.slot
+
+    def _floor(self, x: int) -> int:
+        return x - (x + self.slot_base) % self.slot
+
+    def contains(self, start: int, end: int) -> bool:
+        """[start, end) が1つの空き区間に丸ごと入っているか"""
+        i = bisect.bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    def find(self, duration: int, earliest: int = 0, latest_end: Optional[int] = None) -> Optional[int]:
+        """earliest 以降で duration 分が入る最初の開始位置（15分単位）"""
+        i = bisect.bisect_right(self.ends, earliest)
+        while i < len(self.starts):
+            s = self._ceil(max(self.starts[i], earliest))
+            if latest_end is not None and s + duration > latest_end:
+                return None
+            if s + duration <= self.ends[i]:
+                return s
+            i += 1
+        return None
+
+    def find_nearest(self, duration: int, target: int, earliest: int = 0) -> Optional[int]:
+        """target に最も近い開始位置（同距離なら後ろ側）"""
+        after = self.find(duration, max(target, earliest))
+
+        before = None
+        i = bisect.bisect_right(self.starts, target) - 1
+        while i >= 0:
+            s = self._floor(min(target, self.ends[i] - duration))
+            if s >= max(self.starts[i], earliest):
+                before = s
+                break
+            if self.ends[i] <= earliest:
+                break
+            i -= 1
+
+        if before is None:
+            return after
+        if after is None:
+            return before
+        return before if (target - before) < (after - target) else after
+
+    def reserve(self, start: int, end: int) -> Tuple[int, int]:
+        """
+        [start, end) を空きから取り除く。start を含む区間からはみ出した分は切り詰め、
+        実際に取り除いた範囲を返す（解放用）。
+        """
+        i = bisect.bisect_right(self.starts, start) - 1
+        if i < 0 or self.ends[i] <= start:
+            return start, start
+
+        s, e = self.starts[i], self.ends[i]
+        end = min(end, e)
+        del self.starts[i]
+        del self.ends[i]
+
+        if end < e:
+            self.starts.insert(i, end)
+            self.ends.insert(i, e)
+        if s < start:
+            self.starts.insert(i, s)
+            self.ends.insert(i, start)
+        return start, end
+
+    def release(self, start: int, end: int) -> None:
+        """reserve で取り除いた範囲を空きに戻す（隣接区間とは結合する）"""
+        if end <= start:
+            return
+        i = bisect.bisect_left(self.starts, start)
+
+        if i > 0 and self.ends[i - 1] >= start:
+            i -= 1
+            start = self.starts[i]
+            end = max(end, self.ends[i])
+            del self.starts[i]
+            del self.ends[i]
+
+        while i < len(self.starts) and self.starts[i] <= end:
+            end = max(end, self.ends[i])
+            del self.starts[i]
+            del self.ends[i]
+
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+
+
+def _merge(intervals):
+    out: List[List[int]] = []
+    for s, e in sorted(intervals):
+        if e <= s:
+            continue
+        if out and s <= out[-1][1]:
+            if e > out[-1][1]:
+                out[-1][1] = e
+        else:
+            out.append([s, e])
+    return [(s, e) for s, e in out]
+
+
+def _subtract(free, busy):
+    """ソート済みの free から merge 済みの busy を引く（線形スイープ）"""
+    out = []
+    j = 0
+    for s, e in free:
+        cur = s
+        while j < len(busy) and busy[j][1] <= cur:
+            j += 1
+        k = j
+        while k < len(busy) and busy[k][0] < e:
+            bs, be = busy[k]
+            if bs > cur:
+                out.append((cur, bs))
+            cur = max(cur, be)
+            if cur >= e:
+                break
+            k += 1
+        if cur < e:
+            out.append((cur, e))
+    return out
+
+
+class LocalPlanner:
+    def __init__(
+        self,
+        task_dicts,
+        existing_events,
+        availability,
+        window_start,
+        window_end,
+        not_before=None,
+    ):
+        availability = availability or {}
+        self.window_start = _parse_dt(window_start)
+        self.window_end = _parse_dt(window_end)
+        if self.window_start is None or self.window_end is None:
+            raise ValueError("window_start / window_end が不正です")
+
+        tz_name = availability.get("timezone")
+        self.tz = ZoneInfo(tz_name) if tz_name else self.window_start.tzinfo
+        self.origin = self.window_start
+
+        slot = int(availability.get("slot_minutes") or SLOT_MINUTES)
+        local_origin = self.origin.astimezone(self.tz) if self.tz else self.origin
+        slot_base = local_origin.hour * 60 + local_origin.minute
+
+        self.horizon = self._offset(self.window_end)
+        self.earliest = 0
+        nb = _parse_dt(not_before)
+        if nb is not None:
+            self.earliest = min(max(0, self._offset(nb, ceil=True)), self.horizon)
+
+        busy = []
+        for ev in existing_events or []:
+            s = _parse_dt(ev.get("start"))
+            e = _parse_dt(ev.get("end"))
+            if s and e and e > s:
+                busy.append((self._offset(s), self._offset(e, ceil=True)))
+
+        free = _subtract(_merge(self._availability_intervals(availability)), _merge(busy))
+        free = [(max(s, self.earliest), e) for s, e in free if e > self.earliest]
+
+        # base: 既存予定だけを引いた空き（AI結果の検証用）/ index: 計画中に予約していく空き
+        self.base = FreeSlotIndex(free, slot, slot_base)
+        self.index = self.base.copy()
+
+        self.tasks = [self._normalize(t) for t in task_dicts or [] if t.get("id") is not None]
+        self.placements: Dict[int, List[Tuple[int, int, int]]] = {}
+        self.unplaced: List[int] = []
+
+    # ---------- 変換 ----------
+    def _offset(self, dt: datetime, ceil: bool = False) -> int:
+        secs = (dt - self.origin).total_seconds()
+        m = int(secs // 60)
+        if ceil and secs > m * 60:
+            m += 1
+        return m
+
+    def _to_dt(self, offset: int) -> datetime:
+        dt = self.origin + timedelta(minutes=offset)
+        return dt.astimezone(self.tz) if self.tz else dt
+
+    def _availability_intervals(self, availability):
+        weekday = availability.get("weekday")
+        weekend = availability.get("weekend")
+        if weekday is None and weekend is None:
+            return [(0, self.horizon)]
+
+        first = self.window_start.astimezone(self.tz).date() if self.tz else self.window_start.date()
+        last = self.window_end.astimezone(self.tz).date() if self.tz else self.window_end.date()
+
+        out = []
+        d = first
+        while d <= last:
+            ranges = (weekend if d.weekday() >= 5 else weekday) or []
+            for r in ranges:
+                s = self._day_clock(d, r.get("start"))
+                e = self._day_clock(d, r.get("end"))
+                if s is None or e is None:
+                    continue
+                if e <= s:
+                    e += 24 * 60
+                s, e = max(s, 0), min(e, self.horizon)
+                if e > s:
+                    out.append((s, e))
+            d += timedelta(days=1)
+        return out
+
+    def _day_clock(self, d: date, text) -> Optional[int]:
+        if not text:
+            return None
+        try:
+            hh, mm = _parse_clock(text)
+        except (TypeError, ValueError):
+            return None
+        extra = 0
+        if hh >= 24:
+            extra, hh = hh // 24, hh % 24
+        dt = datetime.combine(d + timedelta(days=extra), time(hh, mm), tzinfo=self.tz)
+        return self._offset(dt)
+
+    def _normalize(self, t):
+        try:
+            minutes = int(t.get("estimated_minutes") or 0)
+        except (TypeError, ValueError):
+            minutes = 0
+        if minutes <= 0:
+            minutes = DEFAULT_MINUTES
+
+        try:
+            priority = int(t.get("priority") or 2)
+        except (TypeError, ValueError):
+            priority = 2
+
+        deadline = _parse_dt(t.get("deadline"))
+        desired = _parse_dt(t.get("desired_at"))
+        return {
+            "id": t["id"],
+            "minutes": minutes,
+            "priority": priority,
+            "deadline": self._offset(deadline) if deadline else None,
+            "desired": self._offset(desired) if desired else None,
+        }
+
+    # ---------- 配置 ----------
+    @staticmethod
+    def _chunks(minutes: int) -> List[int]:
+        out = []
+        while minutes > 0:
+            out.append(min(minutes, MAX_CONTINUOUS_MINUTES))
+            minutes -= MAX_CONTINUOUS_MINUTES
+        return out
+
+    def _place(self, task, earliest=None, latest_end=None, near=None) -> bool:
+        """
+        タスクを（90分以下のブロックに分けて）配置する。最後まで置けなければ元に戻して False。
+        各ブロックの後ろには休憩分も予約しておく。
+        """
+        if not len(self.index):
+            return False
+
+        cursor = self.earliest if earliest is None else max(earliest, self.earliest)
+        placed = []
+        for n, chunk in enumerate(self._chunks(task["minutes"])):
+            if n == 0 and near is not None:
+                s = self.index.find_nearest(chunk, near, cursor)
+            else:
+                s = self.index.find(chunk, cursor, latest_end)
+            if s is None or (latest_end is not None and s + chunk > latest_end):
+                for ps, pe, _ in placed:
+                    self.index.release(ps, pe)
+                return False
+            rs, re_ = self.index.reserve(s, s + chunk + BREAK_MINUTES)
+            placed.append((rs, re_, chunk))
+            cursor = s + chunk + BREAK_MINUTES
+
+        self.placements[task["id"]] = placed
+        return True
+
+    def _unplace(self, task) -> None:
+        for s, e, _ in self.placements.pop(task["id"], []):
+            self.index.release(s, e)
+
+    def _end(self, task) -> Optional[int]:
+        placed = self.placements.get(task["id"])
+        if not placed:
+            return None
+        s, _, chunk = placed[-1]
+        return s + chunk
+
+    def _is_late(self, task) -> bool:
+        if task["deadline"] is None:
+            return False
+        end = self._end(task)
+        return end is None or end > task["deadline"]
+
+    def _greedy(self):
+        pinned = sorted(
+            (t for t in self.tasks if t["desired"] is not None),
+            key=lambda t: (t["priority"], t["desired"]),
+        )
+        rest = sorted(
+            (t for t in self.tasks if t["desired"] is None),
+            key=lambda t: (
+                t["deadline"] is None,
+                t["deadline"] if t["deadline"] is not None else 0,
+                t["priority"],
+                t["minutes"],
+            ),
+        )
+
+        for t in pinned:
+            if not self._place(t, near=t["desired"]):
+                self._place(t)
+        for t in rest:
+            # 締切内に置けるならそこへ、無理なら締切を過ぎても空いている所へ
+            if not self._place(t, latest_end=t["deadline"]):
+                self._place(t)
+
+    def _improve(self):
+        """
+        締切に遅れた（または置けなかった）タスクを、締切より前にいる
+        「締切なし or 優先度が低い」タスクと入れ替えて救済する。
+        """
+        attempts = 0
+        late = [t for t in self.tasks if self._is_late(t)]
+        late.sort(key=lambda t: (t["priority"], t["deadline"]))
+
+        for t in late:
+            candidates = [
+                v for v in self.tasks
+                if v is not t
+                and v["id"] in self.placements
+                and v["desired"] is None
+                and self.placements[v["id"]][0][0] < t["deadline"]
+                and (v["deadline"] is None or v["priority"] > t["priority"])
+            ]
+            candidates.sort(key=lambda v: (v["deadline"] is not None, -v["priority"], -v["minutes"]))
+
+            for v in candidates:
+                if attempts >= MAX_IMPROVE_ATTEMPTS:
+                    return
+                attempts += 1
+
+                before_t = self.placements.get(t["id"])
+                before_v = self.placements.get(v["id"])
+                self._unplace(t)
+                self._unplace(v)
+
+                if self._place(t, latest_end=t["deadline"]):
+                    if self._place(v, latest_end=v["deadline"]) or self._place(v):
+                        break
+                    self._unplace(t)
+
+                # 失敗したら元の配置に戻す
+                self._restore(v, before_v)
+                self._restore(t, before_t)
+
+    def _restore(self, task, placed) -> None:
+        self._unplace(task)
+        if not placed:
+            return
+        for s, e, _ in placed:
+            self.index.reserve(s, e)
+        self.placements[task["id"]] = placed
+
+    # ---------- 出力 ----------
+    def plan(self) -> List[dict]:
+        self._greedy()
+        self._improve()
+
+        rows = []
+        for t in self.tasks:
+            for s, _, chunk in self.placements.get(t["id"], []):
+                rows.append((s, chunk, t))
+        rows.sort(key=lambda r: (r[0], r[2]["id"]))
+
+        self.unplaced = [t["id"] for t in self.tasks if t["id"] not in self.placements]
+
+        items = []
+        for order, (s, chunk, t) in enumerate(rows, start=1):
+            items.append(
+                {
+                    "id": t["id"],
+                    "order": order,
+                    "start_at": self._to_dt(s).isoformat(),
+                    "end_at": self._to_dt(s + chunk).isoformat(),
+                    "estimated_minutes": t["minutes"],
+                    "priority": t["priority"],
+                }
+            )
+        return items
+
+    def fits(self, start: datetime, end: datetime) -> bool:
+        """既存予定・作業可能時間の観点で [start, end) に置けるか（AI結果の検証用）"""
+        return self.base.contains(self._offset(start), self._offset(end, ceil=True))
+
+    def accepts(self, items) -> bool:
+        """
+        AIが仕上げた結果をそのまま採用してよいか。
+        - すべての要素に正しい start_at/end_at があり、空き枠に収まっている
+        - 要素同士が重なっていない
+        - ローカル計画で配置できたタスクを1つも落としていない
+        """
+        spans = []
+        covered = set()
+        for r in items:
+            s = _parse_dt(r.get("start_at"))
+            e = _parse_dt(r.get("end_at"))
+            if s is None or e is None or s.tzinfo is None or e <= s:
+                return False
+            if not self.fits(s, e):
+                return False
+            spans.append((s, e))
+            covered.add(r.get("id"))
+
+        spans.sort()
+        if any(a[1] > b[0] for a, b in zip(spans, spans[1:])):
+            return False
+        return set(self.placements) <= covered
+
+
+def plan_tasks(task_dicts, existing_events, availability, window_start, window_end, not_before=None):
+    return LocalPlanner(
+        task_dicts,
+        existing_events,
+        availability,
+        window_start,
+        window_end,
+        not_before=not_before,
+    ).plan()
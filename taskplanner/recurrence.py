@@ -0,0 +1,190 @@
+"""
+繰り返し予定（ScheduleSeries）の展開
+
+シリーズは1行だけ保存し、画面/プラン生成/空き計算が必要とする期間の分だけ「回」に展開する。
+展開結果はユーザー×期間でキャッシュし、シリーズの保存/削除でユーザーの世代を進めて無効にする。
+"""
+from __future__ import annotations
+
+import calendar
+import itertools
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterator, List, Optional
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from .caching import auser_version, user_version
+from .models import MAX_SCHEDULE_LENGTH, Schedule, ScheduleSeries
+
+CACHE_NAMESPACE = "schedule_series"
+CACHE_TTL = 60 * 60 * 24
+
+
+@dataclass(frozen=True)
+class Occurrence:
+    """
+    繰り返し予定の1回分。テンプレート/空き計算からは Schedule と同じように
+    title/date/end_at/priority/duration_minutes で扱える（id は無いので series_id で区別する）。
+    """
+
+    series_id: int
+    title: str
+    memo: str
+    priority: int
+    date: datetime
+    end_at: datetime
+    duration_minutes: int
+
+    id = None
+
+    @property
+    def local_date(self) -> str:
+        return timezone.localtime(self.date).date().isoformat()
+
+    def get_duration_display(self):
+        return Schedule.get_duration_display(self)
+
+    def get_priority_display(self):
+        return dict(Schedule.PRIORITY_CHOICES).get(self.priority, "")
+
+
+def _at(day: date, first: datetime, tz) -> datetime:
+    """day の日付に、初回と同じローカル時刻を付ける"""
+    return timezone.make_aware(datetime.combine(day, first.time()), tz)
+
+
+def _starts(series: ScheduleSeries, first: datetime, tz, jump_to: Optional[datetime]) -> Iterator[datetime]:
+    """
+    回の開始日時を順に返す（無限）。
+    jump_to があれば、それより前の回は数えずに飛ばしてよい（count が無いシリーズだけ）。
+    """
+    step = max(series.interval or 1, 1)
+    jump_day = timezone.localtime(jump_to, tz).date() if jump_to and jump_to > first else None
+
+    if series.freq == ScheduleSeries.FREQ_DAILY:
+        k0 = (jump_day - first.date()).days // step if jump_day else 0
+        for k in itertools.count(k0):
+            yield _at(first.date() + timedelta(days=k * step), first, tz)
+
+    elif series.freq == ScheduleSeries.FREQ_WEEKLY:
+        days = series.weekdays() or [first.weekday()]
+        anchor = first.date() - timedelta(days=first.weekday())  # 初回の週の月曜
+        w0 = (jump_day - anchor).days // 7 // step if jump_day else 0
+        for w in itertools.count(w0):
+            monday = anchor + timedelta(days=7 * step * w)
+            for d in days:
+                day = monday + timedelta(days=d)
+                if day >= first.date():
+                    yield _at(day, first, tz)
+
+    else:  # 毎月：同じ日付（その日が無い月は飛ばす）
+        m0 = 0
+        if jump_day:
+            months = (jump_day.year - first.year) * 12 + (jump_day.month - first.month)
+            m0 = max(0, months // step - 1)
+        for m in itertools.count(m0):
+            total = first.month - 1 + m * step
+            year, month = first.year + total // 12, total % 12 + 1
+            if first.day <= calendar.monthrange(year, month)[1]:
+                yield _at(date(year, month, first.day), first, tz)
+
+
+def expand(series: ScheduleSeries, start: datetime, end: datetime) -> Iterator[Occurrence]:
+    """[start, end) と重なる回だけを返す（件数はシリーズの総回数ではなく期間に比例）"""
+    tz = timezone.get_current_timezone()
+    first = timezone.localtime(series.dtstart, tz)
+    length = timedelta(minutes=series.duration_minutes)
+    skip = set(series.exdates or [])
+
+    # 回数指定があるときは何回目かを数える必要があるので先頭から、無ければ期間の手前まで飛ばす
+    jump_to = None if series.count else start - length
+    starts = _starts(series, first, tz, jump_to)
+
+    for n, occ_start in enumerate(starts):
+        if series.count and n >= series.count:
+            break
+        if series.until and occ_start > series.until:
+            break
+        if occ_start >= end:
+            break
+        occ_end = occ_start + length
+        if occ_end <= start or occ_start < series.dtstart:
+            continue
+        if occ_start.date().isoformat() in skip:
+            continue
+        yield Occurrence(
+            series_id=series.id,
+            title=series.title,
+            memo=series.memo,
+            priority=series.priority,
+            date=occ_start,
+            end_at=occ_end,
+            duration_minutes=series.duration_minutes,
+        )
+
+
+def _series_overlapping(start: datetime, end: datetime):
+    return ScheduleSeries.objects.filter(dtstart__lt=end).filter(
+        Q(until__isnull=True) | Q(until__gte=start - MAX_SCHEDULE_LENGTH)
+    )
+
+
+def _series_in(user_id, start: datetime, end: datetime):
+    return _series_overlapping(start, end).filter(user_id=user_id)
+
+
+def _expand_all(series, start: datetime, end: datetime) -> List[Occurrence]:
+    occurrences = [o for s in series for o in expand(s, start, end)]
+    occurrences.sort(key=lambda o: o.date)
+    return occurrences
+
+
+def load_occurrences(user_id, start: datetime, end: datetime) -> List[Occurrence]:
+    return _expand_all(_series_in(user_id, start, end), start, end)
+
+
+def load_occurrences_by_user(user_ids, start: datetime, end: datetime) -> Dict[int, List[Occurrence]]:
+    """複数ユーザーのシリーズを1クエリで読んで展開する（キャッシュは使わない。plan_all_users 用）"""
+    series = _series_overlapping(start, end).filter(user_id__in=user_ids)
+    by_user: Dict[int, list] = {}
+    for s in series:
+        by_user.setdefault(s.user_id, []).append(s)
+    return {user_id: _expand_all(rows, start, end) for user_id, rows in by_user.items()}
+
+
+async def aload_occurrences(user_id, start: datetime, end: datetime) -> List[Occurrence]:
+    series = [s async for s in _series_in(user_id, start, end)]
+    return _expand_all(series, start, end)
+
+
+def _cache_key(user_id, version: str, start: datetime, end: datetime) -> str:
+    return f"occ:{user_id}:{version}:{start.isoformat()}:{end.isoformat()}"
+
+
+def occurrences_for(user_id, start: datetime, end: datetime, cached: bool = True) -> List[Occurrence]:
+    """ユーザーの全シリーズを [start, end) で展開した回（開始順）"""
+    if not cached:
+        return load_occurrences(user_id, start, end)
+
+    key = _cache_key(user_id, user_version(user_id, CACHE_NAMESPACE), start, end)
+    occurrences = cache.get(key)
+    if occurrences is None:
+        occurrences = load_occurrences(user_id, start, end)
+        cache.set(key, occurrences, CACHE_TTL)
+    return occurrences
+
+
+async def aoccurrences_for(user_id, start: datetime, end: datetime, cached: bool = True) -> List[Occurrence]:
+    """occurrences_for の async 版（キャッシュは同じキーを共有する）"""
+    if not cached:
+        return await aload_occurrences(user_id, start, end)
+
+    key = _cache_key(user_id, await auser_version(user_id, CACHE_NAMESPACE), start, end)
+    occurrences = await cache.aget(key)
+    if occurrences is None:
+        occurrences = await aload_occurrences(user_id, start, end)
+        await cache.aset(key, occurrences, CACHE_TTL)
+    return occurrences
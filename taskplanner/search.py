@@ -0,0 +1,219 @@
+"""
+予定（Schedule）とタスク（PlanTask）のタイトル・メモの全文検索
+
+日本語は単語で区切れないので、どちらも n-gram の転置インデックスを使う。
+- MySQL：FULLTEXT INDEX (title, memo) WITH PARSER ngram。行の更新に合わせて InnoDB が索引も更新する
+- SQLite：FTS5 の trigram（外部コンテンツ表 <テーブル>_fts）。INSERT/UPDATE/DELETE のトリガーで更新するので、
+  bulk_create / queryset.update() でも漏れない
+  ※ Django のマイグレーションが SQLite でテーブルを作り直す（AlterField など）とトリガーが消えるので、
+    そのあとは manage.py rebuild_search_index を流す
+n-gram より短い語（MySQL は ngram_token_size＝既定2文字、SQLite は3文字）は索引で引けないので、
+索引で絞ったうえで LIKE で確かめる（短い語だけなら LIKE のみ＝そのユーザーの行を全部見る）。
+"""
+from __future__ import annotations
+
+import sqlite3
+from typing import List, Tuple
+
+from django.db import connection
+from django.db.models import BooleanField, Q
+from django.db.models.expressions import RawSQL
+
+from .models import PlanTask, Schedule
+
+SEARCH_LIMIT = 20
+MAX_TERMS = 8
+
+# n-gram の長さ（これより短い語は索引では引けない）
+MIN_NGRAM = {"mysql": 2, "sqlite": 3}
+
+# 検索対象のモデル（どちらも title / memo を持つ）
+INDEXED_MODELS = (Schedule, PlanTask)
+
+# ランキングでタイトルの一致をメモより重く見る（SQLite の bm25 の列の重み）
+TITLE_WEIGHT = 10.0
+MEMO_WEIGHT = 1.0
+
+
+def sqlite_fts_available() -> bool:
+    # trigram トークナイザは SQLite 3.34 から
+    return sqlite3.sqlite_version_info >= (3, 34, 0)
+
+
+def _backend():
+    vendor = connection.vendor
+    if vendor == "sqlite" and not sqlite_fts_available():
+        return None
+    return vendor if vendor in MIN_NGRAM else None
+
+
+def split_terms(q: str) -> List[str]:
+    """空白（全角も）区切りの語。全ての語を含むものを探す"""
+    terms = []
+    for term in (q or "").split():
+        term = term.replace('"', "")
+        if term and term not in terms:
+            terms.append(term)
+    return terms[:MAX_TERMS]
+
+
+def _split(terms) -> Tuple[str | None, List[str], List[str]]:
+    """(バックエンド, 索引で引く語, LIKE で確かめる語)"""
+    backend = _backend()
+    if backend is None:
+        return None, [], terms
+    n = MIN_NGRAM[backend]
+    return backend, [t for t in terms if len(t) >= n], [t for t in terms if len(t) < n]
+
+
+def _match_query(backend, terms) -> str:
+    # 語ごとにフレーズ扱い（演算子として解釈させない）にして全部を必須にする
+    if backend == "mysql":
+        return " ".join(f'+"{t}"' for t in terms)
+    return " ".join(f'"{t}"' for t in terms)
+
+
+def _like_q(terms) -> Q:
+    q = Q()
+    for term in terms:
+        q &= Q(title__icontains=term) | Q(memo__icontains=term)
+    return q
+
+
+def _like_param(term) -> str:
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def matches(q: str, *texts) -> bool:
+    """DB を通らないもの（繰り返し予定の展開した回など）を同じ条件で絞る"""
+    haystack = " ".join(t or "" for t in texts).casefold()
+    return all(term.casefold() in haystack for term in split_terms(q))
+
+
+def filter_queryset(qs, q: str):
+    """Schedule / PlanTask のクエリセットを全文検索で絞る（並び順はそのまま）"""
+    terms = split_terms(q)
+    if not terms:
+        return qs
+    backend, indexed, short = _split(terms)
+    if indexed:
+        table = qs.model._meta.db_table
+        query = _match_query(backend, indexed)
+        if backend == "mysql":
+            qs = qs.filter(RawSQL(
+                f"MATCH ({table}.title, {table}.memo) AGAINST (%s IN BOOLEAN MODE)", [query],
+                output_field=BooleanField(),
+            ))
+        else:
+            qs = qs.filter(id__in=RawSQL(f"SELECT rowid FROM {table}_fts WHERE {table}_fts MATCH %s", [query]))
+    if short:
+        qs = qs.filter(_like_q(short))
+    return qs
+
+
+def ranked(model, user, q: str, limit: int = SEARCH_LIMIT) -> list:
+    """
+    関連度の高い順に limit 件（インスタンスの .score が関連度。大きいほど良い）
+
+    MySQL は MATCH の値、SQLite は bm25（タイトル重め）。
+    索引の使えない短い語だけのときは新しい順で、score は None。
+    """
+    terms = split_terms(q)
+    if not terms:
+        return []
+    backend, indexed, short = _split(terms)
+    if not indexed:
+        rows = list(model.objects.filter(user=user).filter(_like_q(short)).order_by("-id")[:limit])
+        for row in rows:
+            row.score = None
+        return rows
+
+    table = model._meta.db_table
+    query = _match_query(backend, indexed)
+    # MySQL は既定でバックスラッシュがエスケープ文字（文字列リテラルの中でも特別扱いなので ESCAPE は書かない）
+    escape = "" if backend == "mysql" else " ESCAPE '\\'"
+    like_sql = "".join(f" AND (b.title LIKE %s{escape} OR b.memo LIKE %s{escape})" for _ in short)
+    like_params = [p for t in short for p in (_like_param(t), _like_param(t))]
+
+    if backend == "mysql":
+        sql = (
+            f"SELECT b.*, MATCH (b.title, b.memo) AGAINST (%s IN BOOLEAN MODE) AS score FROM {table} b "
+            f"WHERE b.user_id = %s AND MATCH (b.title, b.memo) AGAINST (%s IN BOOLEAN MODE){like_sql} "
+            "ORDER BY score DESC, b.id DESC LIMIT %s"
+        )
+        params = [query, user.id, query, *like_params, limit]
+    else:
+        fts = f"{table}_fts"
+        rank = f"bm25({fts}, {TITLE_WEIGHT}, {MEMO_WEIGHT})"
+        sql = (
+            f"SELECT b.*, -{rank} AS score FROM {fts} JOIN {table} b ON b.id = {fts}.rowid "
+            f"WHERE {fts} MATCH %s AND b.user_id = %s{like_sql} "
+            f"ORDER BY {rank}, b.id DESC LIMIT %s"
+        )
+        params = [query, user.id, *like_params, limit]
+    return list(model.objects.raw(sql, params))
+
+
+def search(user, q: str, limit: int = SEARCH_LIMIT) -> dict:
+    """予定とタスクを別々に関連度順で（表が違うとスコアを比べられないので混ぜない）"""
+    return {
+        "schedules": ranked(Schedule, user, q, limit),
+        "tasks": ranked(PlanTask, user, q, limit),
+    }
+
+
+# ===== 索引の作成（マイグレーションと rebuild_search_index から使う）=====
+
+def _sqlite_statements(table) -> List[str]:
+    fts = f"{table}_fts"
+    delete_old = f"INSERT INTO {fts}({fts}, rowid, title, memo) VALUES ('delete', old.id, old.title, old.memo);"
+    insert_new = f"INSERT INTO {fts}(rowid, title, memo) VALUES (new.id, new.title, new.memo);"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+        f"title, memo, content='{table}', content_rowid='id', tokenize='trigram')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN {insert_new} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN {delete_old} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF title, memo ON {table} "
+        f"BEGIN {delete_old} {insert_new} END",
+        # 既存の行から作り直す
+        f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+    ]
+
+
+def _mysql_index_name(table) -> str:
+    return f"{table.removeprefix('taskplanner_')}_fulltext"
+
+
+def install_index(conn=None) -> bool:
+    """索引を作る（作り直す）。対応していない DB なら False"""
+    conn = conn or connection
+    if conn.vendor == "sqlite" and sqlite_fts_available():
+        with conn.cursor() as cursor:
+            for model in INDEXED_MODELS:
+                for sql in _sqlite_statements(model._meta.db_table):
+                    cursor.execute(sql)
+        return True
+    if conn.vendor == "mysql":
+        with conn.cursor() as cursor:
+            for model in INDEXED_MODELS:
+                table = model._meta.db_table
+                name = _mysql_index_name(table)
+                if name not in conn.introspection.get_constraints(cursor, table):
+                    cursor.execute(f"ALTER TABLE {table} ADD FULLTEXT INDEX {name} (title, memo) WITH PARSER ngram")
+        return True
+    return False
+
+
+def uninstall_index(conn=None) -> None:
+    conn = conn or connection
+    with conn.cursor() as cursor:
+        for model in INDEXED_MODELS:
+            table = model._meta.db_table
+            if conn.vendor == "sqlite":
+                for suffix in ("ai", "ad", "au"):
+                    cursor.execute(f"DROP TRIGGER IF EXISTS {table}_fts_{suffix}")
+                cursor.execute(f"DROP TABLE IF EXISTS {table}_fts")
+            elif conn.vendor == "mysql":
+                name = _mysql_index_name(table)
+                if name in conn.introspection.get_constraints(cursor, table):
+                    cursor.execute(f"ALTER TABLE {table} DROP INDEX {name}")
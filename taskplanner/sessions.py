@@ -0,0 +1,221 @@
+"""
+セッションとログインユーザーのキャッシュ（ページ表示のたびのセッションと auth_user の SELECT を無くす）
+
+SessionStore（settings.SESSION_ENGINE = "taskplanner.sessions"）
+- 読み込みはキャッシュから。無ければ DB から読んでキャッシュに載せる
+- SESSION_WRITE_BEHIND_SECONDS > 0 なら write-behind：新しいセッション・ログイン状態のキー（_auth_user_id など）/
+  有効期限が変わったとき・DB への前回の書き込みからこの秒数を過ぎたときだけ DB にも書き、それ以外
+  （セッションに溢れたメッセージなど）はキャッシュだけに書いて印を付けておく。印のあるセッションは、
+  窓を過ぎてから読んだ/書いたときに DB へ書く。それより先にキャッシュから消えた、またはほかのインスタンスで
+  読まれた変更は失われる（キャッシュを共有していない本番では 0 にしておく）
+- キャッシュの保持は SESSION_CACHE_SECONDS まで。キャッシュがプロセス/インスタンス間で共有されていないと、
+  ほかで変えた内容（ログアウトなど）がこの秒数までずれるので短めにしておく
+
+ログインユーザー（middleware.CachedAuthenticationMiddleware から get_user / aget_user）
+- セッションのユーザー id で User をキャッシュから引く（SESSION_USER_CACHE_SECONDS まで）
+- セッションの検証（パスワードのハッシュとの照合）は毎回行う。合わなければ DB の User で確かめ直してから切る
+- User の保存/削除・ログアウトでキャッシュを消す（signals.py の forget_user）。消えるのはそのインスタンスの
+  キャッシュだけなので、ほかのインスタンスでパスワードを変えた/無効にしたユーザーの古いセッションは
+  SESSION_USER_CACHE_SECONDS まで通る
+"""
+from __future__ import annotations
+
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, load_backend
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.core.cache import caches
+from django.db import DatabaseError, router, transaction
+from django.utils.crypto import constant_time_compare
+
+KEY_PREFIX = "taskplanner.sessions"
+USER_KEY_PREFIX = "auth_user:"
+
+# 変わったら必ず DB にも書くキー（ほかのプロセスがキャッシュを持っていなくてもログイン状態が正しくなるように）
+WRITE_THROUGH_KEYS = (SESSION_KEY, BACKEND_SESSION_KEY, HASH_SESSION_KEY, "_session_expiry")
+
+
+def cache_seconds() -> int:
+    return getattr(settings, "SESSION_CACHE_SECONDS", 60)
+
+
+def write_behind_seconds() -> int:
+    return getattr(settings, "SESSION_WRITE_BEHIND_SECONDS", 0)
+
+
+def user_cache_seconds() -> int:
+    return getattr(settings, "SESSION_USER_CACHE_SECONDS", 10)
+
+
+def _cache():
+    return caches[settings.SESSION_CACHE_ALIAS]
+
+
+class SessionStore(CachedDBStore):
+    cache_key_prefix = KEY_PREFIX
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        # 読み込んだ時点の WRITE_THROUGH_KEYS の値（新しいセッションは None）
+        self._loaded_auth = None
+        # キャッシュにある DB への書き込みの状態 {"saved_at": 最後に DB に書いた時刻, "dirty": キャッシュだけに書いた変更がある}
+        self._db_state = None
+
+    def _cache_timeout(self, expiry_age) -> int:
+        return max(1, min(expiry_age, cache_seconds()))
+
+    @property
+    def _db_state_key(self):
+        return self.cache_key + ":db"
+
+    def _auth_state(self, data):
+        return tuple(data.get(k) for k in WRITE_THROUGH_KEYS)
+
+    def _window_passed(self) -> bool:
+        state = self._db_state
+        return state is None or time.time() - state["saved_at"] >= write_behind_seconds()
+
+    def _set_db_state(self, dirty: bool, timeout: int) -> None:
+        saved_at = self._db_state["saved_at"] if dirty and self._db_state else time.time()
+        self._db_state = {"saved_at": saved_at, "dirty": dirty}
+        self._cache.set(self._db_state_key, self._db_state, timeout)
+
+    def _write_db(self, data, timeout: int) -> bool:
+        """キャッシュだけに書いてあった data を DB に書く（load の中から。self._session は使えない）"""
+        obj = self.model(
+            session_key=self.session_key,
+            session_data=self.encode(data),
+            expire_date=self.get_expiry_date(expiry=data.get("_session_expiry")),
+        )
+        using = router.db_for_write(self.model, instance=obj)
+        try:
+            with transaction.atomic(using=using):
+                obj.save(force_update=True, using=using)
+        except DatabaseError:
+            # ほかで消された（ログアウトなど）。キャッシュも捨てて、このセッションは無かったことにする
+            self._cache.delete_many([self.cache_key, self._db_state_key])
+            return False
+        self._set_db_state(False, timeout)
+        return True
+
+    def load(self):
+        try:
+            found = self._cache.get_many([self.cache_key, self._db_state_key])
+        except Exception:
+            # memcached などは不正なキーで例外になる（cached_db と同じくセッションを作り直す）
+            found = {}
+        data = found.get(self.cache_key)
+        self._db_state = found.get(self._db_state_key)
+
+        if data is None:
+            # キャッシュから消えていれば、キャッシュだけに書いてあった変更も無い
+            self._db_state = None
+            s = self._get_session_from_db()
+            if s:
+                data = self.decode(s.session_data)
+                self._cache.set(self.cache_key, data, self._cache_timeout(self.get_expiry_age(expiry=s.expire_date)))
+            else:
+                data = {}
+        elif self._db_state and self._db_state["dirty"] and self._window_passed():
+            # キャッシュだけに書いた変更は、窓を過ぎたら次に読んだときに DB へ書く
+            expiry_age = self.get_expiry_age(expiry=data.get("_session_expiry"))
+            if not self._write_db(data, self._cache_timeout(expiry_age)):
+                data = {}
+        self._loaded_auth = self._auth_state(data)
+        return data
+
+    async def aload(self):
+        return await sync_to_async(self.load)()
+
+    def _needs_db_write(self) -> bool:
+        if write_behind_seconds() <= 0 or self._loaded_auth is None:
+            return True
+        if self._auth_state(self._session) != self._loaded_auth:
+            return True
+        return self._window_passed()
+
+    def save(self, must_create=False):
+        timeout = self._cache_timeout(self.get_expiry_age())
+        if must_create or self.session_key is None or self._needs_db_write():
+            DBStore.save(self, must_create)
+            self._set_db_state(False, timeout)
+            self._loaded_auth = self._auth_state(self._session)
+        else:
+            # DB はあとで（次に窓を過ぎてから読む/書くとき）。それまでに消えたキャッシュの変更は失われる
+            self._set_db_state(True, timeout)
+        self._cache.set(self.cache_key, self._session, timeout)
+
+    async def asave(self, must_create=False):
+        await sync_to_async(self.save)(must_create)
+
+
+# ===== ログインユーザー =====
+
+def _user_key(user_id) -> str:
+    return f"{USER_KEY_PREFIX}{user_id}"
+
+
+def forget_user(user_id) -> None:
+    _cache().delete(_user_key(user_id))
+
+
+def _cache_user(user) -> None:
+    _cache().set(_user_key(user.pk), user, user_cache_seconds())
+
+
+def _load_user(backend, user_id):
+    user = _cache().get(_user_key(user_id))
+    if user is None:
+        user = backend.get_user(user_id)
+        if user is not None:
+            _cache_user(user)
+    return user
+
+
+def _hash_matches(user, session_hash) -> bool:
+    return bool(session_hash) and constant_time_compare(session_hash, user.get_session_auth_hash())
+
+
+def get_user(request):
+    """
+    django.contrib.auth.get_user と同じ検証をするが、User はキャッシュから引く。
+    セッションのハッシュがキャッシュの User と合わないときは、切る前に DB の User で確かめ直す
+    （ほかのインスタンスでパスワードを変えた本人のセッションを、古いキャッシュのせいで切らないように）
+    """
+    user = None
+    session = request.session
+    try:
+        user_id = session[SESSION_KEY]
+        backend_path = session[BACKEND_SESSION_KEY]
+    except KeyError:
+        pass
+    else:
+        if backend_path in settings.AUTHENTICATION_BACKENDS:
+            backend = load_backend(backend_path)
+            user = _load_user(backend, user_id)
+            if hasattr(user, "get_session_auth_hash"):
+                session_hash = session.get(HASH_SESSION_KEY)
+                if not _hash_matches(user, session_hash):
+                    user = backend.get_user(user_id)
+                    if user is not None:
+                        _cache_user(user)
+                if hasattr(user, "get_session_auth_hash") and not _hash_matches(user, session_hash):
+                    # SECRET_KEY_FALLBACKS の古い鍵で作ったハッシュなら今の鍵で作り直す
+                    if session_hash and any(
+                        constant_time_compare(session_hash, fallback)
+                        for fallback in user.get_session_auth_fallback_hash()
+                    ):
+                        session.cycle_key()
+                        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+                    else:
+                        session.flush()
+                        user = None
+    return user or AnonymousUser()
+
+
+async def aget_user(request):
+    return await sync_to_async(get_user)(request)
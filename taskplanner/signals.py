@@ -0,0 +1,82 @@
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .ai_cache import CACHE_NAMESPACE as AI_PLAN_NAMESPACE
+from .caching import bump_user_version
+from .calendar_index import CACHE_NAMESPACE as CALENDAR_MONTH_NAMESPACE
+from .models import PlanJob, PlanSuggestion, PlanTask, Schedule, ScheduleSeries
+from .pagecache import SUGGESTIONS_NAMESPACE, TASKS_NAMESPACE
+from .recurrence import CACHE_NAMESPACE as SERIES_NAMESPACE
+from .sessions import forget_user
+
+
+@receiver(post_save, sender=PlanTask)
+@receiver(post_delete, sender=PlanTask)
+@receiver(post_save, sender=Schedule)
+@receiver(post_delete, sender=Schedule)
+@receiver(post_save, sender=ScheduleSeries)
+@receiver(post_delete, sender=ScheduleSeries)
+def invalidate_ai_plan_cache(sender, instance, **kwargs):
+    bump_user_version(instance.user_id, AI_PLAN_NAMESPACE)
+
+
+@receiver(post_save, sender=Schedule)
+@receiver(post_delete, sender=Schedule)
+@receiver(post_save, sender=ScheduleSeries)
+@receiver(post_delete, sender=ScheduleSeries)
+def invalidate_calendar_month_index(sender, instance, **kwargs):
+    bump_user_version(instance.user_id, CALENDAR_MONTH_NAMESPACE)
+
+
+@receiver(post_save, sender=ScheduleSeries)
+@receiver(post_delete, sender=ScheduleSeries)
+def invalidate_series_occurrences(sender, instance, **kwargs):
+    bump_user_version(instance.user_id, SERIES_NAMESPACE)
+
+
+@receiver(post_save, sender=PlanTask)
+@receiver(post_delete, sender=PlanTask)
+def invalidate_plan_task_pages(sender, instance, **kwargs):
+    bump_user_version(instance.user_id, TASKS_NAMESPACE)
+
+
+# 提案一覧の画面にはジョブの状態も出る（進捗の .update() はシグナルが飛ばないが、実行中の画面は 304 にしない）。
+# PlanSuggestion の削除には受け手を置かない（置くと .delete() が1件ずつ読んでから消すことになる）。
+# 消した側が suggestions_deleted / plan_bulk_changed を呼ぶ。タスクの削除で連鎖して消えた分はここで拾う
+@receiver(post_save, sender=PlanSuggestion)
+@receiver(post_save, sender=PlanJob)
+@receiver(post_delete, sender=PlanTask)
+def invalidate_plan_suggestion_pages(sender, instance, **kwargs):
+    bump_user_version(instance.user_id, SUGGESTIONS_NAMESPACE)
+
+
+def suggestions_deleted(user_id):
+    """PlanSuggestion を .delete() したあとに呼ぶ"""
+    bump_user_version(user_id, SUGGESTIONS_NAMESPACE)
+
+
+def schedules_bulk_changed(user_id):
+    """bulk_create/bulk_update はシグナルが飛ばないので、書いた側から呼ぶ"""
+    bump_user_version(user_id, AI_PLAN_NAMESPACE)
+    bump_user_version(user_id, CALENDAR_MONTH_NAMESPACE)
+
+
+def plan_bulk_changed(user_id):
+    """プラン生成で提案/タスクを bulk_* で書いたあとに呼ぶ"""
+    bump_user_version(user_id, TASKS_NAMESPACE)
+    bump_user_version(user_id, SUGGESTIONS_NAMESPACE)
+
+
+# ログイン中のユーザーのキャッシュ（ユーザー名/メール/パスワードの変更・管理画面での編集・ログアウト）
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    forget_user(instance.pk)
+
+
+@receiver(user_logged_out)
+def forget_logged_out_user(sender, request, user, **kwargs):
+    if user is not None:
+        forget_user(user.pk)
@@ -0,0 +1,162 @@
+"""
+コンテナ起動を速くする仕組み（entrypoint.sh の FAST_START）
+
+- migrate_if_needed：ディスク上のマイグレーションが全部 django_migrations に記録済みなら migrate を飛ばす
+  （migrate は毎回グラフの読み込み・システムチェック・post_migrate の権限作成まで流れて数秒かかる）
+- STARTUP_WARMUP：gunicorn の master（preload_app）でアプリを読み込むときに URL・テンプレート・google.genai の
+  import まで済ませてから fork する。Gemini のクライアントは接続を共有しないようにワーカーごとに作る
+- 各段階の秒数は startup_timings() に残し、ログ（taskplanner.startup）と /metrics に出す
+"""
+from __future__ import annotations
+
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import pkgutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List
+
+logger = logging.getLogger("taskplanner.startup")
+
+# 段階名 → 秒（master で測ったものは fork でワーカーに引き継がれる）
+_timings: Dict[str, float] = {}
+
+
+@contextmanager
+def phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _timings[name] = time.perf_counter() - started
+
+
+def startup_timings() -> Dict[str, float]:
+    return dict(_timings)
+
+
+def report(event: str = "startup") -> None:
+    """ここまでの段階ごとの秒数を1行の JSON でログに出す"""
+    timings = {name: round(seconds, 4) for name, seconds in _timings.items()}
+    logger.info(json.dumps(
+        {"event": event, "pid": os.getpid(), "phases": timings, "total": round(sum(timings.values()), 4)},
+        ensure_ascii=False,
+    ))
+
+
+# ===== マイグレーション =====
+
+def disk_migrations() -> List[str]:
+    """
+    ディスク上のマイグレーション（"app_label.name"）。モジュールは import しない（MigrationLoader と同じ探し方）
+    """
+    from django.apps import apps
+    from django.db.migrations.loader import MigrationLoader
+
+    names = []
+    for app_config in apps.get_app_configs():
+        module_name, _ = MigrationLoader.migrations_module(app_config.label)
+        if module_name is None:
+            continue
+        try:
+            spec = importlib.util.find_spec(module_name)
+        except ModuleNotFoundError:
+            continue
+        if spec is None or not spec.submodule_search_locations:
+            continue
+        names += [
+            f"{app_config.label}.{name}"
+            for _, name, is_pkg in pkgutil.iter_modules(spec.submodule_search_locations)
+            if not is_pkg and name[0] not in "_~"
+        ]
+    return sorted(names)
+
+
+def migration_state_hash(names) -> str:
+    return hashlib.sha256("\n".join(sorted(names)).encode()).hexdigest()[:16]
+
+
+def pending_migrations(connection=None) -> List[str]:
+    """ディスクにあって DB に記録の無いマイグレーション（表がまだ無ければ全部）"""
+    from django.db import connection as default_connection
+    from django.db.migrations.recorder import MigrationRecorder
+
+    recorder = MigrationRecorder(connection or default_connection)
+    if not recorder.has_table():
+        return disk_migrations()
+    applied = {f"{app}.{name}" for app, name in recorder.migration_qs.values_list("app", "name")}
+    return [name for name in disk_migrations() if name not in applied]
+
+
+# ===== アプリの読み込みと温め =====
+
+def load_application(factory):
+    """
+    myapp/wsgi.py・asgi.py から：get_wsgi_application などを計測しながら呼び、
+    STARTUP_WARMUP なら温めてから返す（gunicorn の preload_app なら master で1回だけ）
+    """
+    with phase("django_setup"):
+        application = factory()
+
+    from django.conf import settings
+
+    if getattr(settings, "STARTUP_WARMUP", False):
+        warm_up()
+    return application
+
+
+def _warm_urls() -> None:
+    from django.urls import get_resolver, reverse
+
+    # ビューの import と、reverse 用の表の作成まで
+    get_resolver().url_patterns
+    reverse("calendar")
+
+
+def _warm_templates() -> int:
+    """アプリのテンプレートを全部コンパイルしてキャッシュローダーに載せる"""
+    from django.apps import apps
+    from django.template.loader import get_template
+
+    root = Path(apps.get_app_config("taskplanner").path) / "templates"
+    names = sorted(p.relative_to(root).as_posix() for p in root.rglob("*.html"))
+    for name in names:
+        get_template(name)
+    return len(names)
+
+
+def _warm_ai_import() -> None:
+    # google.genai の import が重い（初回の plan_generate が払っていた分）
+    from . import ai_service  # noqa: F401
+
+
+def warm_up() -> None:
+    with phase("urls"):
+        _warm_urls()
+    with phase("templates"):
+        _warm_templates()
+    with phase("ai_import"):
+        _warm_ai_import()
+
+    # fork の前に閉じる（master の接続をワーカーが引き継いで共有しないように）
+    from django.db import connections
+
+    connections.close_all()
+    report("warmup")
+
+
+def warm_worker() -> None:
+    """fork したワーカーで、リクエストを受ける前に（gunicorn の post_worker_init から）"""
+    with phase("ai_client"):
+        from .ai_service import _get_client
+
+        try:
+            _get_client()
+        except Exception as e:
+            # キー未設定などは最初の呼び出しで改めてエラーになる（起動は止めない）
+            logger.warning("Gemini クライアントを作れませんでした: %s", e)
+    report("worker_ready")
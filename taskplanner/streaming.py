@@ -0,0 +1,35 @@
+"""
+大きいレスポンスのストリーミング（一覧の JSON・.ics の書き出し）
+
+ASGI では StreamingHttpResponse に渡した同期イテレータは sync_to_async(list) で全部読まれてから送られる。
+件数の多いストリーミングは、ASGI なら async イテレータ、WSGI なら同期イテレータを渡す。
+"""
+from __future__ import annotations
+
+from itertools import islice
+from typing import AsyncIterator
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+
+
+def is_asgi(request) -> bool:
+    return isinstance(request, ASGIRequest)
+
+
+async def aiter_queryset(queryset, chunk_size: int) -> AsyncIterator:
+    """
+    queryset.iterator(chunk_size) を chunk_size 件ずつスレッドで読みながら返す。
+    QuerySet.aiterator は values_list だと最初のクエリを async の文脈で投げてしまう（Django 5.2）ので使わない
+    """
+    rows = queryset.iterator(chunk_size=chunk_size)
+
+    def next_chunk():
+        return list(islice(rows, chunk_size))
+
+    while True:
+        chunk = await sync_to_async(next_chunk)()
+        for row in chunk:
+            yield row
+        if len(chunk) < chunk_size:
+            break
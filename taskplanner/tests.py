@@ -1,3 +1,1956 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib import messages
+from django.contrib.auth import SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import CommandError, call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import request_started
+from django.db import close_old_connections, connection
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import ai_cache, ai_service, batch, batch_worker, ics, jobs, metrics, plan_service, search, sessions, startup
+from .ai_fake import FakeGeminiClient
+from .ai_prompt import PlanPrompt, estimate_tokens
+from .ai_stream import JsonArrayParser
+from .benchdata import seed_user
+from .calendar_index import month_index
+from .dbpool.pool import ConnectionPool, PoolTimeout
+from .freebusy import FreeBusy
+from .jobs import run_pending_jobs
+from .models import PlanBatchRun, PlanJob, PlanSuggestion, PlanTask, PlanWorker, Schedule, ScheduleSeries
+from .plan_service import apply_plan, generate_plan
+from .planner import FreeSlotIndex, LocalPlanner
+from .recurrence import expand, occurrences_for
+
+
+@override_settings(PLAN_AI_POLISH=False)
+class PlanGenerateQueryBudgetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("planner", "planner@example.com", "pw")
+        self.client.force_login(self.user)
+        Schedule.objects.create(
+            user=self.user,
+            title="既存予定",
+            date=timezone.now() + timedelta(days=1),
+            duration_minutes=60,
+        )
+
+    def _add_tasks(self, n):
+        PlanTask.objects.bulk_create(
+            PlanTask(
+                user=self.user,
+                title=f"タスク{i}",
+                # 未定の所要時間は生成時に埋められる（bulk_update の対象）
+                estimated_minutes=None if i % 2 else 30,
+                deadline=timezone.now() + timedelta(days=1 + i % 10),
+            )
+            for i in range(n)
+        )
+
+    def _generate(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            generate_plan(self.user, full=True)
+        return len(ctx.captured_queries)
+
+    def test_query_count_is_constant(self):
+        self._add_tasks(3)
+        small = self._generate()
+
+        self._add_tasks(40)
+        large = self._generate()
+
+        self.assertEqual(small, large)
+        # 書く直前に提案/タスクをロックして読み直す2本と、全部作り直すときも読む今の提案の1本を含む
+        self.assertLessEqual(large, 11)
+        self.assertEqual(
+            PlanSuggestion.objects.filter(user=self.user).values("task").distinct().count(),
+            PlanTask.objects.filter(user=self.user).count(),
+        )
+        self.assertFalse(PlanTask.objects.filter(user=self.user, estimated_minutes__isnull=True).exists())
+
+
+@override_settings(PLAN_AI_POLISH=False)
+class IncrementalPlanTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("replan", "replan@example.com", "pw")
+        self.client.force_login(self.user)
+        self.tasks = PlanTask.objects.bulk_create(
+            PlanTask(user=self.user, title=f"タスク{i}", estimated_minutes=60, priority=2) for i in range(5)
+        )
+        generate_plan(self.user)
+        self.before = self._snapshot()
+
+    def _snapshot(self):
+        return {
+            s.id: (s.task_id, s.suggested_start, s.suggested_end)
+            for s in PlanSuggestion.objects.filter(user=self.user)
+        }
+
+    def test_unchanged_tasks_keep_their_suggestions(self):
+        changed = self.tasks[2]
+        changed.estimated_minutes = 120
+        changed.save()
+
+        outcome = generate_plan(self.user)
+
+        after = self._snapshot()
+        for sid, (task_id, start, end) in self.before.items():
+            if task_id != changed.id:
+                self.assertEqual(after[sid], (task_id, start, end))
+        blocks = [v for v in after.values() if v[0] == changed.id]
+        self.assertEqual(sum((e - s).total_seconds() for _, s, e in blocks), 120 * 60)
+        self.assertIn((messages.INFO, "変更の無い 4 件のタスクの提案はそのままにしました。"), outcome["messages"])
+        # order は全体の開始順で振り直されている
+        rows = list(PlanSuggestion.objects.filter(user=self.user).order_by("order"))
+        self.assertEqual([s.order for s in rows], list(range(1, len(rows) + 1)))
+        self.assertEqual(rows, sorted(rows, key=lambda s: (s.suggested_start, s.task_id)))
+
+    def test_new_and_deleted_tasks(self):
+        deleted_id = self.tasks[0].id
+        self.tasks[0].delete()
+        added = PlanTask.objects.create(user=self.user, title="追加", estimated_minutes=30)
+
+        generate_plan(self.user)
+
+        after = self._snapshot()
+        self.assertEqual(sorted({v[0] for v in after.values()}), sorted([t.id for t in self.tasks[1:]] + [added.id]))
+        for sid, value in self.before.items():
+            if value[0] != deleted_id:
+                self.assertEqual(after[sid], value)
+
+    def test_edited_suggestion_is_pinned(self):
+        suggestion = PlanSuggestion.objects.filter(user=self.user, task=self.tasks[1]).first()
+        start = suggestion.suggested_start + timedelta(days=1)
+        res = self.client.post(reverse("plan_suggestion_edit", args=[suggestion.id]), {
+            "task": suggestion.task_id,
+            "suggested_start": timezone.localtime(start).strftime("%Y-%m-%dT%H:%M"),
+            "suggested_end": timezone.localtime(start + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M"),
+            "order": suggestion.order,
+            "memo": "",
+        })
+        self.assertEqual(res.status_code, 302)
+        suggestion.refresh_from_db()
+        self.assertTrue(suggestion.user_edited)
+
+        # 内容を変えても、手で直した提案のタスクは動かさない
+        self.tasks[1].priority = 3
+        self.tasks[1].save()
+        generate_plan(self.user)
+
+        self.assertEqual(PlanSuggestion.objects.get(pk=suggestion.pk).suggested_start, suggestion.suggested_start)
+
+        # 「すべて作り直す」なら作り直す
+        generate_plan(self.user, full=True)
+        self.assertFalse(PlanSuggestion.objects.filter(pk=suggestion.pk).exists())
+        self.assertFalse(PlanSuggestion.objects.filter(user=self.user, user_edited=True).exists())
+
+    def _edit(self, task, **fields):
+        suggestion = PlanSuggestion.objects.filter(user=self.user, task=task).first()
+        for name, value in fields.items():
+            setattr(suggestion, name, value)
+        suggestion.user_edited = True
+        suggestion.save()
+        return suggestion
+
+    def _blocks(self, task):
+        return list(PlanSuggestion.objects.filter(user=self.user, task=task).order_by("suggested_start"))
+
+    def test_past_or_conflicting_edited_blocks_are_replanned(self):
+        now = timezone.now()
+        past = self._edit(self.tasks[1], suggested_start=now - timedelta(hours=2), suggested_end=now - timedelta(hours=1))
+        clash = self._edit(self.tasks[2])
+        Schedule.objects.create(user=self.user, title="割り込み", date=clash.suggested_start, duration_minutes=30)
+
+        outcome = generate_plan(self.user)
+
+        self.assertNotIn("変わったタスクが無い", outcome["messages"][0][1])
+        for task, old in ((self.tasks[1], past), (self.tasks[2], clash)):
+            blocks = self._blocks(task)
+            self.assertEqual(sum((b.suggested_end - b.suggested_start).total_seconds() for b in blocks), 60 * 60)
+            self.assertTrue(all(b.suggested_start >= now for b in blocks))
+            self.assertNotIn((old.suggested_start, old.suggested_end),
+                             [(b.suggested_start, b.suggested_end) for b in blocks])
+
+    def test_estimate_change_plans_only_what_edited_blocks_do_not_cover(self):
+        edited = self._edit(self.tasks[1])
+        self.tasks[1].estimated_minutes = 150
+        self.tasks[1].save()
+
+        generate_plan(self.user)
+
+        blocks = self._blocks(self.tasks[1])
+        self.assertIn(edited.pk, [b.pk for b in blocks])
+        self.assertEqual(PlanSuggestion.objects.get(pk=edited.pk).suggested_start, edited.suggested_start)
+        self.assertEqual(sum((b.suggested_end - b.suggested_start).total_seconds() for b in blocks), 150 * 60)
+
+        # 次は変わったタスクが無い
+        outcome = generate_plan(self.user)
+        self.assertIn("変わったタスクが無い", outcome["messages"][0][1])
+
+    def test_changes_made_while_planning_are_not_overwritten(self):
+        prepare = plan_service._prepare_plan
+        suggestion = PlanSuggestion.objects.filter(user=self.user, task=self.tasks[1]).first()
+
+        def edit():
+            self._edit(self.tasks[1], suggested_start=suggestion.suggested_start + timedelta(days=1))
+
+        def delete():
+            PlanSuggestion.objects.filter(user=self.user, task=self.tasks[2]).delete()
+
+        def reprioritize():
+            self.tasks[3].priority = 1
+            self.tasks[3].save()
+
+        for change in (edit, delete, reprioritize):
+            with self.subTest(change=change.__name__):
+                changed = {}
+
+                def prepare_then_change(user, full=False):
+                    # AIを待っている間に、別のタブで提案/タスクが変わった
+                    prepared = prepare(user, full)
+                    change()
+                    changed["suggestions"] = self._snapshot()
+                    return prepared
+
+                with mock.patch.object(plan_service, "_prepare_plan", side_effect=prepare_then_change):
+                    outcome = generate_plan(self.user, full=True)
+
+                self.assertEqual(self._snapshot(), changed["suggestions"])
+                self.assertEqual(outcome["created_count"], 0)
+                self.assertEqual(outcome["messages"][0][0], messages.WARNING)
+                self.assertIn("もう一度お試しください", outcome["messages"][0][1])
+
+                # 再実行すれば変わった内容から作り直す
+                outcome = generate_plan(self.user, full=True)
+                self.assertGreater(outcome["created_count"], 0)
+
+    def test_conflicting_suggestion_is_replanned(self):
+        sid, (task_id, start, end) = next(iter(self.before.items()))
+        Schedule.objects.create(user=self.user, title="割り込み", date=start, duration_minutes=30)
+
+        generate_plan(self.user)
+
+        moved = [v for v in self._snapshot().values() if v[0] == task_id]
+        self.assertTrue(moved)
+        self.assertTrue(all(s >= start + timedelta(minutes=30) or e <= start for _, s, e in moved))
+
+    @override_settings(PLAN_AI_POLISH=True)
+    def test_nothing_changed_skips_ai_and_writes(self):
+        with mock.patch.object(ai_service, "_get_client") as client, \
+                CaptureQueriesContext(connection) as ctx:
+            outcome = generate_plan(self.user)
+
+        client.assert_not_called()
+        self.assertEqual(outcome["created_count"], 0)
+        self.assertIn("変わったタスクが無い", outcome["messages"][0][1])
+        self.assertFalse([q for q in ctx.captured_queries if not q["sql"].lstrip().upper().startswith("SELECT")])
+        self.assertEqual(self._snapshot(), self.before)
+
+    def test_full_flag_reaches_the_job(self):
+        with override_settings(PLAN_JOBS_INLINE=False):
+            res = self.client.post(reverse("plan_generate"), {"full": "1"}, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertTrue(PlanJob.objects.get(pk=res.json()["id"]).full)
+
+
+class PlanAllUsersTests(TestCase):
+    def _user(self, name, tasks=2, **kwargs):
+        user = User.objects.create_user(name, f"{name}@example.com", "pw", **kwargs)
+        PlanTask.objects.bulk_create(
+            PlanTask(user=user, title=f"{name}のタスク{i}", estimated_minutes=60) for i in range(tasks)
+        )
+        return user
+
+    def _suggested_users(self):
+        return set(PlanSuggestion.objects.values_list("user__username", flat=True))
+
+    def test_plans_every_user_and_skips_active_jobs(self):
+        users = [self._user(f"u{i}") for i in range(5)]
+        self._user("no-tasks", tasks=0)
+        self._user("inactive", is_active=False)
+        PlanJob.objects.create(user=users[1])
+
+        out = io.StringIO()
+        call_command("plan_all_users", processes=0, chunk_size=2, active_days=0, stdout=out)
+
+        self.assertEqual(self._suggested_users(), {"u0", "u2", "u3", "u4"})
+        run = PlanBatchRun.objects.get()
+        self.assertIsNotNone(run.finished_at)
+        self.assertEqual((run.users_planned, run.users_skipped), (4, 1))
+        self.assertEqual(run.suggestions_written, 8)
+        self.assertIn("users/s", out.getvalue())
+
+        # 2回目は何も変わっていないので書かない
+        before = list(PlanSuggestion.objects.order_by("id").values_list("id", "suggested_start"))
+        call_command("plan_all_users", processes=0, active_days=0, stdout=io.StringIO())
+        self.assertEqual(list(PlanSuggestion.objects.order_by("id").values_list("id", "suggested_start")), before)
+        self.assertEqual(PlanBatchRun.objects.order_by("-id").first().suggestions_written, 0)
+
+    def test_active_days_filters_by_last_login(self):
+        self._user("recent", last_login=timezone.now() - timedelta(days=1))
+        self._user("dormant", last_login=timezone.now() - timedelta(days=90))
+        call_command("plan_all_users", processes=0, stdout=io.StringIO())
+        self.assertEqual(self._suggested_users(), {"recent"})
+
+    def test_resumes_after_crash(self):
+        users = [self._user(f"r{i}") for i in range(4)]
+        real_save = batch.save_chunk
+        calls = []
+
+        def crash_on_second_chunk(*args, **kwargs):
+            calls.append(args[1])
+            if len(calls) == 2:
+                raise RuntimeError("boom")
+            return real_save(*args, **kwargs)
+
+        with mock.patch.object(batch, "save_chunk", side_effect=crash_on_second_chunk):
+            with self.assertRaises(RuntimeError):
+                batch.run_batch(chunk_size=2, processes=0)
+        run = PlanBatchRun.objects.get()
+        self.assertIsNone(run.finished_at)
+        self.assertEqual(run.cursor, users[1].id)
+        self.assertEqual(self._suggested_users(), {"r0", "r1"})
+
+        with mock.patch.object(batch, "plan_user", wraps=batch.plan_user) as planned:
+            again = batch.run_batch(chunk_size=2, processes=0)
+        self.assertEqual(again.pk, run.pk)
+        self.assertEqual(sorted(c.args[0] for c in planned.call_args_list), [users[2].id, users[3].id])
+        self.assertEqual(again.users_planned, 4)
+        self.assertEqual(self._suggested_users(), {"r0", "r1", "r2", "r3"})
+
+    def test_user_changes_during_the_batch_win(self):
+        user = self._user("live")
+        generate_plan(user)
+        PlanTask.objects.filter(user=user).update(estimated_minutes=120)
+        edited = PlanSuggestion.objects.filter(user=user).first()
+
+        def edit_meanwhile(*args):
+            # 計画している間に本人が提案を直した
+            PlanSuggestion.objects.filter(pk=edited.pk).update(user_edited=True)
+            return batch_worker.plan_user(*args)
+
+        with mock.patch.object(batch, "plan_user", side_effect=edit_meanwhile):
+            run = batch.run_batch(processes=0)
+
+        self.assertEqual((run.users_planned, run.users_skipped), (0, 1))
+        self.assertEqual(run.cursor, user.id)
+        self.assertTrue(PlanSuggestion.objects.get(pk=edited.pk).user_edited)
+
+    def test_task_edits_during_the_batch_are_not_overwritten(self):
+        user = self._user("editing")
+        PlanTask.objects.filter(user=user).update(estimated_minutes=None)
+        task = PlanTask.objects.filter(user=user).first()
+
+        def edit_meanwhile(*args):
+            # 計画している間に本人が見積もり/優先度を直した（バッチは所要時間を書き戻そうとしている）
+            PlanTask.objects.filter(pk=task.pk).update(estimated_minutes=240, priority=1)
+            return batch_worker.plan_user(*args)
+
+        with mock.patch.object(batch, "plan_user", side_effect=edit_meanwhile):
+            run = batch.run_batch(processes=0, active_days=None)
+
+        self.assertEqual((run.users_planned, run.users_skipped), (0, 1))
+        task.refresh_from_db()
+        self.assertEqual((task.estimated_minutes, task.priority), (240, 1))
+        self.assertFalse(PlanSuggestion.objects.filter(user=user).exists())
+
+    def test_task_deleted_during_the_batch_skips_only_that_user(self):
+        gone = self._user("deleting")
+        other = self._user("other")
+        task = PlanTask.objects.filter(user=gone).first()
+
+        def delete_meanwhile(user_id, *args):
+            if user_id == gone.id:
+                task.delete()
+            return batch_worker.plan_user(user_id, *args)
+
+        with mock.patch.object(batch, "plan_user", side_effect=delete_meanwhile):
+            run = batch.run_batch(processes=0, active_days=None)
+
+        self.assertEqual((run.users_planned, run.users_skipped), (1, 1))
+        self.assertEqual(self._suggested_users(), {other.username})
+
+    def test_query_count_does_not_grow_with_chunk(self):
+        def count(n):
+            for i in range(n):
+                self._user(f"q{n}-{i}")
+            with CaptureQueriesContext(connection) as ctx:
+                batch.run_batch(processes=0, restart=True)
+            return len(ctx.captured_queries)
+
+        self.assertEqual(count(2), count(8))
+
+    def test_process_pool(self):
+        for i in range(3):
+            self._user(f"p{i}")
+        run = batch.run_batch(processes=2)
+        self.assertEqual(run.users_planned, 3)
+        self.assertEqual(self._suggested_users(), {"p0", "p1", "p2"})
+
+
+@override_settings(PLAN_AI_POLISH=False, PLAN_JOBS_INLINE=False)
+class PlanJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("jobs", "jobs@example.com", "pw")
+        self.client.force_login(self.user)
+        PlanTask.objects.create(user=self.user, title="レポート", estimated_minutes=60)
+
+    def test_generate_enqueues_and_worker_completes(self):
+        res = self.client.post(reverse("plan_generate"), HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(res.status_code, 202)
+        job = res.json()
+        self.assertEqual(job["status"], PlanJob.STATUS_QUEUED)
+        self.assertFalse(PlanSuggestion.objects.exists())
+
+        # 二重クリックしても同じジョブが返る
+        again = self.client.post(reverse("plan_generate"), HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(again.json()["id"], job["id"])
+
+        self.assertEqual(run_pending_jobs(), 1)
+
+        status = self.client.get(job["status_url"]).json()
+        self.assertTrue(status["finished"])
+        self.assertEqual(status["status"], PlanJob.STATUS_DONE)
+        self.assertEqual(PlanSuggestion.objects.filter(user=self.user).count(), 1)
+
+    def test_job_left_queued_without_a_worker_fails(self):
+        res = self.client.post(reverse("plan_generate"), HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        job = res.json()
+        self.assertFalse(self.client.get(job["status_url"]).json()["finished"])
+
+        # ワーカーが落ちていて誰も取り出さないまま時間が経った
+        PlanJob.objects.filter(pk=job["id"]).update(created_at=timezone.now() - jobs.QUEUED_TIMEOUT - timedelta(seconds=1))
+        status = self.client.get(job["status_url"]).json()
+        self.assertTrue(status["finished"])
+        self.assertEqual(status["status"], PlanJob.STATUS_FAILED)
+        self.assertEqual(PlanJob.objects.get(pk=job["id"]).result_messages[0][1], jobs.TIMEOUT_MESSAGE)
+
+        # 次のボタンでは新しいジョブが積まれる
+        again = self.client.post(reverse("plan_generate"), HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertNotEqual(again.json()["id"], job["id"])
+
+    def test_queued_job_waits_while_a_worker_is_alive(self):
+        old = timezone.now() - jobs.QUEUED_TIMEOUT - timedelta(seconds=1)
+        job = PlanJob.objects.create(user=self.user)
+        PlanJob.objects.filter(pk=job.pk).update(created_at=old)
+
+        # ワーカーは動いていて混んでいるだけ：画面からのポーリングでは失敗にしない
+        jobs.record_heartbeat("web-1:100")
+        status = self.client.get(reverse("plan_job_status", args=[job.pk])).json()
+        self.assertEqual(status["status"], PlanJob.STATUS_QUEUED)
+
+        # ワーカー自身が取り出すときも、古い待機中のジョブは失敗にせず処理する
+        PlanWorker.objects.update(last_seen=timezone.now() - jobs.WORKER_DEAD_AFTER - timedelta(seconds=1))
+        self.assertEqual(run_pending_jobs(), 1)
+        self.assertEqual(PlanJob.objects.get(pk=job.pk).status, PlanJob.STATUS_DONE)
+
+    def test_worker_records_heartbeat(self):
+        PlanWorker.objects.create(name="gone:1", last_seen=timezone.now() - timedelta(days=2))
+        with mock.patch("taskplanner.management.commands.run_plan_worker.run_pending_jobs", return_value=0):
+            call_command("run_plan_worker", once=True, stdout=io.StringIO())
+        self.assertEqual(PlanWorker.objects.count(), 1)
+        self.assertNotEqual(PlanWorker.objects.get().name, "gone:1")
+
+    @override_settings(PLAN_JOBS_INLINE=True)
+    def test_inline_double_click_generates_once(self):
+        started = []
+
+        async def slow_generate(user, full=False):
+            started.append(user.id)
+            await asyncio.sleep(0.2)
+            return {"created_count": 0, "used_ai": False, "messages": []}
+
+        async def double_click():
+            first = asyncio.ensure_future(jobs.aenqueue_plan_job(self.user))
+            await asyncio.sleep(0.05)
+            second = await jobs.aenqueue_plan_job(self.user)
+            return await first, second
+
+        with mock.patch.object(jobs, "agenerate_plan", side_effect=slow_generate):
+            first, second = async_to_sync(double_click)()
+
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(started, [self.user.id])
+        self.assertEqual(second.status, PlanJob.STATUS_RUNNING)
+        self.assertEqual(PlanJob.objects.get(pk=first.id).status, PlanJob.STATUS_DONE)
+
+    @override_settings(PLAN_JOBS_INLINE=True, PLAN_AI_POLISH=True, AI_PLAN_CACHE={"BACKEND": None})
+    def test_inline_generation_uses_async_client(self):
+        ai_service._breakers.clear()
+        self.addCleanup(ai_service._breakers.clear)
+        fake = FakeGeminiClient()
+        with mock.patch.object(ai_service, "_get_client", return_value=fake):
+            res = self.client.post(reverse("plan_generate"), HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+
+        self.assertEqual(res.json()["status"], PlanJob.STATUS_DONE)
+        self.assertEqual(fake.calls, [ai_service.MODEL_CANDIDATES[0]])
+        job = PlanJob.objects.get(pk=res.json()["id"])
+        self.assertIn("AIプラン", job.result_messages[-1][1])
+        self.assertEqual(PlanSuggestion.objects.filter(user=self.user).count(), 1)
+
+
+class LocalPlannerTests(TestCase):
+    # 2026-01-05 は月曜。availability を渡さなければ窓全体が空き
+    window_start = "2026-01-05T09:00:00+09:00"
+    window_end = "2026-01-12T09:00:00+09:00"
+    weekday_mornings = {
+        "timezone": "Asia/Tokyo",
+        "weekday": [{"start": "09:00", "end": "12:00"}],
+        "weekend": [],
+    }
+
+    def at(self, day, hour, minute=0):
+        return f"2026-01-{day:02d}T{hour:02d}:{minute:02d}:00+09:00"
+
+    def planner(self, tasks, events=(), availability=None, not_before=None):
+        return LocalPlanner(
+            tasks, list(events), availability or {}, self.window_start, self.window_end, not_before=not_before
+        )
+
+    def spans(self, items):
+        return [(r["id"], r["start_at"], r["end_at"]) for r in items]
+
+    def test_long_task_is_split_into_90_minute_blocks_with_breaks(self):
+        items = self.planner([{"id": 1, "estimated_minutes": 200}]).plan()
+        # 90分 → 10分休憩（開始は15分単位なので 10:45）→ 90分 → 20分
+        self.assertEqual(self.spans(items), [
+            (1, self.at(5, 9), self.at(5, 10, 30)),
+            (1, self.at(5, 10, 45), self.at(5, 12, 15)),
+            (1, self.at(5, 12, 30), self.at(5, 12, 50)),
+        ])
+
+    def test_deadline_comes_before_priority(self):
+        tasks = [
+            {"id": 1, "estimated_minutes": 30, "priority": 1},
+            {"id": 2, "estimated_minutes": 30, "priority": 3, "deadline": self.at(7, 18)},
+            {"id": 3, "estimated_minutes": 30, "priority": 3, "deadline": self.at(6, 18)},
+            {"id": 4, "estimated_minutes": 30, "priority": 1, "deadline": self.at(7, 18)},
+        ]
+        items = self.planner(tasks).plan()
+        self.assertEqual([r["id"] for r in items], [3, 4, 2, 1])
+
+    def test_desired_at_goes_to_the_nearest_free_slot(self):
+        tasks = [
+            {"id": 1, "estimated_minutes": 60, "desired_at": self.at(5, 15)},
+            {"id": 2, "estimated_minutes": 60, "desired_at": self.at(6, 13, 15)},
+            {"id": 3, "estimated_minutes": 30},
+        ]
+        events = [{"start": self.at(6, 13), "end": self.at(6, 14)}]
+        items = self.planner(tasks, events).plan()
+        self.assertEqual(self.spans(items), [
+            (3, self.at(5, 9), self.at(5, 9, 30)),
+            (1, self.at(5, 15), self.at(5, 16)),
+            # 13:15 の前に置くなら 12:00（75分差）、後ろなら 14:00（45分差）
+            (2, self.at(6, 14), self.at(6, 15)),
+        ])
+
+    def test_nothing_starts_before_not_before(self):
+        items = self.planner(
+            [{"id": 1, "estimated_minutes": 30}], not_before=self.at(5, 10, 7)
+        ).plan()
+        self.assertEqual(items[0]["start_at"], self.at(5, 10, 15))
+
+    def test_late_task_swaps_with_a_lower_priority_one(self):
+        tasks = [
+            # 締切に間に合わないので先頭に置かれ、優先度の高い2の締切をつぶしてしまう
+            {"id": 1, "estimated_minutes": 120, "priority": 3, "deadline": self.at(5, 9, 30)},
+            {"id": 2, "estimated_minutes": 60, "priority": 1, "deadline": self.at(5, 10, 30)},
+        ]
+        planner = self.planner(tasks)
+        planner._greedy()
+        self.assertTrue(planner._is_late(planner.tasks[1]))
+
+        items = self.planner(tasks).plan()
+        self.assertEqual(self.spans(items)[0], (2, self.at(5, 9), self.at(5, 10)))
+        self.assertEqual([r["id"] for r in items], [2, 1, 1])
+
+    def test_reserve_and_release_split_and_merge(self):
+        index = FreeSlotIndex([(0, 30), (20, 60), (60, 100), (200, 300)])
+        self.assertEqual(index.intervals(), [(0, 100), (200, 300)])
+
+        self.assertEqual(index.reserve(20, 50), (20, 50))
+        self.assertEqual(index.intervals(), [(0, 20), (50, 100), (200, 300)])
+        index.release(20, 50)
+        self.assertEqual(index.intervals(), [(0, 100), (200, 300)])
+
+        # 区間からはみ出した分は切り詰めて、実際に取った範囲を返す
+        self.assertEqual(index.reserve(90, 150), (90, 100))
+        self.assertEqual(index.intervals(), [(0, 90), (200, 300)])
+        index.release(90, 200)
+        self.assertEqual(index.intervals(), [(0, 300)])
+
+    def test_accepts_rejects_overlaps_and_slots_outside_availability(self):
+        events = [{"start": self.at(5, 10), "end": self.at(5, 11)}]
+        tasks = [{"id": 1, "estimated_minutes": 30}, {"id": 2, "estimated_minutes": 30}]
+        planner = self.planner(tasks, events, self.weekday_mornings)
+        items = planner.plan()
+        self.assertTrue(planner.accepts(items))
+
+        def item(task_id, start, end):
+            return {"id": task_id, "start_at": start, "end_at": end}
+
+        self.assertTrue(planner.accepts([
+            item(1, self.at(5, 11), self.at(5, 11, 30)),
+            item(2, self.at(6, 9), self.at(6, 9, 30)),
+        ]))
+        # 重なり
+        self.assertFalse(planner.accepts([
+            item(1, self.at(5, 9), self.at(5, 9, 30)),
+            item(2, self.at(5, 9, 15), self.at(5, 9, 45)),
+        ]))
+        # 既存予定と重なる / 作業可能時間の外 / 週末
+        for start, end in [
+            (self.at(5, 10, 30), self.at(5, 11)),
+            (self.at(5, 13), self.at(5, 13, 30)),
+            (self.at(10, 9), self.at(10, 9, 30)),
+        ]:
+            self.assertFalse(planner.accepts([item(1, start, end), item(2, self.at(6, 9), self.at(6, 9, 30))]))
+        # ローカル計画で置けたタスクを落としている
+        self.assertFalse(planner.accepts([item(1, self.at(5, 9), self.at(5, 9, 30))]))
+
+
+@override_settings(AI_PLAN_CACHE={"BACKEND": None})
+class AIDispatchTests(TestCase):
+    def setUp(self):
+        ai_service._breakers.clear()
+        ai_service._get_client.cache_clear()
+        ai_cache.get_backend.cache_clear()
+        self.addCleanup(ai_service._get_client.cache_clear)
+        self.addCleanup(ai_service._breakers.clear)
+        self.addCleanup(ai_cache.get_backend.cache_clear)
+
+    def _plan(self, client):
+        with mock.patch.object(ai_service, "_get_client", return_value=client):
+            return ai_service.ai_plan_tasks([], [], {}, "2026-01-01T09:00:00+09:00", "2026-01-15T09:00:00+09:00")
+
+    @override_settings(AI_HEDGE_DELAY_SECONDS=0.05)
+    def test_hedge_takes_first_valid_answer(self):
+        slow = ai_service.MODEL_CANDIDATES[0]
+        client = FakeGeminiClient(latency={slow: 1.0}, response='[{"id": 1, "order": 1}]')
+
+        started = time.monotonic()
+        self.assertEqual(self._plan(client), [{"id": 1, "order": 1}])
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertIn(ai_service.MODEL_CANDIDATES[1], client.calls)
+
+    @override_settings(AI_HEDGE_DELAY_SECONDS=-1, AI_BREAKER_FAILURES=2, AI_BREAKER_RESET_SECONDS=60)
+    def test_breaker_skips_model_after_failures(self):
+        down = ai_service.MODEL_CANDIDATES[0]
+        client = FakeGeminiClient(fail_models=[down], response="[]")
+
+        for _ in range(3):
+            self.assertEqual(self._plan(client), [])
+
+        self.assertEqual(client.calls.count(down), 2)
+        self.assertEqual(ai_service.get_breaker(down).state, ai_service.CircuitBreaker.OPEN)
+
+    @override_settings(AI_HEDGE_DELAY_SECONDS=0.05)
+    def test_async_hedge_cancels_the_slow_model(self):
+        slow = ai_service.MODEL_CANDIDATES[0]
+        client = FakeGeminiClient(latency={slow: 5.0}, response='[{"id": 1, "order": 1}]')
+
+        started = time.monotonic()
+        with mock.patch.object(ai_service, "_get_client", return_value=client):
+            result = async_to_sync(ai_service.ai_plan_tasks_async)(
+                [], [], {}, "2026-01-01T09:00:00+09:00", "2026-01-15T09:00:00+09:00"
+            )
+        self.assertEqual(result, [{"id": 1, "order": 1}])
+        self.assertLess(time.monotonic() - started, 1.0)
+        # 負けて打ち切られた側は失敗に数えない
+        self.assertEqual(ai_service.get_breaker(slow).failures, 0)
+        self.assertEqual(ai_service.get_breaker(slow).state, ai_service.CircuitBreaker.CLOSED)
+
+
+@override_settings(AI_PLAN_CACHE={"BACKEND": "memory", "TTL": 60, "MAX_ENTRIES": 8})
+class AIPlanCacheTests(TestCase):
+    def setUp(self):
+        ai_cache.get_backend.cache_clear()
+        self.addCleanup(ai_cache.get_backend.cache_clear)
+        self.user = User.objects.create_user("cache", "cache@example.com", "pw")
+        self.task = PlanTask.objects.create(user=self.user, title="読書", estimated_minutes=30)
+        self.client_fake = FakeGeminiClient(response='[{"id": 1, "order": 1}]')
+
+    def _plan(self, draft=None):
+        with mock.patch.object(ai_service, "_get_client", return_value=self.client_fake):
+            return ai_service.ai_plan_tasks(
+                [{"id": self.task.id, "title": self.task.title}],
+                [],
+                {},
+                "2026-01-01T09:00:00+09:00",
+                "2026-01-15T09:00:00+09:00",
+                draft=draft,
+                cache_user_id=self.user.id,
+            )
+
+    def test_repeat_hits_cache_until_user_data_changes(self):
+        self._plan()
+        self._plan()
+        self.assertEqual(len(self.client_fake.calls), 1)
+
+        # タスクが保存されるとユーザーの世代が進み、同じ入力でも呼び直す
+        self.task.save()
+        self._plan()
+        self.assertEqual(len(self.client_fake.calls), 2)
+
+    def test_draft_is_part_of_the_key(self):
+        # 下書きは not_before 以降の空きに詰めたものなので、時間が進めばずれて呼び直す
+        self._plan(draft=[{"id": self.task.id, "start_at": "2026-01-01T09:00:00+09:00"}])
+        self._plan(draft=[{"id": self.task.id, "start_at": "2026-01-01T09:00:00+09:00"}])
+        self.assertEqual(len(self.client_fake.calls), 1)
+        self._plan(draft=[{"id": self.task.id, "start_at": "2026-01-01T09:10:00+09:00"}])
+        self.assertEqual(len(self.client_fake.calls), 2)
+
+    def test_answer_starting_in_the_past_is_not_replayed(self):
+        start = timezone.now() + timedelta(minutes=5)
+        self.client_fake = FakeGeminiClient(response=json.dumps([{
+            "id": self.task.id,
+            "order": 1,
+            "start_at": start.isoformat(),
+            "end_at": (start + timedelta(minutes=30)).isoformat(),
+        }]))
+        self._plan()
+        self._plan()
+        self.assertEqual(len(self.client_fake.calls), 1)
+
+        with mock.patch("django.utils.timezone.now", return_value=start + timedelta(minutes=1)):
+            self._plan()
+        self.assertEqual(len(self.client_fake.calls), 2)
+
+    def test_memory_backend_evicts_least_recently_used(self):
+        backend = ai_cache.MemoryBackend(ttl=60, max_entries=2)
+        backend.set("a", 1)
+        backend.set("b", 2)
+        backend.get("a")
+        backend.set("c", 3)
+        self.assertEqual(backend.get("a"), 1)
+        self.assertIsNone(backend.get("b"))
+
+
+class PlanPromptTests(TestCase):
+    window_start = "2026-01-05T09:00:00+09:00"
+    window_end = "2026-01-19T09:00:00+09:00"
+
+    def _builder(self, n):
+        tasks = [
+            {"id": i, "title": f"タスク{i}", "memo": "メモ" * 200, "priority": 2, "estimated_minutes": 30}
+            for i in range(n)
+        ]
+        events = [
+            {"title": "A", "start": "2026-01-05T10:00:00+09:00", "end": "2026-01-05T11:00:00+09:00"},
+            {"title": "B", "start": "2026-01-05T10:30:00+09:00", "end": "2026-01-05T12:00:00+09:00"},
+        ]
+        return PlanPrompt(tasks, events, {}, self.window_start, self.window_end)
+
+    def test_events_are_merged_into_minute_offsets(self):
+        self.assertEqual(self._builder(1).busy, [[60, 180]])
+
+    def test_large_task_sets_are_split_within_budget(self):
+        builder = self._builder(80)
+        batches = builder.batches(budget=600)
+
+        self.assertGreater(len(batches), 1)
+        self.assertEqual(sum(len(tasks) for tasks, _ in batches), 80)
+        for tasks, memo_limit in batches:
+            self.assertLessEqual(estimate_tokens(builder.render(tasks, memo_limit)), 600)
+
+    def test_decode_restores_iso_datetimes(self):
+        item = self._builder(1).decode([{"id": 0, "order": 1, "s": 540, "e": 570, "est": 30}])[0]
+        self.assertEqual(item["start_at"], "2026-01-05T18:00:00+09:00")
+        self.assertEqual(item["end_at"], "2026-01-05T18:30:00+09:00")
+        self.assertEqual(item["estimated_minutes"], 30)
+
+
+class AIStreamTests(TestCase):
+    def test_parser_yields_each_element_as_it_closes(self):
+        parser = JsonArrayParser()
+        self.assertEqual(parser.feed('```json\n[{"id": 1, "memo": "a}, {b'), [])
+        self.assertEqual(parser.feed('"}, {"id"'), [{"id": 1, "memo": "a}, {b"}])
+        self.assertEqual(parser.feed(': 2}]\n```'), [{"id": 2}])
+        parser.close()
+
+    def test_parser_rejects_truncated_array(self):
+        parser = JsonArrayParser()
+        parser.feed('[{"id": 1}, {"id"')
+        with self.assertRaises(ValueError):
+            parser.close()
+
+    @override_settings(AI_PLAN_CACHE={"BACKEND": None}, AI_BREAKER_FAILURES=3)
+    def test_stream_decodes_items_from_fake_client(self):
+        ai_service._breakers.clear()
+        ai_cache.get_backend.cache_clear()
+        self.addCleanup(ai_cache.get_backend.cache_clear)
+        self.addCleanup(ai_service._breakers.clear)
+
+        draft = [
+            {"id": 1, "start_at": "2026-01-05T18:00:00+09:00", "end_at": "2026-01-05T18:30:00+09:00", "estimated_minutes": 30},
+            {"id": 2, "start_at": "2026-01-05T19:00:00+09:00", "end_at": "2026-01-05T20:00:00+09:00", "estimated_minutes": 60},
+        ]
+        client = FakeGeminiClient(fail_models=[ai_service.MODEL_CANDIDATES[0]])
+        with mock.patch.object(ai_service, "_get_client", return_value=client):
+            items = list(ai_service.ai_plan_tasks_stream(
+                [{"id": 1, "title": "a"}, {"id": 2, "title": "b"}],
+                [],
+                {},
+                "2026-01-05T09:00:00+09:00",
+                "2026-01-19T09:00:00+09:00",
+                draft=draft,
+            ))
+
+        self.assertEqual([(i["id"], i["start_at"], i["end_at"]) for i in items], [(d["id"], d["start_at"], d["end_at"]) for d in draft])
+
+
+class CalendarMonthIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("cal", "cal@example.com", "pw")
+        self.client.force_login(self.user)
+        jst = timezone.get_current_timezone()
+        for day, hour, priority, minutes in [(3, 10, 1, 90), (3, 23, 2, 30), (10, 8, 3, 60)]:
+            Schedule.objects.create(
+                user=self.user,
+                title="予定",
+                date=timezone.make_aware(datetime(2026, 2, day, hour, 30), jst),
+                priority=priority,
+                duration_minutes=minutes,
+            )
+
+    def test_one_query_per_month_then_cached(self):
+        # 日ごとの集計1 + 繰り返し予定1
+        with self.assertNumQueries(2):
+            index = month_index(self.user.id, 2026, 2)
+        self.assertEqual(index[3]["count"], 2)
+        self.assertEqual(index[3]["high"], 1)
+        self.assertEqual(index[3]["minutes"], 120)
+        self.assertEqual(index[10]["minutes"], 60)
+        self.assertNotIn(4, index)
+
+        with self.assertNumQueries(0):
+            month_index(self.user.id, 2026, 2)
+
+    def test_saving_a_schedule_invalidates_the_month(self):
+        month_index(self.user.id, 2026, 2)
+        Schedule.objects.filter(user=self.user).first().delete()
+        with self.assertNumQueries(2):
+            month_index(self.user.id, 2026, 2)
+
+    def test_calendar_view_renders_load(self):
+        res = self.client.get(reverse("calendar"), {"year": 2026, "month": 2, "day": 3})
+        self.assertContains(res, 'class="load-2"')
+
+
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("pc", "pc@example.com", "pw")
+        self.client.force_login(self.user)
+        self.jst = timezone.get_current_timezone()
+        Schedule.objects.create(
+            user=self.user,
+            title="歯医者",
+            date=timezone.make_aware(datetime(2026, 2, 3, 10, 0), self.jst),
+            duration_minutes=30,
+        )
+        self.calendar_url = reverse("calendar") + "?year=2026&month=2&day=3"
+
+    def test_unchanged_page_is_304_without_view_queries(self):
+        res = self.client.get(self.calendar_url)
+        self.assertContains(res, "歯医者")
+        self.assertIn("private", res["Cache-Control"])
+        etag = res["ETag"]
+
+        # ログイン確認（セッション + ユーザー）もキャッシュから引くので DB に行かない
+        with self.assertNumQueries(0):
+            res = self.client.get(self.calendar_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+
+        # 別の日は別の ETag
+        res = self.client.get(reverse("calendar") + "?year=2026&month=2&day=4", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+
+    def test_fragments_are_reused_until_data_changes(self):
+        self.client.get(self.calendar_url)
+        with self.assertNumQueries(0):
+            res = self.client.get(self.calendar_url)
+        self.assertContains(res, "歯医者")
+
+        old_etag = res["ETag"]
+        Schedule.objects.create(
+            user=self.user,
+            title="買い物",
+            date=timezone.make_aware(datetime(2026, 2, 3, 18, 0), self.jst),
+            duration_minutes=60,
+        )
+        res = self.client.get(self.calendar_url, HTTP_IF_NONE_MATCH=old_etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertContains(res, "買い物")
+        self.assertNotEqual(res["ETag"], old_etag)
+
+    def test_plan_pages_follow_task_and_suggestion_changes(self):
+        task = PlanTask.objects.create(user=self.user, title="資料作成", estimated_minutes=60)
+        etag = self.client.get(reverse("plan_task"))["ETag"]
+        self.assertEqual(self.client.get(reverse("plan_task"), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        task.title = "資料作成（改）"
+        task.save()
+        res = self.client.get(reverse("plan_task"), HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(res, "資料作成（改）")
+
+        res = self.client.get(reverse("plan_ai"))
+        etag = res["ETag"]
+        start = timezone.now() + timedelta(days=1)
+        suggestion = PlanSuggestion.objects.create(
+            user=self.user, task=task, suggested_start=start, suggested_end=start + timedelta(hours=1), order=1
+        )
+        res = self.client.get(reverse("plan_ai"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertContains(res, reverse("plan_suggestion_delete", args=[suggestion.id]))
+
+        etag = res["ETag"]
+        self.client.post(reverse("plan_suggestion_delete", args=[suggestion.id]))
+        res = self.client.get(reverse("plan_ai"), HTTP_IF_NONE_MATCH=etag)
+        self.assertNotContains(res, reverse("plan_suggestion_delete", args=[suggestion.id]))
+
+        # タスクを消すと提案も連鎖して消える（提案の削除にはシグナルの受け手が無い）
+        suggestion = PlanSuggestion.objects.create(
+            user=self.user, task=task, suggested_start=start, suggested_end=start + timedelta(hours=1), order=1
+        )
+        etag = self.client.get(reverse("plan_ai"))["ETag"]
+        task.delete()
+        res = self.client.get(reverse("plan_ai"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotContains(res, reverse("plan_suggestion_delete", args=[suggestion.id]))
+
+    def test_pending_messages_are_never_304(self):
+        etag = self.client.get(self.calendar_url)["ETag"]
+        self.client.post(reverse("settings_username"), {"username": "pc2"})
+
+        res = self.client.get(self.calendar_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertContains(res, "ユーザー名を変更しました。")
+        self.assertFalse(res.has_header("ETag"))
+
+        # 表示済みになったら元の版に戻る
+        self.assertEqual(self.client.get(self.calendar_url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+def explain_problems(sql):
+    """
+    1本のクエリの実行計画を見て、taskplanner のテーブルに対する
+    フルスキャン / ORDER BY のための一時ソートがあれば説明文の配列で返す。
+    """
+    problems = []
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            for row in cursor.fetchall():
+                detail = row[-1]
+                # 全文検索（FTS5）の MATCH は "SCAN ..._fts VIRTUAL TABLE INDEX 0:M..." と出るが索引で引いている
+                if detail.startswith("SCAN taskplanner_") and "VIRTUAL TABLE INDEX" not in detail:
+                    problems.append(detail)
+                elif "USE TEMP B-TREE FOR ORDER BY" in detail:
+                    problems.append(detail)
+        elif connection.vendor == "mysql":
+            cursor.execute("EXPLAIN " + sql)
+            cols = [c[0].lower() for c in cursor.description]
+            for values in cursor.fetchall():
+                row = dict(zip(cols, values))
+                table = row.get("table") or ""
+                if not table.startswith("taskplanner_"):
+                    continue
+                if row.get("type") == "ALL":
+                    problems.append(f"full scan on {table}")
+                if "Using filesort" in (row.get("extra") or ""):
+                    problems.append(f"filesort on {table}")
+    return problems
+
+
+@override_settings(PLAN_AI_POLISH=False, PLAN_JOBS_INLINE=True)
+class QueryPlanTests(TestCase):
+    """よく叩かれる画面のクエリがインデックスを使っているか（フルスキャン/ソートが出たら失敗）"""
+
+    @classmethod
+    def setUpTestData(cls):
+        jst = timezone.get_current_timezone()
+        base = timezone.make_aware(datetime(2026, 2, 1, 9, 0), jst)
+        cls.users = [
+            User.objects.create_user(f"explain{n}", f"explain{n}@example.com", "pw") for n in range(3)
+        ]
+        for user in cls.users:
+            Schedule.objects.bulk_create(
+                Schedule(
+                    user=user,
+                    title=f"予定{i}",
+                    date=base + timedelta(hours=7 * i),
+                    end_at=base + timedelta(hours=7 * i, minutes=60),
+                    priority=1 + i % 3,
+                )
+                for i in range(200)
+            )
+            tasks = PlanTask.objects.bulk_create(
+                PlanTask(user=user, title=f"タスク{i}", estimated_minutes=30) for i in range(30)
+            )
+            PlanSuggestion.objects.bulk_create(
+                PlanSuggestion(
+                    user=user,
+                    task=t,
+                    suggested_start=base + timedelta(hours=i),
+                    suggested_end=base + timedelta(hours=i, minutes=30),
+                    order=30 - i,
+                )
+                for i, t in enumerate(tasks)
+            )
+        cls.user = cls.users[0]
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def assertIndexedQueries(self, request):
+        with CaptureQueriesContext(connection) as ctx:
+            res = request()
+        self.assertLess(res.status_code, 400)
+
+        checked = 0
+        for q in ctx.captured_queries:
+            sql = q["sql"]
+            if not sql.startswith("SELECT") or "taskplanner_" not in sql:
+                continue
+            checked += 1
+            problems = explain_problems(sql)
+            self.assertEqual(problems, [], sql)
+        self.assertGreater(checked, 0)
+
+    def test_calendar(self):
+        self.assertIndexedQueries(
+            lambda: self.client.get(reverse("calendar"), {"year": 2026, "month": 2, "day": 10})
+        )
+
+    def test_schedule_list(self):
+        self.assertIndexedQueries(lambda: self.client.get(reverse("schedule_list")))
+        self.assertIndexedQueries(
+            lambda: self.client.get(
+                reverse("schedule_list"), {"q": "予定1", "priority": "1", "from": "2026-02-01", "to": "2026-02-20"}
+            )
+        )
+
+    def test_schedule_list_next_page(self):
+        first = self.client.get(reverse("schedule_list"))
+        self.assertIndexedQueries(lambda: self.client.get(first.context["next_url"]))
+
+    def test_freebusy(self):
+        self.assertIndexedQueries(lambda: self.client.get(reverse("freebusy"), {"start": "2026-02-10", "days": 7}))
+
+    def test_plan_task(self):
+        self.assertIndexedQueries(lambda: self.client.get(reverse("plan_task")))
+
+    def test_plan_ai(self):
+        self.assertIndexedQueries(lambda: self.client.get(reverse("plan_ai")))
+
+    def test_plan_generate(self):
+        self.assertIndexedQueries(lambda: self.client.post(reverse("plan_generate")))
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("finder", "finder@example.com", "pw")
+        self.other = User.objects.create_user("other", "other@example.com", "pw")
+        self.client.force_login(self.user)
+        self.when = timezone.now() + timedelta(days=1)
+
+    def _schedule(self, title, memo="", user=None):
+        return Schedule.objects.create(user=user or self.user, title=title, memo=memo, date=self.when)
+
+    def _titles(self, q):
+        return [s.title for s in search.ranked(Schedule, self.user, q)]
+
+    def test_title_and_memo_substrings_ranked_by_relevance(self):
+        self._schedule("定例ミーティング")
+        self._schedule("歯医者", memo="帰りに定例ミーティングの資料を印刷")
+        self._schedule("買い物")
+        self._schedule("定例ミーティング", user=self.other)
+
+        # タイトルの一致がメモの一致より上
+        self.assertEqual(self._titles("ミーティング"), ["定例ミーティング", "歯医者"])
+        # 空白区切りは全てを含むもの
+        self.assertEqual(self._titles("ミーティング 資料"), ["歯医者"])
+
+    def test_short_terms_fall_back_to_like(self):
+        self._schedule("会議", memo="A社")
+        self._schedule("会議室の予約")
+        self._schedule("休み")
+
+        self.assertCountEqual(self._titles("会議"), ["会議", "会議室の予約"])
+        self.assertEqual(self._titles("会議 a社"), ["会議"])
+        self.assertEqual(self._titles("会議室 予約"), ["会議室の予約"])
+
+    def test_index_follows_saves_deletes_and_bulk_writes(self):
+        s = self._schedule("ジムで筋トレ")
+        self.assertEqual(self._titles("筋トレ"), ["ジムで筋トレ"])
+
+        s.title = "ジムでストレッチ"
+        s.save()
+        self.assertEqual(self._titles("筋トレ"), [])
+        self.assertEqual(self._titles("ストレッチ"), ["ジムでストレッチ"])
+
+        Schedule.objects.filter(pk=s.pk).update(memo="肩のストレッチ")
+        Schedule.objects.bulk_create([Schedule(user=self.user, title="朝ストレッチ", date=self.when, end_at=self.when)])
+        self.assertCountEqual(self._titles("ストレッチ"), ["ジムでストレッチ", "朝ストレッチ"])
+
+        s.delete()
+        self.assertEqual(self._titles("ストレッチ"), ["朝ストレッチ"])
+
+    def test_schedule_list_searches_memo(self):
+        self._schedule("通院", memo="保険証を持っていく")
+        self._schedule("保険の見直し")
+        res = self.client.get(reverse("schedule_list"), {"q": "保険証"})
+        self.assertEqual([s.title for s in res.context["schedules"]], ["通院"])
+
+    def test_search_view_returns_schedules_and_tasks(self):
+        self._schedule("読書会")
+        PlanTask.objects.create(user=self.user, title="読書感想文", memo="")
+        res = self.client.get(reverse("search"), {"q": "読書"}, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        body = res.json()
+        self.assertEqual([s["title"] for s in body["schedules"]], ["読書会"])
+        self.assertEqual([t["title"] for t in body["tasks"]], ["読書感想文"])
+
+
+class ScheduleListPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("lister", "lister@example.com", "pw")
+        self.client.force_login(self.user)
+        jst = timezone.get_current_timezone()
+        base = timezone.make_aware(datetime(2026, 3, 1, 9, 0), jst)
+        # 同じ時刻の予定も混ぜる（id で順番が決まること）
+        Schedule.objects.bulk_create(
+            Schedule(
+                user=self.user,
+                title=f"予定{i}",
+                date=base + timedelta(days=i // 3),
+                end_at=base + timedelta(days=i // 3, hours=1),
+                priority=1 + i % 3,
+            )
+            for i in range(120)
+        )
+
+    def test_pages_cover_everything_once(self):
+        seen = []
+        url = reverse("schedule_list")
+        while url:
+            res = self.client.get(url)
+            page = res.context["schedules"]
+            self.assertLessEqual(len(page), 50)
+            seen.extend(s.id for s in page)
+            url = res.context["next_url"]
+
+        expected = list(Schedule.objects.filter(user=self.user).order_by("-date", "-id").values_list("id", flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_next_page_keeps_filters(self):
+        res = self.client.get(reverse("schedule_list"), {"priority": "1"})
+        self.assertIsNone(res.context["next_url"])
+        self.assertTrue(all(s.priority == 1 for s in res.context["schedules"]))
+
+    def test_broken_cursor_starts_from_top(self):
+        res = self.client.get(reverse("schedule_list"), {"cursor": "!!"})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.context["schedules"]), 50)
+
+    def test_json_stream_uses_same_filters(self):
+        res = self.client.get(reverse("schedule_list_json"), {"priority": "2", "from": "2026-03-05"})
+        self.assertTrue(res.streaming)
+        rows = json.loads(b"".join(res.streaming_content))
+        expected = Schedule.objects.filter(
+            user=self.user, priority=2, date__gte=timezone.make_aware(datetime(2026, 3, 5))
+        ).count()
+        self.assertEqual(len(rows), expected)
+        self.assertEqual(rows[0]["title"], "予定118")
+
+
+class ScheduleDurationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("dur", "dur@example.com", "pw")
+        self.client.force_login(self.user)
+
+    def test_form_stores_total_minutes_and_end_at(self):
+        res = self.client.post(reverse("schedule_create"), {
+            "title": "会議",
+            "date": "2026-04-01T10:00",
+            "priority": "2",
+            "memo": "",
+            "duration_hours": "1",
+            "duration_minutes": "30",
+        })
+        self.assertEqual(res.status_code, 302)
+        s = Schedule.objects.get(user=self.user)
+        self.assertEqual(s.duration_minutes, 90)
+        self.assertEqual(s.end_at - s.date, timedelta(minutes=90))
+        self.assertEqual(s.get_duration_display(), "1時間30分")
+
+    def test_update_fields_keeps_end_at_in_sync(self):
+        s = Schedule.objects.create(user=self.user, title="a", date=timezone.now(), duration_minutes=30)
+        s.duration_minutes = 45
+        s.save(update_fields=["duration_minutes"])
+        s.refresh_from_db()
+        self.assertEqual(s.end_at - s.date, timedelta(minutes=45))
+
+    def test_legacy_duration_parser(self):
+        from importlib import import_module
+
+        backfill = import_module("taskplanner.migrations.0014_backfill_schedule_duration")
+        self.assertEqual(backfill.parse_legacy_duration("90"), 90)
+        self.assertEqual(backfill.parse_legacy_duration("1時間30分"), 90)
+        self.assertEqual(backfill.parse_legacy_duration("2時間"), 120)
+        self.assertEqual(backfill.parse_legacy_duration("45分"), 45)
+        self.assertIsNone(backfill.parse_legacy_duration("そのうち"))
+        self.assertIsNone(backfill.parse_legacy_duration(""))
+
+
+class FreeBusyTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("fb", "fb@example.com", "pw")
+        self.client.force_login(self.user)
+        self.jst = timezone.get_current_timezone()
+        # 前日 23:30〜0:30 の予定は当日に食い込む。10:00-11:00 と 10:30-12:00 は結合される
+        for day, hour, minute, minutes in [(1, 23, 30, 60), (2, 10, 0, 60), (2, 10, 30, 90), (2, 15, 0, 30)]:
+            Schedule.objects.create(
+                user=self.user,
+                title=f"予定{day}-{hour}",
+                date=self.at(day, hour, minute),
+                duration_minutes=minutes,
+            )
+
+    def at(self, day, hour, minute=0):
+        return timezone.make_aware(datetime(2026, 5, day, hour, minute), self.jst)
+
+    def test_busy_is_merged_and_free_is_complement(self):
+        # 予定1 + 繰り返し予定1（以降は展開結果がキャッシュされる）
+        with self.assertNumQueries(2):
+            fb = FreeBusy.for_user(self.user, self.at(2, 0), self.at(3, 0))
+        self.assertEqual(fb.busy, [
+            (self.at(2, 0), self.at(2, 0, 30)),
+            (self.at(2, 10), self.at(2, 12)),
+            (self.at(2, 15), self.at(2, 15, 30)),
+        ])
+        self.assertEqual(fb.free[0], (self.at(2, 0, 30), self.at(2, 10)))
+        self.assertEqual(fb.free[-1], (self.at(2, 15, 30), self.at(3, 0)))
+
+        self.assertTrue(fb.conflicts(self.at(2, 11, 45), self.at(2, 12, 15)))
+        self.assertTrue(fb.conflicts(self.at(2, 9), self.at(2, 16)))
+        self.assertFalse(fb.conflicts(self.at(2, 12), self.at(2, 15)))
+
+    def test_schedule_form_rejects_overlap(self):
+        res = self.client.post(reverse("schedule_create"), {
+            "title": "重なる予定",
+            "date": "2026-05-02T11:30",
+            "priority": "2",
+            "memo": "",
+            "duration_hours": "0",
+            "duration_minutes": "30",
+        })
+        self.assertEqual(res.status_code, 200)
+        self.assertContains(res, "時間が重なっています")
+        self.assertFalse(Schedule.objects.filter(title="重なる予定").exists())
+
+    def test_editing_a_schedule_ignores_itself(self):
+        s = Schedule.objects.get(date=self.at(2, 15))
+        res = self.client.post(reverse("schedule_edit", args=[s.id]), {
+            "title": "延長",
+            "date": "2026-05-02T15:00",
+            "priority": "2",
+            "memo": "",
+            "duration_hours": "1",
+            "duration_minutes": "15",
+        })
+        self.assertEqual(res.status_code, 302)
+
+    def test_plan_apply_skips_conflicting_suggestions(self):
+        task = PlanTask.objects.create(user=self.user, title="作業", estimated_minutes=30)
+        for h in (11, 13):
+            PlanSuggestion.objects.create(
+                user=self.user, task=task, suggested_start=self.at(2, h), suggested_end=self.at(2, h, 30), order=h
+            )
+        report = self.client.post(reverse("plan_apply"), HTTP_X_REQUESTED_WITH="XMLHttpRequest").json()
+        self.assertEqual(report["created_count"], 1)
+        self.assertEqual(report["conflicts"][0]["with"], ["予定2-10"])
+        self.assertEqual(Schedule.objects.filter(user=self.user, title="作業").count(), 1)
+        self.assertTrue(Schedule.objects.filter(user=self.user, title="作業", date=self.at(2, 13)).exists())
+
+    def test_endpoint(self):
+        data = self.client.get(reverse("freebusy"), {"start": "2026-05-02", "days": 1}).json()
+        self.assertEqual(len(data["busy"]), 3)
+        self.assertEqual(data["busy"][1], [self.at(2, 10).isoformat(), self.at(2, 12).isoformat()])
+
+
+class PlanApplyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("apply", "apply@example.com", "pw")
+        self.client.force_login(self.user)
+        jst = timezone.get_current_timezone()
+        self.base = timezone.make_aware(datetime(2026, 6, 1, 9, 0), jst)
+
+    def _suggest(self, n):
+        tasks = PlanTask.objects.bulk_create(
+            PlanTask(user=self.user, title=f"タスク{i}", estimated_minutes=30) for i in range(n)
+        )
+        PlanSuggestion.objects.bulk_create(
+            PlanSuggestion(
+                user=self.user,
+                task=t,
+                suggested_start=self.base + timedelta(hours=i),
+                suggested_end=self.base + timedelta(hours=i, minutes=30),
+                order=i,
+            )
+            for i, t in enumerate(tasks)
+        )
+
+    def test_bulk_apply_query_budget(self):
+        self._suggest(200)
+        with CaptureQueriesContext(connection) as ctx:
+            outcome = apply_plan(self.user, token="t1")
+        self.assertEqual(outcome["created_count"], 200)
+        # SAVEPOINT/RELEASE は数えない（SQLite の変数上限で bulk_create は2回に分かれる）
+        statements = [q for q in ctx.captured_queries if "SAVEPOINT" not in q["sql"]]
+        self.assertLessEqual(len(statements), 8)
+        self.assertEqual(Schedule.objects.filter(user=self.user).count(), 200)
+
+    def test_replay_with_same_token_does_nothing(self):
+        self._suggest(3)
+        self.client.post(reverse("plan_apply"), {"apply_token": "abc"})
+        res = self.client.post(reverse("plan_apply"), {"apply_token": "abc"}, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertTrue(res.json()["replayed"])
+        self.assertEqual(Schedule.objects.filter(user=self.user).count(), 3)
+
+    def test_missing_token_falls_back_to_plan_fingerprint(self):
+        self._suggest(2)
+        apply_plan(self.user)
+        self.assertTrue(apply_plan(self.user)["replayed"])
+        self.assertEqual(Schedule.objects.filter(user=self.user).count(), 2)
+
+    def test_apply_invalidates_month_index(self):
+        month_index(self.user.id, 2026, 6)
+        self._suggest(2)
+        apply_plan(self.user, token="t2")
+        self.assertEqual(month_index(self.user.id, 2026, 6)[1]["count"], 2)
+
+
+class RecurrenceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("rec", "rec@example.com", "pw")
+        self.client.force_login(self.user)
+        self.jst = timezone.get_current_timezone()
+
+    def at(self, y, m, d, hh=0, mm=0):
+        return timezone.make_aware(datetime(y, m, d, hh, mm), self.jst)
+
+    def series(self, **kwargs):
+        values = {"user": self.user, "title": "授業", "dtstart": self.at(2026, 4, 6, 10), "duration_minutes": 90}
+        values.update(kwargs)
+        return ScheduleSeries.objects.create(**values)
+
+    def test_weekly_weekdays_count_and_exdates(self):
+        # 2026/4/6 は月曜。月・水の週2回を5回、4/8 は休み
+        s = self.series(freq="weekly", byweekday="0,2", count=5, exdates=["2026-04-08"])
+        days = [o.date.astimezone(self.jst).day for o in expand(s, self.at(2026, 4, 1), self.at(2026, 5, 1))]
+        self.assertEqual(days, [6, 13, 15, 20])
+
+    def test_monthly_skips_short_months(self):
+        s = self.series(freq="monthly", dtstart=self.at(2026, 1, 31, 9))
+        months = [o.date.month for o in expand(s, self.at(2026, 1, 1), self.at(2026, 6, 1))]
+        self.assertEqual(months, [1, 3, 5])
+
+    def test_open_ended_series_expands_only_the_window(self):
+        s = self.series(freq="daily", dtstart=self.at(2000, 1, 1, 23, 30), duration_minutes=60)
+        occ = list(expand(s, self.at(2026, 4, 10), self.at(2026, 4, 11)))
+        # 前日 23:30 開始の回は当日に食い込むので含まれる
+        self.assertEqual([o.date for o in occ], [self.at(2026, 4, 9, 23, 30), self.at(2026, 4, 10, 23, 30)])
+
+    def test_until(self):
+        s = self.series(freq="weekly", until=self.at(2026, 4, 20, 10))
+        self.assertEqual(len(list(expand(s, self.at(2026, 4, 1), self.at(2026, 6, 1)))), 3)
+
+    def test_window_cache_is_invalidated_on_save(self):
+        s = self.series(freq="weekly")
+        start, end = self.at(2026, 4, 1), self.at(2026, 5, 1)
+        self.assertEqual(len(occurrences_for(self.user.id, start, end)), 4)
+        with self.assertNumQueries(0):
+            occurrences_for(self.user.id, start, end)
+        s.exdates = ["2026-04-13"]
+        s.save()
+        self.assertEqual(len(occurrences_for(self.user.id, start, end)), 3)
+
+    def test_occurrences_show_up_and_block_time(self):
+        self.series(freq="weekly")
+        res = self.client.get(reverse("calendar"), {"year": 2026, "month": 4, "day": 13})
+        self.assertContains(res, "授業")
+        self.assertEqual(res.context["weeks"][2][1]["load"]["count"], 1)
+
+        self.assertTrue(FreeBusy.for_user(self.user, self.at(2026, 4, 13), self.at(2026, 4, 14)).conflicts(
+            self.at(2026, 4, 13, 11), self.at(2026, 4, 13, 12)
+        ))
+        res = self.client.post(reverse("schedule_create"), {
+            "title": "重なる", "date": "2026-04-20T11:00", "priority": "2", "memo": "",
+            "duration_hours": "1", "duration_minutes": "30",
+        })
+        self.assertContains(res, "時間が重なっています")
+
+    def test_skip_one_occurrence(self):
+        s = self.series(freq="weekly")
+        self.client.post(reverse("series_skip", args=[s.id]), {"date": "2026-04-13"})
+        s.refresh_from_db()
+        self.assertEqual(s.exdates, ["2026-04-13"])
+        res = self.client.get(reverse("calendar"), {"year": 2026, "month": 4, "day": 13})
+        self.assertNotContains(res, "授業")
+
+    def test_series_form(self):
+        res = self.client.post(reverse("series_create"), {
+            "title": "ゼミ", "dtstart": "2026-04-07T13:00", "freq": "weekly", "interval": "2",
+            "weekdays": ["1", "3"], "count": "", "until": "", "priority": "1", "memo": "",
+            "duration_hours": "1", "duration_minutes": "30", "exdates_text": "2026-04-09\n",
+        })
+        self.assertEqual(res.status_code, 302)
+        s = ScheduleSeries.objects.get(title="ゼミ")
+        self.assertEqual((s.byweekday, s.duration_minutes, s.exdates), ("1,3", 90, ["2026-04-09"]))
+
+
+SAMPLE_ICS = (
+    "BEGIN:VCALENDAR\r\n"
+    "VERSION:2.0\r\n"
+    "BEGIN:VEVENT\r\n"
+    "UID:a@example.com\r\n"
+    "DTSTART;TZID=Asia/Tokyo:20260701T100000\r\n"
+    "DTEND;TZID=Asia/Tokyo:20260701T113000\r\n"
+    "SUMMARY:定例\\, 週次\r\n"
+    "DESCRIPTION:1行目\\n2行目\r\n"
+    "PRIORITY:1\r\n"
+    "BEGIN:VALARM\r\n"
+    "DESCRIPTION:通知\r\n"
+    "END:VALARM\r\n"
+    "END:VEVENT\r\n"
+    "BEGIN:VEVENT\r\n"
+    "UID:b@example.com\r\n"
+    "DTSTART:20260702T010000Z\r\n"
+    "DURATION:PT45M\r\n"
+    "SUMMARY:とても長いタイトルの予定なので折り返されても日本語が壊れないことを確認し\r\n"
+    " ます\r\n"
+    "END:VEVENT\r\n"
+    "BEGIN:VEVENT\r\n"
+    "UID:c@example.com\r\n"
+    "DTSTART;VALUE=DATE:20260703\r\n"
+    "SUMMARY:終日\r\n"
+    "END:VEVENT\r\n"
+    "BEGIN:VEVENT\r\n"
+    "UID:d@example.com\r\n"
+    "SUMMARY:開始日時なし\r\n"
+    "END:VEVENT\r\n"
+    "END:VCALENDAR\r\n"
+)
+
+
+class ICSTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("ics", "ics@example.com", "pw")
+        self.client.force_login(self.user)
+        self.jst = timezone.get_current_timezone()
+
+    def test_import_parses_and_dedups_by_uid(self):
+        stats = ics.import_ics(self.user, SAMPLE_ICS.encode().splitlines(True), batch_size=2)
+        self.assertEqual(stats, {"created": 3, "duplicates": 0, "skipped": 1})
+
+        a = Schedule.objects.get(uid="a@example.com")
+        self.assertEqual((a.title, a.memo, a.priority, a.duration_minutes), ("定例, 週次", "1行目\n2行目", 1, 90))
+        self.assertEqual(a.date, timezone.make_aware(datetime(2026, 7, 1, 10), self.jst))
+        b = Schedule.objects.get(uid="b@example.com")
+        self.assertTrue(b.title.endswith("確認します"))
+        self.assertEqual(b.duration_minutes, 45)
+        self.assertEqual(Schedule.objects.get(uid="c@example.com").duration_minutes, 24 * 60)
+
+        again = ics.import_ics(self.user, SAMPLE_ICS.encode().splitlines(True))
+        self.assertEqual(again["created"], 0)
+        self.assertEqual(again["duplicates"], 3)
+
+    def test_folding_splits_on_character_boundaries(self):
+        line = "SUMMARY:" + "予定" * 40
+        folded = ics.fold(line)
+        self.assertTrue(all(len(part.encode()) <= 75 for part in folded.split("\r\n")))
+        self.assertEqual(list(ics.iter_lines(folded.encode().splitlines(True))), [line])
+
+    def test_export_round_trip(self):
+        Schedule.objects.create(
+            user=self.user, title="会議; 定例", memo="議題\nメモ", priority=3,
+            date=timezone.make_aware(datetime(2026, 7, 5, 9), self.jst), duration_minutes=30,
+        )
+        ScheduleSeries.objects.create(
+            user=self.user, title="授業", dtstart=timezone.make_aware(datetime(2026, 4, 6, 8), self.jst),
+            freq="weekly", byweekday="0,2", count=10, exdates=["2026-04-08"],
+        )
+        res = self.client.get(reverse("schedule_export_ics"))
+        self.assertTrue(res.streaming)
+        body = b"".join(res.streaming_content)
+        self.assertIn(b"RRULE:FREQ=WEEKLY;BYDAY=MO,WE;COUNT=10", body)
+        self.assertIn(b"EXDATE;TZID=Asia/Tokyo:20260408T080000", body)
+
+        other = User.objects.create_user("ics2")
+        stats = ics.import_ics(other, body.splitlines(True))
+        self.assertEqual(stats["created"], 2)
+        copy = Schedule.objects.get(user=other, title="会議; 定例")
+        self.assertEqual((copy.memo, copy.priority, copy.duration_minutes), ("議題\nメモ", 3, 30))
+
+    def test_reimporting_own_export_creates_nothing(self):
+        Schedule.objects.create(
+            user=self.user, title="UIDなし", date=timezone.make_aware(datetime(2026, 7, 6, 9), self.jst),
+            duration_minutes=30,
+        )
+        ScheduleSeries.objects.create(
+            user=self.user, title="授業", dtstart=timezone.make_aware(datetime(2026, 4, 6, 8), self.jst),
+            freq="weekly", byweekday="0", count=3,
+        )
+        body = b"".join(self.client.get(reverse("schedule_export_ics")).streaming_content)
+        self.assertIn(b"UID:schedule-", body)
+
+        stats = ics.import_ics(self.user, body.splitlines(True))
+        self.assertEqual((stats["created"], stats["duplicates"]), (0, 2))
+        self.assertEqual(Schedule.objects.filter(user=self.user).count(), 1)
+
+    def test_import_view(self):
+        upload = SimpleUploadedFile("cal.ics", SAMPLE_ICS.encode(), content_type="text/calendar")
+        res = self.client.post(reverse("schedule_import_ics"), {"file": upload})
+        self.assertRedirects(res, reverse("schedule_list"))
+        self.assertEqual(Schedule.objects.filter(user=self.user).count(), 3)
+
+
+class ASGIStreamingTests(TestCase):
+    """ASGI でも大きいレスポンスは全部読み終わる前から送り始める（同期イテレータだと先に全部読まれる）"""
+
+    ROWS = 450
+
+    def setUp(self):
+        self.user = User.objects.create_user("asgi", "asgi@example.com", "pw")
+        self.client.force_login(self.user)
+        jst = timezone.get_current_timezone()
+        schedules = [
+            Schedule(user=self.user, title=f"予定{i}", duration_minutes=30,
+                     date=timezone.make_aware(datetime(2026, 1, 1, 9), jst) + timedelta(hours=i))
+            for i in range(self.ROWS)
+        ]
+        for schedule in schedules:
+            schedule.end_at = schedule.compute_end_at()
+        Schedule.objects.bulk_create(schedules)
+        # テストのトランザクションの接続がリクエストの開始時に閉じられないように（テストクライアントと同じ）
+        request_started.disconnect(close_old_connections)
+        self.addCleanup(request_started.connect, close_old_connections)
+
+    def get_via_asgi(self, path, rows_read):
+        """ASGIHandler を直接呼び、本文のメッセージと、最初の本文を送った時点で読まれていた行数を返す"""
+        cookie = "; ".join(f"{k}={v.value}" for k, v in self.client.cookies.items())
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+            "headers": [(b"host", b"testserver"), (b"cookie", cookie.encode())],
+            "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+        }
+        requested = []
+        bodies = []
+        read_at_first_body = []
+
+        async def receive():
+            if not requested:
+                requested.append(True)
+                return {"type": "http.request", "body": b"", "more_body": False}
+            # 切断を待つ側はレスポンスが終わって止められるまで待つ
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                self.assertEqual(message["status"], 200)
+            elif message["type"] == "http.response.body":
+                if not read_at_first_body:
+                    read_at_first_body.append(rows_read())
+                bodies.append(message.get("body", b""))
+
+        async_to_sync(ASGIHandler())(scope, receive, send)
+        return bodies, read_at_first_body[0]
+
+    def test_json_list_streams_under_asgi(self):
+        made = []
+
+        class CountingEncoder(DjangoJSONEncoder):
+            def __init__(self, *args, **kwargs):
+                made.append(1)
+                super().__init__(*args, **kwargs)
+
+        with mock.patch("taskplanner.views.DjangoJSONEncoder", CountingEncoder):
+            bodies, read = self.get_via_asgi(reverse("schedule_list_json"), lambda: len(made))
+        self.assertEqual(read, 0)
+        self.assertGreater(len(bodies), 2)
+        self.assertEqual(len(json.loads(b"".join(bodies))), self.ROWS)
+
+    def test_ics_export_streams_under_asgi(self):
+        with mock.patch("taskplanner.ics._schedule_vevent", wraps=ics._schedule_vevent) as vevent:
+            bodies, read = self.get_via_asgi(reverse("schedule_export_ics"), lambda: vevent.call_count)
+        self.assertEqual(read, 0)
+        self.assertGreater(len(bodies), 2)
+        self.assertEqual(b"".join(bodies).count(b"BEGIN:VEVENT"), self.ROWS)
+
+
+class _FakeConnection:
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+        self.rollbacks = 0
+
+    def ping(self):
+        if not self.alive:
+            raise OSError("server has gone away")
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class DBPoolTests(TestCase):
+    def _pool(self, **options):
+        made = []
+
+        def connect():
+            made.append(_FakeConnection())
+            return made[-1]
+
+        return ConnectionPool(connect, **options), made
+
+    def test_idle_connection_is_reused_and_reset(self):
+        pool, made = self._pool(size=2, max_overflow=0)
+        for _ in range(5):
+            pool.checkin(pool.checkout())
+
+        self.assertEqual(len(made), 1)
+        self.assertEqual(made[0].rollbacks, 5)
+        self.assertEqual(pool.stats()["created"], 1)
+
+    def test_overflow_connections_are_closed_on_return(self):
+        pool, made = self._pool(size=1, max_overflow=2)
+        conns = [pool.checkout() for _ in range(3)]
+        for c in conns:
+            pool.checkin(c)
+
+        stats = pool.stats()
+        self.assertEqual((stats["open"], stats["idle"], stats["in_use"]), (1, 1, 0))
+        self.assertEqual(sum(c.closed for c in made), 2)
+
+    def test_exhausted_pool_waits_then_times_out(self):
+        pool, _ = self._pool(size=1, max_overflow=0, timeout=0.05)
+        conn = pool.checkout()
+        with self.assertRaises(PoolTimeout):
+            pool.checkout()
+
+        # 別スレッドが返せば、待っていた側がそれを借りる
+        pool.timeout = 2.0
+        threading.Timer(0.05, pool.checkin, [conn]).start()
+        self.assertIs(pool.checkout(), conn)
+
+        stats = pool.stats()
+        self.assertEqual((stats["waits"], stats["timeouts"]), (2, 1))
+        self.assertGreater(stats["wait_seconds"], 0)
+
+    def test_dead_and_old_connections_are_replaced(self):
+        pool, made = self._pool(size=1, max_overflow=0, pre_ping=True)
+        first = pool.checkout()
+        pool.checkin(first)
+        first.alive = False
+        second = pool.checkout()
+        self.assertIsNot(second, first)
+        self.assertTrue(first.closed)
+        pool.checkin(second)
+
+        pool.recycle = 0.01
+        time.sleep(0.02)
+        third = pool.checkout()
+        self.assertIsNot(third, second)
+        self.assertTrue(second.closed)
+        self.assertEqual(len(made), 3)
+        self.assertEqual((pool.stats()["discarded"], pool.stats()["recycled"]), (1, 1))
+
+
+METRICS_ON = {"ENABLED": True, "SAMPLE_RATE": 1.0, "SLOW_REQUEST_MS": 1000, "TOKEN": "scrape"}
+
+
+@override_settings(METRICS=METRICS_ON)
+class MetricsMiddlewareTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.user = User.objects.create_user("metrics", "metrics@example.com", "pw")
+        self.client.force_login(self.user)
+
+    def _logged(self, *args, **kwargs):
+        with self.assertLogs("taskplanner.metrics", "INFO") as logs:
+            res = self.client.get(*args, **kwargs)
+        return res, json.loads(logs.records[-1].getMessage())
+
+    def test_server_timing_and_log_line(self):
+        res, record = self._logged(reverse("freebusy"))
+
+        self.assertIn("db;dur=", res["Server-Timing"])
+        self.assertEqual(record["view"], "freebusy")
+        self.assertGreaterEqual(record["queries"], 1)
+        self.assertIn(f'desc="{record["queries"]} queries"', res["Server-Timing"])
+        self.assertNotIn("slow_queries", record)
+
+    @override_settings(PLAN_JOBS_INLINE=True, PLAN_AI_POLISH=True, AI_PLAN_CACHE={"BACKEND": None})
+    def test_ai_attempts_are_timed(self):
+        ai_service._breakers.clear()
+        self.addCleanup(ai_service._breakers.clear)
+        PlanTask.objects.create(user=self.user, title="読書", estimated_minutes=30)
+
+        with mock.patch.object(ai_service, "_get_client", return_value=FakeGeminiClient()):
+            with self.assertLogs("taskplanner.metrics", "INFO") as logs:
+                res = self.client.post(reverse("plan_generate"), HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual([(a["model"], a["outcome"]) for a in record["ai"]], [(ai_service.MODEL_CANDIDATES[0], "ok")])
+        self.assertIn("ai;dur=", res["Server-Timing"])
+
+    @override_settings(METRICS={**METRICS_ON, "SAMPLE_RATE": 0.0})
+    def test_unsampled_requests_only_feed_the_histogram(self):
+        res = self.client.get(reverse("freebusy"))
+        self.assertFalse(res.has_header("Server-Timing"))
+        self.assertIn('taskplanner_request_duration_seconds_count{view="freebusy"', metrics.render())
+        self.assertNotIn('taskplanner_request_queries_count{view="freebusy"', metrics.render())
+
+    @override_settings(METRICS={**METRICS_ON, "CAPTURE_STACKS": True, "SLOW_QUERY_MS": 0})
+    def test_stacks_only_when_asked(self):
+        _, record = self._logged(reverse("freebusy"))
+        self.assertTrue(record["slow_queries"][0]["stack"])
+
+    def test_endpoint_requires_token(self):
+        with self.assertLogs("taskplanner.metrics", "INFO"):
+            self.client.get(reverse("freebusy"))
+            self.assertEqual(self.client.get(reverse("metrics")).status_code, 401)
+            res = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer scrape")
+        self.assertEqual(res.status_code, 200)
+        body = res.content.decode()
+        self.assertIn('taskplanner_request_duration_seconds_bucket{view="freebusy",method="GET"', body)
+        self.assertIn('le="+Inf"', body)
+        self.assertIn("taskplanner_request_queries_sum", body)
+
+    @override_settings(METRICS={"ENABLED": False})
+    def test_disabled_adds_nothing(self):
+        res = self.client.get(reverse("freebusy"))
+        self.assertFalse(res.has_header("Server-Timing"))
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 404)
+
+
+class SessionCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("sc", "sc@example.com", "old-pw-123!")
+        self.client.force_login(self.user)
+
+    def session_and_user_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get(url)
+        sqls = [q["sql"] for q in ctx.captured_queries]
+        return res, [sql for sql in sqls if "django_session" in sql or "auth_user" in sql]
+
+    def test_warm_page_reads_session_and_user_from_cache(self):
+        self.client.get(reverse("settings"))
+        res, queries = self.session_and_user_queries(reverse("settings"))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(queries, [])
+        self.assertEqual(res.wsgi_request.user, self.user)
+
+    def test_username_and_email_changes_are_seen_on_the_next_page(self):
+        self.client.get(reverse("settings"))
+        self.client.post(reverse("settings_username"), {"username": "sc-new"})
+        res = self.client.get(reverse("settings"))
+        self.assertEqual(res.wsgi_request.user.username, "sc-new")
+
+        self.client.post(reverse("settings_email"), {"email": "new@example.com"})
+        res = self.client.get(reverse("settings"))
+        self.assertEqual(res.wsgi_request.user.email, "new@example.com")
+
+    def test_password_change_logs_out_other_sessions(self):
+        other = self.client_class()
+        other.force_login(self.user)
+        other.get(reverse("settings"))
+
+        res = self.client.post(reverse("password_change"), {
+            "old_password": "old-pw-123!", "new_password1": "new-pw-456?", "new_password2": "new-pw-456?",
+        })
+        self.assertEqual(res.status_code, 302)
+        # 変えた本人はそのまま、ほかのセッションはキャッシュに古いユーザーが残っていても切れる
+        self.assertEqual(self.client.get(reverse("settings")).status_code, 200)
+        self.assertRedirects(other.get(reverse("settings")), reverse("login") + "?next=" + reverse("settings"))
+
+    def test_logout_clears_session_and_user(self):
+        self.client.get(reverse("settings"))
+        key = self.client.session.session_key
+        self.client.get(reverse("logout"))
+        self.assertFalse(Session.objects.filter(session_key=key).exists())
+        self.assertIsNone(cache.get(sessions._user_key(self.user.pk)))
+        self.assertEqual(self.client.get(reverse("settings")).status_code, 302)
+
+    @override_settings(SESSION_WRITE_BEHIND_SECONDS=30)
+    def test_write_behind_only_for_non_auth_keys(self):
+        key = self.client.session.session_key
+        store = sessions.SessionStore(key)
+        store["note"] = "x"
+        with CaptureQueriesContext(connection) as ctx:
+            store.save()
+        self.assertEqual(ctx.captured_queries, [])
+        self.assertEqual(sessions.SessionStore(key)["note"], "x")
+        self.assertNotIn("note", Session.objects.get(session_key=key).get_decoded())
+
+        # ログイン状態のキーが変わったら DB にも書く（ほかのインスタンスでも正しくなるように）
+        store = sessions.SessionStore(key)
+        del store[SESSION_KEY]
+        store.save()
+        decoded = Session.objects.get(session_key=key).get_decoded()
+        self.assertNotIn(SESSION_KEY, decoded)
+        self.assertEqual(decoded["note"], "x")
+
+    @override_settings(SESSION_WRITE_BEHIND_SECONDS=30)
+    def test_cache_only_changes_reach_the_db_after_the_window(self):
+        key = self.client.session.session_key
+        store = sessions.SessionStore(key)
+        store["note"] = "x"
+        store.save()
+        self.assertNotIn("note", Session.objects.get(session_key=key).get_decoded())
+
+        # 窓の中で読んでも書かない
+        self.assertEqual(sessions.SessionStore(key)["note"], "x")
+        self.assertNotIn("note", Session.objects.get(session_key=key).get_decoded())
+
+        # 窓を過ぎてから読んだら DB に書く（書き込みが無くても）
+        later = time.time() + 31
+        with mock.patch("taskplanner.sessions.time.time", return_value=later):
+            self.assertEqual(sessions.SessionStore(key)["note"], "x")
+        self.assertEqual(Session.objects.get(session_key=key).get_decoded()["note"], "x")
+        with CaptureQueriesContext(connection) as ctx:
+            sessions.SessionStore(key)["note"]
+        self.assertEqual(ctx.captured_queries, [])
+
+    def test_stale_cached_user_does_not_log_out_the_new_password(self):
+        stale = User.objects.get(pk=self.user.pk)
+        self.client.get(reverse("settings"))
+        self.client.post(reverse("password_change"), {
+            "old_password": "old-pw-123!", "new_password1": "new-pw-456?", "new_password2": "new-pw-456?",
+        })
+        # ほかのインスタンスのキャッシュには変更前の User が残っている
+        cache.set(sessions._user_key(self.user.pk), stale)
+
+        res = self.client.get(reverse("settings"))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.wsgi_request.user.password, User.objects.get(pk=self.user.pk).password)
+        self.assertNotEqual(cache.get(sessions._user_key(self.user.pk)).password, stale.password)
+
+    @override_settings(SESSION_USER_CACHE_SECONDS=7)
+    def test_cached_user_lifetime_is_bounded(self):
+        with mock.patch.object(sessions, "_cache", return_value=mock.Mock(get=mock.Mock(return_value=None))) as c:
+            self.client.get(reverse("settings"))
+        c.return_value.set.assert_called_with(sessions._user_key(self.user.pk), mock.ANY, 7)
+
+
+class StartupTests(TestCase):
+    def test_migrate_is_skipped_when_everything_is_applied(self):
+        self.assertEqual(startup.pending_migrations(), [])
+        self.assertIn("taskplanner.0001_initial", startup.disk_migrations())
+
+        out = io.StringIO()
+        with mock.patch("taskplanner.management.commands.migrate_if_needed.call_command") as migrate:
+            call_command("migrate_if_needed", stdout=out)
+        migrate.assert_not_called()
+        self.assertIn("migrate skipped", out.getvalue())
+
+    def test_migrate_runs_when_something_is_pending(self):
+        disk = startup.disk_migrations() + ["taskplanner.9999_new"]
+        out = io.StringIO()
+        with mock.patch.object(startup, "disk_migrations", return_value=disk), \
+                mock.patch("taskplanner.management.commands.migrate_if_needed.call_command") as migrate:
+            call_command("migrate_if_needed", stdout=out)
+        self.assertEqual(migrate.call_args.args, ("migrate",))
+        self.assertIn("1 pending migrations", out.getvalue())
+        self.assertNotEqual(startup.migration_state_hash(disk), startup.migration_state_hash(disk[:-1]))
+
+    def test_warm_up_records_phases(self):
+        self.addCleanup(startup._timings.clear)
+        with override_settings(STARTUP_WARMUP=True), \
+                mock.patch("django.db.connections.close_all") as close_all, \
+                self.assertLogs("taskplanner.startup", "INFO") as logs:
+            app = startup.load_application(lambda: "app")
+
+        self.assertEqual(app, "app")
+        close_all.assert_called_once()
+        self.assertEqual(set(startup.startup_timings()), {"django_setup", "urls", "templates", "ai_import"})
+        self.assertEqual(json.loads(logs.records[-1].getMessage())["event"], "warmup")
+        self.assertIn('taskplanner_startup_seconds{phase="templates"', metrics.render())
+
+    def test_no_warm_up_by_default(self):
+        self.addCleanup(startup._timings.clear)
+        with mock.patch.object(startup, "warm_up") as warm_up:
+            startup.load_application(lambda: "app")
+        warm_up.assert_not_called()
+        self.assertEqual(set(startup.startup_timings()), {"django_setup"})
+
+
+class BenchTests(TestCase):
+    def test_seed_user_is_deterministic(self):
+        a = seed_user("bench-a", schedules=50, tasks=6, suggestions=4, series=2, seed=1)
+        self.assertEqual(Schedule.objects.filter(user=a).count(), 50)
+        self.assertEqual(PlanTask.objects.filter(user=a).count(), 6)
+        self.assertEqual(PlanSuggestion.objects.filter(user=a).count(), 4)
+        self.assertEqual(ScheduleSeries.objects.filter(user=a).count(), 2)
+
+        first = list(Schedule.objects.filter(user=a).order_by("id").values_list("title", "date", "duration_minutes"))
+        a.delete()
+        a = seed_user("bench-a", schedules=50, tasks=6, suggestions=4, series=2, seed=1)
+        again = list(Schedule.objects.filter(user=a).order_by("id").values_list("title", "date", "duration_minutes"))
+        self.assertEqual(first, again)
+
+    def test_command_saves_and_compares(self):
+        fd, path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        options = {"sizes": "30", "tasks": 4, "repeat": 1, "warmup": 0, "in_place": True, "stdout": io.StringIO()}
+
+        call_command("bench", output=path, **options)
+        with open(path, encoding="utf-8") as f:
+            report = json.load(f)
+        results = report["results"]["30"]
+        self.assertEqual(
+            set(results),
+            {"login", "calendar", "calendar_warm", "schedule_list", "search", "schedule_search",
+             "plan_generate", "plan_apply"},
+        )
+        # 温まったカレンダーはセッション/ユーザーもキャッシュから引くので 0
+        self.assertEqual(results["calendar_warm"]["queries"], 0)
+        self.assertTrue(all(r["queries"] > 0 for name, r in results.items() if name != "calendar_warm"))
+        # データは残らない
+        self.assertFalse(User.objects.filter(username="bench30").exists())
+
+        # 基準より少ないクエリ数に書き換えると劣化として失敗する
+        report["results"]["30"]["calendar"]["queries"] = 0
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f)
+        with self.assertRaises(CommandError):
+            call_command("bench", compare=path, **options)
@@ -9,8 +9,14 @@ urlpatterns = [
     path("logout/", views.logout_view, name="logout"),
     path("schedule_create", views.schedule_create, name="schedule_create"),
     path("list/", views.schedule_list_view, name="schedule_list"),
+    path("list/json/", views.schedule_list_json, name="schedule_list_json"),
+    path("list/export.ics", views.schedule_export_ics, name="schedule_export_ics"),
+    path("list/import/", views.schedule_import_ics, name="schedule_import_ics"),
+    path("search/", views.search_view, name="search"),
     path("calendar/", views.calendar_view, name="calendar"),
+    path("freebusy/", views.freebusy_view, name="freebusy"),
     path("plan/generate/", views.plan_generate, name="plan_generate"),
+    path("plan/jobs/<int:pk>/", views.plan_job_status, name="plan_job_status"),
     path("plan/apply/", views.plan_apply, name="plan_apply"),
     path("plan/task", views.plan_task_view, name="plan_task"),
     path("plan/ai/", views.plan_ai_view, name="plan_ai"),
@@ -20,6 +26,12 @@ urlpatterns = [
     path("plan/suggestion/<int:pk>/delete/", views.plan_suggestion_delete, name="plan_suggestion_delete"),
     path("schedule/<int:pk>/edit/", views.schedule_edit, name="schedule_edit"),
     path("schedule/<int:pk>/delete/", views.schedule_delete, name="schedule_delete"),
+    path("series/", views.series_list_view, name="series_list"),
+    path("series/new/", views.series_create, name="series_create"),
+    path("series/<int:pk>/edit/", views.series_edit, name="series_edit"),
+    path("series/<int:pk>/delete/", views.series_delete, name="series_delete"),
+    path("series/<int:pk>/skip/", views.series_skip, name="series_skip"),
+    path("metrics", views.metrics_view, name="metrics"),
     path("settings/", views.settings_view, name="settings"),
     path("settings/", views.settings_view, name="settings"),
     path("settings/username/", views.settings_username_view, name="settings_username"),
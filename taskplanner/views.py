@@ -1,17 +1,36 @@
-from .forms import ScheduleForm, PlanTaskForm, PlanSuggestionForm, UsernameChangeForm, EmailChangeForm
+from .forms import ScheduleForm, ScheduleSeriesForm, PlanTaskForm, PlanSuggestionForm, UsernameChangeForm, EmailChangeForm
 from django.shortcuts import render, redirect, get_object_or_404
-from .models import Schedule, PlanTask, PlanSuggestion
-from datetime import date, datetime, timedelta, time , timezone as dt_timezone
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils.http import urlencode, urlsafe_base64_decode, urlsafe_base64_encode
+from .models import Schedule, ScheduleSeries, PlanTask, PlanSuggestion, PlanJob
+from .jobs import aenqueue_plan_job, aexpire_stale_jobs
+from . import metrics, search
+from .pagecache import (
+    SCHEDULES_NAMESPACE, SUGGESTIONS_NAMESPACE, TASKS_NAMESPACE, cached_page, fragment_key, fragment_timeout, no_validators,
+)
+from .calendar_index import month_index
+from .freebusy import FreeBusy
+from .ics import aexport_ics, export_ics, import_ics
+from .plan_service import apply_plan
+from .recurrence import occurrences_for
+from .signals import suggestions_deleted
+from .streaming import aiter_queryset, is_asgi
+from datetime import date, datetime, timedelta, time
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
 from django.contrib import messages
-from django.utils.dateparse import parse_datetime
 from django.views.decorators.http import require_POST
 from django.urls import reverse
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import PasswordChangeForm
+from django.utils.crypto import constant_time_compare
 import calendar
+import json
+import uuid
 
 
 @login_required
@@ -132,19 +151,23 @@ def schedule_edit(request, pk):
     )
 
     if request.method == "POST":
-        form = ScheduleForm(request.POST, instance=schedule)
+        form = ScheduleForm(request.POST, instance=schedule, user=request.user)
         if form.is_valid():
             form.save()
             return redirect("schedule_list")
     else:
-        form = ScheduleForm(instance=schedule)
+        form = ScheduleForm(instance=schedule, user=request.user)
 
     return render(request, "saving/schedule_edit.html", {"form": form, "schedule": schedule})
 
 
-@login_required
-def schedule_list_view(request):
-    qs = Schedule.objects.filter(user=request.user).order_by("-date")
+SCHEDULE_PAGE_SIZE = 50
+SCHEDULE_STREAM_CHUNK = 500
+
+
+def _filter_schedules(request):
+    """一覧画面とJSON APIで共通の絞り込み（q / priority / from / to）"""
+    qs = Schedule.objects.filter(user=request.user)
 
     q = request.GET.get("q", "").strip()
     priority = request.GET.get("priority", "").strip()
@@ -152,7 +175,8 @@ def schedule_list_view(request):
     date_to = request.GET.get("to", "").strip()
 
     if q:
-        qs = qs.filter(title__icontains=q)
+        # タイトルとメモの全文検索（n-gram の索引。taskplanner.search）
+        qs = search.filter_queryset(qs, q)
 
     if priority:
         try:
@@ -179,26 +203,165 @@ def schedule_list_view(request):
         except ValueError:
             pass
 
+    # (user, date) インデックスを逆順に読むだけで並ぶ（id は同時刻の順番を決めるため）
+    qs = qs.order_by("-date", "-id")
+
+    filters = {"q": q, "priority": priority, "from": date_from, "to": date_to}
+    return qs, filters
+
+
+def _encode_cursor(schedule):
+    raw = f"{schedule.date.isoformat()}|{schedule.id}"
+    return urlsafe_base64_encode(raw.encode())
+
+
+def _decode_cursor(value):
+    """壊れたカーソルは None（先頭から表示）"""
+    try:
+        raw = urlsafe_base64_decode(value).decode()
+        date_str, pk = raw.rsplit("|", 1)
+        dt = datetime.fromisoformat(date_str)
+        return dt, int(pk)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        return None
+
+
+@login_required
+def schedule_list_view(request):
+    qs, filters = _filter_schedules(request)
+
+    # キーセットページング：前ページ最後の (date, id) より後ろだけを読む（OFFSET を使わない）
+    cursor = _decode_cursor(request.GET.get("cursor", ""))
+    if cursor:
+        last_date, last_id = cursor
+        qs = qs.filter(Q(date__lt=last_date) | Q(date=last_date, id__lt=last_id))
+
+    schedules = list(qs[:SCHEDULE_PAGE_SIZE + 1])
+    next_url = None
+    if len(schedules) > SCHEDULE_PAGE_SIZE:
+        schedules = schedules[:SCHEDULE_PAGE_SIZE]
+        params = {k: v for k, v in filters.items() if v}
+        params["cursor"] = _encode_cursor(schedules[-1])
+        next_url = f"{reverse('schedule_list')}?{urlencode(params)}"
+
+    first_params = {k: v for k, v in filters.items() if v}
+    first_url = f"{reverse('schedule_list')}?{urlencode(first_params)}" if cursor else None
+    export_url = f"{reverse('schedule_list_json')}?{urlencode(first_params)}"
+
+    # 繰り返し予定は無期限のものもあるので、期間を区切って1ページ目にだけ出す
+    occurrences = [] if cursor else _series_occurrences_for_list(request, filters)
+
     return render(request, "saving/schedule_list.html", {
-        "schedules": qs,
-        "q": q,
-        "priority": priority,
-        "date_from": date_from,
-        "date_to": date_to,
+        "schedules": schedules,
+        "occurrences": occurrences,
+        "q": filters["q"],
+        "priority": filters["priority"],
+        "date_from": filters["from"],
+        "date_to": filters["to"],
+        "next_url": next_url,
+        "first_url": first_url,
+        "export_url": export_url,
     })
 
 
+SERIES_LIST_DEFAULT_DAYS = 14
+SERIES_LIST_MAX_DAYS = 366
+
+
+def _series_occurrences_for_list(request, filters):
+    """一覧の絞り込み期間（未指定なら今日から2週間）の繰り返し予定の回を、q/priority で絞って返す"""
+    jst = timezone.get_current_timezone()
+    try:
+        d_from = datetime.strptime(filters["from"], "%Y-%m-%d").date()
+    except ValueError:
+        d_from = timezone.localdate()
+    try:
+        d_to = datetime.strptime(filters["to"], "%Y-%m-%d").date() + timedelta(days=1)
+    except ValueError:
+        d_to = d_from + timedelta(days=SERIES_LIST_DEFAULT_DAYS)
+    d_to = min(d_to, d_from + timedelta(days=SERIES_LIST_MAX_DAYS))
+
+    start = timezone.make_aware(datetime.combine(d_from, time.min), jst)
+    end = timezone.make_aware(datetime.combine(d_to, time.min), jst)
+
+    occurrences = []
+    for o in occurrences_for(request.user.id, start, end):
+        if filters["q"] and not search.matches(filters["q"], o.title, o.memo):
+            continue
+        if filters["priority"] and str(o.priority) != filters["priority"]:
+            continue
+        occurrences.append(o)
+    return occurrences
+
+
+@login_required
+def search_view(request):
+    """予定とタスクを関連度順に（一覧画面の検索は日付順、こちらは当たりの良い順）"""
+    q = request.GET.get("q", "").strip()
+    results = search.search(request.user, q) if q else {"schedules": [], "tasks": []}
+
+    if request.headers.get("x-requested-with") == "XMLHttpRequest":
+        return JsonResponse({
+            "q": q,
+            "schedules": [
+                {"id": s.id, "title": s.title, "date": s.date, "score": s.score} for s in results["schedules"]
+            ],
+            "tasks": [{"id": t.id, "title": t.title, "score": t.score} for t in results["tasks"]],
+        })
+
+    return render(request, "saving/search.html", {"q": q, **results})
+
+
+SCHEDULE_JSON_FIELDS = ("id", "title", "date", "end_at", "priority", "duration_minutes", "memo")
+
+
+@login_required
+def schedule_list_json(request):
+    """
+    一覧と同じ絞り込みで全件をJSON配列として返す。
+    サーバ側カーソルで chunk ずつ読み、1件ずつ書き出すので件数に関係なくメモリは一定。
+    """
+    qs, _ = _filter_schedules(request)
+    rows = qs.values_list(*SCHEDULE_JSON_FIELDS)
+
+    def item(row):
+        return json.dumps(dict(zip(SCHEDULE_JSON_FIELDS, row)), cls=DjangoJSONEncoder, ensure_ascii=False)
+
+    def stream():
+        yield "["
+        sep = ""
+        for row in rows.iterator(chunk_size=SCHEDULE_STREAM_CHUNK):
+            yield sep + item(row)
+            sep = ","
+        yield "]"
+
+    async def astream():
+        yield "["
+        sep = ""
+        async for row in aiter_queryset(rows, SCHEDULE_STREAM_CHUNK):
+            yield sep + item(row)
+            sep = ","
+        yield "]"
+
+    return StreamingHttpResponse(
+        astream() if is_asgi(request) else stream(), content_type="application/json; charset=utf-8"
+    )
+
+
 @login_required
 def plan_suggestion_edit(request, pk):
     suggestion = get_object_or_404(PlanSuggestion, pk=pk, user=request.user)
 
     if request.method == "POST":
-        form = PlanSuggestionForm(request.POST, instance=suggestion)
+        form = PlanSuggestionForm(request.POST, instance=suggestion, user=request.user)
         if form.is_valid():
-            form.save()
+            suggestion = form.save(commit=False)
+            # 手で直した提案は次の再計画でも動かさない
+            suggestion.user_edited = True
+            suggestion.save()
             return redirect("plan_ai")
     else:
-        form = PlanSuggestionForm(instance=suggestion)
+        form = PlanSuggestionForm(instance=suggestion, user=request.user)
 
     return render(
         request,
@@ -212,6 +375,7 @@ def plan_suggestion_edit(request, pk):
 def plan_suggestion_delete(request, pk):
     suggestion = get_object_or_404(PlanSuggestion, pk=pk, user=request.user)
     suggestion.delete()
+    suggestions_deleted(request.user.id)
     return redirect("plan_ai")
 
 
@@ -244,6 +408,7 @@ def plan_task_delete(request, pk):
 
 
 @login_required
+@cached_page(TASKS_NAMESPACE)
 def plan_task_view(request):
     if request.method == "POST":
         form = PlanTaskForm(request.POST)
@@ -255,15 +420,36 @@ def plan_task_view(request):
     else:
         form = PlanTaskForm()
 
+    # 一覧は断片キャッシュに当たれば評価されない
     tasks = PlanTask.objects.filter(user=request.user).order_by("-created_at")
-    return render(request, "saving/plan_task.html", {"form": form, "tasks": tasks})
+    return render(
+        request,
+        "saving/plan_task.html",
+        {
+            "form": form,
+            "tasks": tasks,
+            "fragment_timeout": fragment_timeout(),
+            "tasks_key": fragment_key(request, TASKS_NAMESPACE, vary=[request.get_full_path()]),
+        },
+    )
 
 
 @login_required
+@cached_page(TASKS_NAMESPACE, SUGGESTIONS_NAMESPACE)
 def plan_ai_view(request):
     tasks = PlanTask.objects.filter(user=request.user).order_by("-created_at")
     suggestions = PlanSuggestion.objects.filter(user=request.user).order_by("order")
 
+    # 最新のジョブ：実行中なら画面でポーリング、終わっていれば結果メッセージを1回だけ出す
+    job = PlanJob.objects.filter(user=request.user).order_by("-id").first()
+    if job and not job.is_active and not job.notified:
+        for level, text in job.result_messages:
+            messages.add_message(request, level, text)
+        PlanJob.objects.filter(pk=job.pk).update(notified=True)
+    if job and job.is_active:
+        # 終わったら画面が再読み込みされるので、実行中の表示は 304 で使い回させない
+        no_validators(request)
+
     open_id = request.GET.get("open")
 
     return render(
@@ -273,6 +459,12 @@ def plan_ai_view(request):
             "tasks": tasks,
             "suggestions": suggestions,
             "open_id": open_id,
+            "job": job if job and job.is_active else None,
+            "fragment_timeout": fragment_timeout(),
+            "tasks_key": fragment_key(request, TASKS_NAMESPACE),
+            "suggestions_key": fragment_key(request, TASKS_NAMESPACE, SUGGESTIONS_NAMESPACE),
+            # 「カレンダーに追加」の二重送信対策（同じ token は1回しか適用しない）
+            "apply_token": uuid.uuid4().hex,
         },
     )
 
@@ -282,225 +474,100 @@ def plan_apply(request):
     if request.method != "POST":
         return redirect("plan_task")
 
-    suggestions = PlanSuggestion.objects.filter(user=request.user).select_related("task")
+    outcome = apply_plan(request.user, token=request.POST.get("apply_token"))
 
-    for s in suggestions:
-        Schedule.objects.create(
-            user=request.user,
-            title=s.task.title,
-            memo=s.task.memo,
-            date=s.suggested_start,
-            start_time=s.suggested_start.time(),
-            end_time=s.suggested_end.time(),
-            priority=s.task.priority,
-            duration=str(s.task.estimated_minutes or 60),
-        )
+    if request.headers.get("x-requested-with") == "XMLHttpRequest":
+        return JsonResponse(outcome)
+
+    if outcome["replayed"]:
+        messages.info(request, "このプランは既にカレンダーに追加済みです。")
+    elif outcome["created_count"]:
+        messages.success(request, f"{outcome['created_count']} 件の予定を追加しました。")
+
+    conflicts = outcome["conflicts"]
+    if conflicts and not outcome["replayed"]:
+        titles = "、".join(c["title"] for c in conflicts[:3])
+        messages.warning(request, f"既存の予定と重なる {len(conflicts)} 件（{titles} など）は追加しませんでした。")
 
     return redirect("calendar")
 
 
 @login_required
 @require_POST
-def plan_generate(request):
-    from .ai_service import ai_plan_tasks
-    if request.method != "POST":
-        return redirect("plan_ai")
+async def plan_generate(request):
+    # LLMはWebワーカーで待たない：ジョブを積んで即座に返す（run_plan_worker が処理）
+    # PLAN_JOBS_INLINE のときはその場で生成する。async ビューなので ASGI では Gemini の応答待ちでワーカーを塞がない
+    # 「すべて作り直す」のときだけ前回の提案を捨てる（既定は変わったタスクだけ計画し直す）
+    job = await aenqueue_plan_job(await request.auser(), full=request.POST.get("full") == "1")
+
+    if request.headers.get("x-requested-with") == "XMLHttpRequest":
+        return JsonResponse(_plan_job_payload(job), status=202)
+    return redirect("plan_ai")
 
-    # 既存の提案を削除
-    PlanSuggestion.objects.filter(user=request.user).delete()
 
-    tasks = PlanTask.objects.filter(user=request.user)
-    if not tasks.exists():
-        messages.info(request, "タスクが無いのでプランを作れませんでした。")
-        return redirect("plan_ai")
+def _plan_job_payload(job):
+    return {
+        "id": job.id,
+        "status": job.status,
+        "created_count": job.created_count,
+        "progress": job.progress,
+        "finished": job.status not in PlanJob.ACTIVE_STATUSES,
+        "status_url": reverse("plan_job_status", args=[job.id]),
+    }
 
-    payload = [
-        {
-            "id": t.id,
-            "title": t.title,
-            "memo": t.memo,
 
-            "priority": t.priority,
-            "priority_locked": True,  
+@login_required
+async def plan_job_status(request, pk):
+    user = await request.auser()
+    job = (
+        await PlanJob.objects.filter(pk=pk, user=user)
+        .only("id", "status", "created_count", "progress", "created_at", "started_at")
+        .afirst()
+    )
+    if job is None:
+        return JsonResponse({"error": "not found"}, status=404)
+    # ワーカーが落ちて積まれたまま/実行中のままなら失敗にして、画面のポーリングを終わらせる
+    if job.is_active and await aexpire_stale_jobs(pk=job.pk):
+        job.status = PlanJob.STATUS_FAILED
+    return JsonResponse(_plan_job_payload(job))
 
-            "deadline": t.deadline.isoformat() if t.deadline else None,
 
-            "desired_at": t.desired_at.isoformat() if t.desired_at else None,
-            "desired_at_locked": bool(t.desired_at), 
+FREEBUSY_MAX_DAYS = 62
 
-            "estimated_minutes": t.estimated_minutes,
-            "estimated_minutes_locked": bool(t.estimated_minutes), 
-        }
-        for t in tasks
-    ]
 
-    # ===== AIに渡す「既存予定」「期間」「作業可能時間」 =====
+@login_required
+async def freebusy_view(request):
+    """?start=YYYY-MM-DD&days=7 の期間の busy/free 区間（JST の ISO 文字列）"""
     jst = timezone.get_current_timezone()
-    window_start_dt = timezone.now().astimezone(jst).replace(hour=9, minute=0, second=0, microsecond=0)
-    window_end_dt = window_start_dt + timedelta(days=14)
-
-    schedules = Schedule.objects.filter(
-        user=request.user,
-        date__gte=window_start_dt,
-        date__lt=window_end_dt
-    ).order_by("date")
-
-    existing_events = []
-    for s in schedules:
-        start_dt = s.date.astimezone(jst)
-
-        if s.end_time:
-            end_dt = timezone.make_aware(datetime.combine(start_dt.date(), s.end_time), jst)
-            if end_dt <= start_dt:
-                end_dt += timedelta(days=1)
-        else:
-            try:
-                m = int(s.duration) if s.duration else 60
-            except ValueError:
-                m = 60
-            end_dt = start_dt + timedelta(minutes=m)
-
-        existing_events.append(
-            {"title": s.title, "start": start_dt.isoformat(), "end": end_dt.isoformat()}
-        )
-
-    availability = {
-        "timezone": "Asia/Tokyo",
-        "weekday": [{"start": "18:00", "end": "23:00"}],
-        "weekend": [{"start": "10:00", "end": "22:00"}],
-        "slot_minutes": 15,
-    }
-
-    window_start = window_start_dt.isoformat()
-    window_end = window_end_dt.isoformat()
-    # ===== ここまで =====
 
-    result = None
-    used_fallback = False
-
-    # ===== Gemini呼び出し =====
     try:
-        result = ai_plan_tasks(payload, existing_events, availability, window_start, window_end)
-        if not isinstance(result, list):
-            raise ValueError(f"AI結果がlistではありません: {type(result)}")
-    except Exception as e:
-        used_fallback = True
-        msg = str(e)
-
-        # メッセージはここで出す（成功時には出さない）
-        if ("503" in msg) or ("UNAVAILABLE" in msg) or ("high demand" in msg):
-            messages.error(request, "AIが混雑しています（503）。仮のルールでプランを作りました。")
-        else:
-            messages.error(request, f"AIエラーが発生しました。仮のルールでプランを作りました。（詳細: {msg}）")
-
-    # ===== フォールバック（疑似AI）=====
-    if result is None:
-        used_fallback = True
-        tasks_sorted = sorted(
-            tasks,
-            key=lambda t: (
-                t.priority,
-                t.deadline or datetime.max.replace(tzinfo=dt_timezone.utc),
-                t.estimated_minutes or 9999,
-            ),
-        )
-        result = []
-        order = 1
-        for t in tasks_sorted:
-            result.append({"id": t.id, "estimated_minutes": t.estimated_minutes or 60, "order": order})
-            order += 1
-
-    # ===== PlanSuggestion 作成 =====
-    base = window_start_dt
-    created_count = 0  # ★実際に作れた件数
-    skipped_count = 0  # ★スキップした件数（デバッグに便利）
-
-    for r in sorted(result, key=lambda x: int(x.get("order", 999999))):
-        task_id = r.get("id")
-        if task_id is None:
-            skipped_count += 1
-            continue
+        d = datetime.strptime(request.GET.get("start", ""), "%Y-%m-%d").date()
+    except ValueError:
+        d = timezone.localdate()
 
-        task = PlanTask.objects.filter(id=task_id, user=request.user).first()
-        if not task:
-            skipped_count += 1
-            continue
+    try:
+        days = int(request.GET.get("days", 7))
+    except (TypeError, ValueError):
+        days = 7
+    days = min(max(days, 1), FREEBUSY_MAX_DAYS)
 
-        # ---- AIが返した日時を使う（あれば） ----
-        start_at = r.get("start_at")
-        end_at = r.get("end_at")
-
-        start = end = None
-        minutes = None
-
-        if start_at and end_at:
-            sdt = parse_datetime(start_at)
-            edt = parse_datetime(end_at)
-
-            if sdt and timezone.is_naive(sdt):
-                sdt = timezone.make_aware(sdt, timezone.get_current_timezone())
-            if edt and timezone.is_naive(edt):
-                edt = timezone.make_aware(edt, timezone.get_current_timezone())
-
-            if sdt and edt and edt > sdt:
-                start, end = sdt, edt
-                minutes = int((end - start).total_seconds() // 60)
-
-        # ---- AI日時が無い/壊れている場合：仮詰め ----
-        if not (start and end):
-            est = r.get("estimated_minutes")
-            try:
-                minutes = int(est) if est is not None else (task.estimated_minutes or 60)
-            except (TypeError, ValueError):
-                minutes = task.estimated_minutes or 60
-
-            if minutes <= 0:
-                minutes = 60
-
-            start = base
-            end = start + timedelta(minutes=minutes)
-            base = end + timedelta(minutes=30)
-
-        # 所要時間をタスクに保存（未設定のときだけ）
-        if task.estimated_minutes is None and minutes is not None:
-            task.estimated_minutes = minutes
-            task.save(update_fields=["estimated_minutes"])
-
-        # 優先度をAIが返してきたら反映（1〜3のみ）
-        p = r.get("priority")
-        if p in (1, 2, 3) and task.priority != p:
-            task.priority = p
-            task.save(update_fields=["priority"])
-
-        # order を安全に決める（AIがorder返さない場合に備える）
-        try:
-            order_val = int(r.get("order", 999999))
-        except (TypeError, ValueError):
-            order_val = 999999
+    start = timezone.make_aware(datetime.combine(d, time.min), jst)
+    end = start + timedelta(days=days)
+    fb = await FreeBusy.afor_user(await request.auser(), start, end)
 
-        PlanSuggestion.objects.create(
-            user=request.user,
-            task=task,
-            suggested_start=start,
-            suggested_end=end,
-            order=order_val,
-        )
-        created_count += 1
+    def fmt(intervals):
+        return [[s.astimezone(jst).isoformat(), e.astimezone(jst).isoformat()] for s, e in intervals]
 
-    # ===== メッセージ：ここが一番重要 =====
-    if created_count == 0:
-        # resultはあるのに保存できてないパターンを確実に拾う
-        messages.error(request, "プランを作れませんでした（AI出力が不正か、タスクIDが一致していません）。")
-    else:
-        if used_fallback:
-            messages.info(request, f"仮ルールでプランを {created_count} 件生成しました。")
-        else:
-            messages.success(request, f"AIプランを {created_count} 件生成しました。")
-
-    return redirect("plan_ai")
+    return JsonResponse({
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "busy": fmt(fb.busy),
+        "free": fmt(fb.free),
+    })
 
 
 @login_required
+@cached_page(SCHEDULES_NAMESPACE)
 def calendar_view(request):
     today = date.today()
 
@@ -535,8 +602,15 @@ def calendar_view(request):
     elif selected_day > last_day:
         selected_day = last_day
 
-    cal = calendar.Calendar(firstweekday=6)
-    weeks = cal.monthdayscalendar(year, month)
+    # 月グリッド：日ごとの件数/合計分を1クエリで集計したもの（キャッシュ済み）を各マスに付ける
+    # 月グリッドとその日の予定は断片キャッシュに当たれば作らない（テンプレートで初めて評価される）
+    def build_weeks():
+        load = month_index(request.user.id, year, month)
+        cal = calendar.Calendar(firstweekday=6)
+        return [
+            [{"day": d, "load": load.get(d)} for d in week]
+            for week in cal.monthdayscalendar(year, month)
+        ]
 
     # 前月/次月（テンプレ用）
     prev_year, prev_month = year, month - 1
@@ -553,18 +627,28 @@ def calendar_view(request):
     start = timezone.make_aware(datetime(year, month, selected_day, 0, 0, 0), jst)
     end = start + timedelta(days=1)
 
-    schedules = Schedule.objects.filter(
-        user=request.user,
-        date__gte=start,
-        date__lt=end
-    ).order_by("date")
+    def build_schedules():
+        schedules = list(Schedule.objects.filter(
+            user=request.user,
+            date__gte=start,
+            date__lt=end
+        ).order_by("date"))
+        # 繰り返し予定はその日の分だけ展開して混ぜる
+        schedules += occurrences_for(request.user.id, start, end)
+        schedules.sort(key=lambda s: s.date)
+        return schedules
 
     context = {
         "year": year,
         "month": month,
-        "weeks": weeks,
+        "weeks": SimpleLazyObject(build_weeks),
         "selected_day": selected_day,
-        "schedules": schedules,
+        "schedules": SimpleLazyObject(build_schedules),
+        "fragment_timeout": fragment_timeout(),
+        "grid_key": fragment_key(request, SCHEDULES_NAMESPACE, vary=[year, month, selected_day]),
+        "day_key": fragment_key(
+            request, SCHEDULES_NAMESPACE, vary=[year, month, selected_day, request.get_full_path()]
+        ),
         "today": today,
         "prev_year": prev_year,
         "prev_month": prev_month,
@@ -577,29 +661,129 @@ def calendar_view(request):
 @login_required
 def schedule_create(request):
     if request.method == "POST":
-        form = ScheduleForm(request.POST)
+        form = ScheduleForm(request.POST, user=request.user)
         if form.is_valid():
             schedule = form.save(commit=False)
             schedule.user = request.user
-
-            minutes = int(form.cleaned_data.get("duration") or 0)
-
-            schedule.start_time = schedule.date.time()
-
-            end_datetime = schedule.date + timedelta(minutes=minutes)
-            schedule.end_time = end_datetime.time()
-
             schedule.save()
 
             return redirect(
                 f"/calendar/?year={schedule.date.year}&month={schedule.date.month}&day={schedule.date.day}"
             )
     else:
-        form = ScheduleForm()
+        form = ScheduleForm(user=request.user)
 
     return render(request, "saving/schedule_form.html", {"form": form})
 
 
+@login_required
+def schedule_export_ics(request):
+    content = aexport_ics(request.user) if is_asgi(request) else export_ics(request.user)
+    response = StreamingHttpResponse(content, content_type="text/calendar; charset=utf-8")
+    response["Content-Disposition"] = 'attachment; filename="schedules.ics"'
+    return response
+
+
+@login_required
+def schedule_import_ics(request):
+    if request.method == "POST":
+        upload = request.FILES.get("file")
+        if not upload:
+            messages.error(request, "ファイルを選択してください。")
+            return redirect("schedule_import_ics")
+
+        # UploadedFile は1行ずつ読めるので、ファイル全体をメモリに載せずに取り込める
+        stats = import_ics(request.user, upload)
+        messages.success(
+            request,
+            f"{stats['created']} 件の予定を取り込みました。"
+            f"（取り込み済み {stats['duplicates']} 件・読めなかった予定 {stats['skipped']} 件はスキップ）",
+        )
+        return redirect("schedule_list")
+
+    return render(request, "saving/schedule_import.html")
+
+
+@login_required
+def series_list_view(request):
+    series = ScheduleSeries.objects.filter(user=request.user).order_by("-dtstart")
+    return render(request, "saving/series_list.html", {"series_list": series})
+
+
+@login_required
+def series_create(request):
+    if request.method == "POST":
+        form = ScheduleSeriesForm(request.POST)
+        if form.is_valid():
+            series = form.save(commit=False)
+            series.user = request.user
+            series.save()
+            messages.success(request, "繰り返し予定を登録しました。")
+            return redirect("series_list")
+    else:
+        form = ScheduleSeriesForm()
+
+    return render(request, "saving/series_form.html", {"form": form})
+
+
+@login_required
+def series_edit(request, pk):
+    series = get_object_or_404(ScheduleSeries, pk=pk, user=request.user)
+
+    if request.method == "POST":
+        form = ScheduleSeriesForm(request.POST, instance=series)
+        if form.is_valid():
+            form.save()
+            return redirect("series_list")
+    else:
+        form = ScheduleSeriesForm(instance=series)
+
+    return render(request, "saving/series_form.html", {"form": form, "series": series})
+
+
+@login_required
+@require_POST
+def series_delete(request, pk):
+    series = get_object_or_404(ScheduleSeries, pk=pk, user=request.user)
+    series.delete()
+    return redirect("series_list")
+
+
+@login_required
+@require_POST
+def series_skip(request, pk):
+    """繰り返し予定の「この回だけ休み」（exdates に日付を足す）"""
+    series = get_object_or_404(ScheduleSeries, pk=pk, user=request.user)
+
+    day = request.POST.get("date", "")
+    try:
+        datetime.strptime(day, "%Y-%m-%d")
+    except ValueError:
+        return redirect("calendar")
+
+    if day not in series.exdates:
+        series.exdates = sorted(series.exdates + [day])
+        series.save(update_fields=["exdates"])
+
+    next_url = request.POST.get("next")
+    if next_url:
+        return redirect(next_url)
+    return redirect("calendar")
+
+
+def metrics_view(request):
+    """Prometheus のテキスト形式（METRICS["TOKEN"] があれば Bearer トークン、無ければスタッフのみ）"""
+    conf = metrics.config()
+    if not conf["ENABLED"]:
+        raise Http404
+    if conf["TOKEN"]:
+        if not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {conf['TOKEN']}"):
+            return HttpResponse(status=401)
+    elif not (request.user.is_authenticated and request.user.is_staff):
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @login_required
 def base(request):
     return render(request, "saving/base.html")